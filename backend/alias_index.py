@@ -0,0 +1,150 @@
+import threading
+from collections import Counter
+
+from search_engine import ENTRY_OVERHEAD_BYTES, RESULT_FIELDS, fetch_tenant_rows, rows_memory_bytes
+from utils import normalize_text
+
+DOCUMENT_COLUMNS = "id, procedure_name, text_content, category, subject, is_active, effective_date"
+ALIAS_COLUMNS = "id, document_id, normalized_alias"
+
+
+class AliasIndex:
+    """
+    Bảng băm normalized_alias (và normalize_text(procedure_name)) -> document.
+    Câu hỏi trùng khớp chính xác một alias được trả lời ngay, không cần
+    embedding hay RPC. match() tra thêm chỉ mục từ -> alias để có câu trả lời
+    tạm khi câu hỏi chỉ chứa một alias (chat-stream gửi trước kết quả hybrid).
+    """
+
+    def __init__(self, include_procedure_names: bool = True):
+        self.include_procedure_names = include_procedure_names
+        self._lock = threading.Lock()
+        self.documents = {}     # document_id -> row
+        self._keys = {}         # ("alias", id) | ("doc", id) -> normalized text
+        self._by_text = {}      # normalized text -> {key: document_id}
+        self._by_token = {}     # từ -> {key}
+
+    @classmethod
+    def from_supabase(cls, supabase, include_procedure_names: bool = True,
+                      tenant_column: str = None, tenant: str = None):
+        index = cls(include_procedure_names)
+        documents, aliases = fetch_tenant_rows(supabase, DOCUMENT_COLUMNS, ALIAS_COLUMNS, tenant_column, tenant)
+        for doc in documents:
+            index.upsert_document(doc)
+        for alias in aliases:
+            index.upsert_alias(alias)
+        return index
+
+    @classmethod
+    def from_snapshot(cls, snapshot, include_procedure_names: bool = True):
+        # Metadata documents đọc lười từ snapshot, chỉ bảng băm text -> id nằm trong RAM
+        index = cls(include_procedure_names)
+        index.documents = snapshot.rows("documents")
+        if include_procedure_names:
+            names = snapshot.column("documents", "procedure_name")
+            for i, doc_id in enumerate(snapshot.ids("documents")):
+                index._put(("doc", doc_id), normalize_text(names[i] or ""), doc_id)
+        document_ids = snapshot.column("alias", "document_id")
+        normalized = snapshot.column("alias", "normalized_alias")
+        texts = snapshot.column("alias", "alias_text")
+        for j, alias_id in enumerate(snapshot.ids("alias")):
+            text = normalized[j] or normalize_text(texts[j] or "")
+            index._put(("alias", alias_id), text, document_ids[j])
+        return index
+
+    def _put(self, key, text: str, document_id) -> None:
+        old = self._keys.pop(key, None)
+        if old is not None:
+            bucket = self._by_text.get(old, {})
+            bucket.pop(key, None)
+            if not bucket:
+                self._by_text.pop(old, None)
+            for token in set(old.split()):
+                keys = self._by_token.get(token)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._by_token[token]
+        if text and document_id is not None:
+            self._keys[key] = text
+            self._by_text.setdefault(text, {})[key] = document_id
+            for token in set(text.split()):
+                self._by_token.setdefault(token, set()).add(key)
+
+    def upsert_document(self, doc: dict) -> None:
+        with self._lock:
+            row = dict(self.documents.get(doc["id"], {}))
+            row.update(doc)
+            self.documents[doc["id"]] = row
+            if self.include_procedure_names:
+                name = normalize_text(row.get("procedure_name") or "")
+                self._put(("doc", doc["id"]), name, doc["id"])
+
+    def upsert_alias(self, alias: dict) -> None:
+        with self._lock:
+            text = alias.get("normalized_alias") or normalize_text(alias.get("alias_text") or "")
+            self._put(("alias", alias["id"]), text, alias.get("document_id"))
+
+    def remove_alias(self, alias_id) -> None:
+        with self._lock:
+            self._put(("alias", alias_id), "", None)
+
+    def _results(self, scored, limit: int) -> list:
+        # scored: [(document_id, score)] theo thứ tự ưu tiên
+        results = []
+        seen = set()
+        for document_id, score in scored:
+            if document_id in seen:
+                continue
+            seen.add(document_id)
+            doc = self.documents.get(document_id)
+            if doc is None or doc.get("is_active") is False:
+                continue
+            result = {field: doc.get(field) for field in RESULT_FIELDS}
+            result["score"] = score
+            results.append(result)
+            if len(results) == limit:
+                break
+        return results
+
+    def lookup(self, q_format: str, limit: int = 5) -> list:
+        with self._lock:
+            bucket = self._by_text.get(q_format)
+            if not bucket:
+                return []
+            return self._results(((document_id, 1.0) for document_id in bucket.values()), limit)
+
+    def match(self, q_format: str, limit: int = 5, min_coverage: float = 1.0) -> list:
+        """
+        Alias/tên thủ tục có ít nhất min_coverage số từ nằm trong câu hỏi.
+        score = số từ khớp / số từ của cả alias và câu hỏi (Jaccard), nên alias
+        dài, sát câu hỏi đứng trước.
+        """
+        tokens = set(q_format.split())
+        if not tokens:
+            return []
+        with self._lock:
+            hits = Counter()
+            for token in tokens:
+                hits.update(self._by_token.get(token, ()))
+            scored = []
+            for key, count in hits.items():
+                text = self._keys[key]
+                size = len(set(text.split()))
+                if count < min_coverage * size:
+                    continue
+                score = count / (size + len(tokens) - count)
+                scored.append((score, count, text, key))
+            scored.sort(key=lambda item: (-item[0], -item[1]))
+            return self._results(((self._by_text[text][key], round(score, 4))
+                                  for score, _, text, key in scored), limit)
+
+    def memory_bytes(self) -> int:
+        """Ước lượng bộ nhớ: text của các khóa, entry của các bảng băm và metadata documents."""
+        with self._lock:
+            text = sum(len(t) for t in self._keys.values())
+            entries = 2 * len(self._keys) + sum(len(keys) for keys in self._by_token.values())
+            return text + entries * ENTRY_OVERHEAD_BYTES + rows_memory_bytes(self.documents)
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -1,6 +1,9 @@
 
 import uuid
-from flask import Flask, request, jsonify
+import json
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from datetime import datetime
 from openai import OpenAI
@@ -9,64 +12,416 @@ from dotenv import load_dotenv
 import os
 from utils import normalize_text, classify
 from corn import supabase
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from embedding_codec import to_pgvector
+from search_engine import LocalSearchEngine
+from alias_index import AliasIndex
+from kb_version import KBVersion
+from result_cache import ResultCache
+from singleflight import SingleFlight
+import metrics
+from metrics import span, crud_span
+from listing import ListQuery, accepts_gzip, gzip_body, gzip_stream, GZIP_MIN_BYTES
+from bulk_import import BulkImportJobs, parse_alias_rows
+from reindex import ReindexQueue, Reindexer, embed_texts
+from kb_snapshot import SnapshotFile
+from query_log import QueryLog, query_record
+from tenants import DEFAULT_TENANT, TENANT_HEADER, TenantPathMiddleware, TenantRegistry, UnknownTenant
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# /t/<tenant>/api/... -> /api/... kèm header X-Tenant
+app.wsgi_app = TenantPathMiddleware(app.wsgi_app)
 
 client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY")
 )
 
+embedding_cache = EmbeddingCache.from_env()
 
-@app.route('/api/get-chunks', methods=['GET'])
-def get_chunks():
-    try:
-        response = supabase.table("documents") \
-            .select("id, procedure_name, text_content, category, subject, is_active, effective_date") \
-            .execute()
+# Gom embedding của nhiều request thành một lần gọi embeddings.create
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "1") == "1"
+embedding_batcher = EmbeddingBatcher.from_env(client)
 
-        if not response.data:
-            return jsonify({
-                "chunks": [],
-                "message": "No chunks available"
-            }), 200
 
-        return jsonify({
-            "chunks": response.data
-        }), 200
+def compute_embedding(text):
+    if EMBEDDING_BATCHING:
+        return embedding_batcher.embed(text)
+    return client.embeddings.create(
+        model=embedding_batcher.model,
+        input=text
+    ).data[0].embedding
 
-    except Exception as e:
-        return jsonify({
-            "error": str(e)
-        }), 500
 
+def embed_text(text, exact=False):
+    # exact=True cho vector sẽ ghi xuống Supabase: không dùng bản đã lượng tử hóa trong cache
+    return embedding_cache.embed(text, compute_embedding, exact=exact)
 
-@app.route('/api/get-alias', methods=['GET'])
-def get_alias():
-    try:
-        response = supabase.table("alias") \
-            .select("id, document_id, alias_text, normalized_alias") \
-            .execute()
+# "rpc": gọi search_documents_full_hybrid_v4 trên Supabase
+# "local": LocalSearchEngine nạp documents/alias vào RAM một lần
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "rpc")
+# Tenant của request không ghi tenant, của reindexer và của snapshot (xem tenants.py)
+SEARCH_TENANT = DEFAULT_TENANT
+# Cột tenant của bảng documents; trống: mọi tenant dùng chung bảng, chỉ khác
+# p_tenant của RPC, classifier và namespace cache
+TENANT_COLUMN = os.getenv("TENANT_COLUMN", "")
 
-        if not response.data:
-            return jsonify({
-                "alias": [],
-                "message": "No alias available"
-            }), 200
 
-        return jsonify({
-            "alias": response.data
-        }), 200
+def has_local_indexes(tenant):
+    # Không có TENANT_COLUMN thì không tách được dữ liệu theo tenant: chỉ tenant mặc định dùng
+    # alias index / LocalSearchEngine (cả bảng); tenant khác luôn tìm qua RPC (lọc theo p_tenant)
+    return bool(TENANT_COLUMN) or tenant == SEARCH_TENANT
+
+
+# Phiên bản knowledge base, dùng chung giữa các worker qua file KB_VERSION_PATH
+kb_version = KBVersion(os.getenv("KB_VERSION_PATH", "kb_version"))
+
+
+def version_scope(tenant):
+    # Có TENANT_COLUMN thì mỗi tenant có bộ đếm riêng: sửa một tenant không làm tenant khác
+    # nạp lại index hay mất result cache. Không có thì mọi tenant dùng bộ đếm chung
+    return tenant if TENANT_COLUMN else None
+
+
+def current_version(tenant=SEARCH_TENANT):
+    return kb_version.current(version_scope(tenant))
+
+
+# Codec của ma trận embedding trong LocalSearchEngine: float32 | float16 | int8
+LOCAL_SEARCH_CODEC = os.getenv("LOCAL_SEARCH_CODEC", "float32")
+
+
+def load_local_search(tenant):
+    snapshot = current_snapshot(tenant)
+    if snapshot is not None:
+        return LocalSearchEngine.from_snapshot(snapshot)
+    return LocalSearchEngine.from_supabase(supabase, codec=LOCAL_SEARCH_CODEC,
+                                           tenant_column=TENANT_COLUMN or None, tenant=tenant)
+
+
+def get_local_search(tenant=SEARCH_TENANT):
+    return tenants.get(tenant, "local_search")
+
+
+def search_documents(q_format, query_embedding, category, subject, limit=5, tenant=SEARCH_TENANT):
+    if SEARCH_BACKEND == "local" and has_local_indexes(tenant):
+        return get_local_search(tenant).search(q_format, query_embedding, category, subject, limit)
+
+    response = supabase.rpc(
+        "search_documents_full_hybrid_v4",
+        {
+            "p_query_format": q_format,
+            "p_query_embedding": query_embedding,
+            "p_tenant": tenant,
+            "p_category": category,
+            "p_subject": subject,
+            "p_limit": limit
+        }
+    ).execute()
+    return response.data
+
+
+# Câu hỏi trùng khớp chính xác alias/tên thủ tục: trả lời ngay, không gọi OpenAI/RPC
+ALIAS_FAST_PATH = os.getenv("ALIAS_FAST_PATH", "1") == "1"
+ALIAS_INDEX_PROCEDURE_NAMES = os.getenv("ALIAS_INDEX_PROCEDURE_NAMES", "1") == "1"
+
+
+def load_alias_index(tenant):
+    snapshot = current_snapshot(tenant)
+    if snapshot is not None:
+        return AliasIndex.from_snapshot(snapshot, ALIAS_INDEX_PROCEDURE_NAMES)
+    return AliasIndex.from_supabase(supabase, ALIAS_INDEX_PROCEDURE_NAMES,
+                                    tenant_column=TENANT_COLUMN or None, tenant=tenant)
+
+
+def get_alias_index(tenant=SEARCH_TENANT):
+    return tenants.get(tenant, "alias_index")
+
+
+# Classifier và index của từng tenant, nạp lười, LRU trong TENANT_MEMORY_BUDGET_MB
+tenants = TenantRegistry.from_env({"alias_index": load_alias_index, "local_search": load_local_search},
+                                  version=current_version)
+
+
+def request_tenant():
+    # Header X-Tenant (hoặc tiền tố /t/<tenant>/); không có thì tenant mặc định
+    return tenants.resolve(request.headers.get(TENANT_HEADER))
+
+
+@app.errorhandler(UnknownTenant)
+def unknown_tenant(e):
+    return jsonify({"error": f"Unknown tenant: {e}"}), 404
+
+
+def warm_indexes():
+    names = ["alias_index"] if ALIAS_FAST_PATH else []
+    if SEARCH_BACKEND == "local":
+        names.append("local_search")
+    return names
+
+
+def warm_up_indexes():
+    tenants.warm(warm_indexes(), [tenant for tenant in tenants.warm_tenants() if has_local_indexes(tenant)])
+
+
+_warm_up_pid = None
+
+
+@app.before_request
+def start_tenant_warm_up():
+    # Nạp sẵn index của các tenant "warm" trên thread nền, một lần mỗi worker
+    global _warm_up_pid
+    if _warm_up_pid != os.getpid():
+        _warm_up_pid = os.getpid()
+        threading.Thread(target=warm_up_indexes, daemon=True, name="tenant-warm-up").start()
+
+
+# Snapshot memmap dùng chung giữa các worker (xem kb_snapshot.py); trống thì luôn nạp từ Supabase
+KB_SNAPSHOT_PATH = os.getenv("KB_SNAPSHOT_PATH", "")
+kb_snapshot = SnapshotFile(KB_SNAPSHOT_PATH) if KB_SNAPSHOT_PATH else None
+_indexes_snapshot = kb_snapshot.key() if kb_snapshot else None
+
+
+def current_snapshot(tenant=SEARCH_TENANT):
+    # Snapshot export trước lần sửa gần nhất thì đã cũ, không dùng
+    if kb_snapshot is None or not has_local_indexes(tenant):
+        return None
+    snapshot = kb_snapshot.current()
+    if snapshot is None or snapshot.kb_version < current_version(tenant):
+        return None
+    # Chỉ dùng snapshot export đúng cách lọc đang chạy: cả bảng, hoặc đúng tenant theo TENANT_COLUMN
+    if snapshot.tenant_column != (TENANT_COLUMN or None) or (TENANT_COLUMN and snapshot.tenant != tenant):
+        return None
+    return snapshot
+
+result_cache = ResultCache(
+    max_items=int(os.getenv("RESULT_CACHE_SIZE", "2048")),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+)
+
+
+def sync_indexes(tenant=SEARCH_TENANT):
+    """
+    Phiên bản knowledge base hiện tại của tenant. Chỉ tenant có phiên bản đổi (worker khác
+    đã sửa) hoặc tenant của snapshot mới phải nạp lại index ở lần dùng tới.
+    """
+    global _indexes_snapshot
+    snapshot_key = kb_snapshot.key() if kb_snapshot else None
+    if snapshot_key != _indexes_snapshot:
+        _indexes_snapshot = snapshot_key
+        snapshot = kb_snapshot.current()
+        if snapshot is not None:
+            tenants.invalidate(snapshot.tenant or SEARCH_TENANT)
+    return tenants.sync(tenant)
+
+
+def fast_answer(q_format, category, subject, limit=5, tenant=SEARCH_TENANT):
+    """
+    Các đường trả lời không cần embedding: result cache rồi alias index.
+    Trả về (replies, source, version); replies là None nếu phải tìm hybrid.
+    """
+    version = sync_indexes(tenant)
+    with span("result_cache"):
+        replies = result_cache.get((tenant, q_format, category, subject, limit), version)
+    if replies is not None:
+        return replies, "cache", version
+
+    if ALIAS_FAST_PATH and has_local_indexes(tenant):
+        with span("alias_lookup"):
+            replies = get_alias_index(tenant).lookup(q_format, limit)
+        if replies:
+            return replies, "alias_exact", version
+
+    return None, None, version
+
+
+# Các request trùng câu hỏi đang chạy cùng lúc chỉ gọi embedding + search một lần
+search_flights = SingleFlight()
+
+
+def flight_key(q_format, category, subject, limit, version, tenant=SEARCH_TENANT):
+    return (tenant, q_format, category, subject, limit, version)
+
+
+def remember_answer(q_format, category, subject, limit, replies, version, tenant=SEARCH_TENANT):
+    # version là phiên bản đọc được TRƯỚC khi tìm, để kết quả cũ không bị gắn phiên bản mới
+    result_cache.set((tenant, q_format, category, subject, limit), replies, version)
+
+
+def hybrid_answer(user_message, q_format, category, subject, limit, version, cancelled=None,
+                  tenant=SEARCH_TENANT):
+    """
+    Embedding + search rồi ghi result cache. cancelled (threading.Event, do
+    SingleFlight.submit truyền vào) được set khi mọi client chờ câu này đã ngắt:
+    dừng trước bước tốn kém tiếp theo.
+    """
+    with span("embedding"):
+        query_embedding = embed_text(user_message)
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledError()
+    with span("search"):
+        replies = search_documents(q_format, query_embedding, category, subject, limit, tenant)
+    remember_answer(q_format, category, subject, limit, replies, version, tenant)
+    return replies
+
+
+def answer_query(user_message, q_format, category, subject, limit=5, tenant=SEARCH_TENANT):
+    """
+    Trả về (replies, source); source là "cache", "alias_exact" hoặc "hybrid".
+    """
+    replies, source, version = fast_answer(q_format, category, subject, limit, tenant)
+    if replies is not None:
+        return replies, source
+
+    with span("hybrid"):
+        replies = search_flights.do(
+            flight_key(q_format, category, subject, limit, version, tenant),
+            lambda: hybrid_answer(user_message, q_format, category, subject, limit, version, tenant=tenant))
+    return replies, "hybrid"
+
+
+def partial_answer(q_format, category, subject, limit=5, tenant=SEARCH_TENANT):
+    """
+    Câu trả lời tạm cho chat-stream trong lúc chờ hybrid, không cần embedding:
+    BM25 của LocalSearchEngine nếu đã nạp sẵn, không thì khớp một phần alias.
+    Trả về (replies, source) hoặc ([], None).
+    """
+    if not has_local_indexes(tenant):
+        return [], None
+    engine = tenants.peek(tenant, "local_search")
+    if engine is not None:
+        with span("partial"):
+            replies = [r for r in engine.search(q_format, None, category, subject, limit) if r["score"] > 0]
+        if replies:
+            return replies, "lexical"
+    if ALIAS_FAST_PATH:
+        with span("partial"):
+            replies = get_alias_index(tenant).match(q_format, limit)
+        if replies:
+            return replies, "alias_partial"
+    return [], None
+
+
+# --- Đồng bộ các index trong RAM sau khi ghi vào Supabase ---
+
+def bump_kb_version(tenant=SEARCH_TENANT):
+    # Không có TENANT_COLUMN thì chỉ tenant mặc định có index trong RAM
+    if not TENANT_COLUMN:
+        tenant = SEARCH_TENANT
+    before = tenants.loaded_version(tenant)
+    version = kb_version.bump(version_scope(tenant))
+    # Index trong process này đã được cập nhật tăng dần, chỉ cần ghi nhận
+    # phiên bản mới nếu không có worker nào khác sửa xen vào
+    if before is not None and version == before + 1:
+        tenants.advance(tenant, before, version)
+    # Upsert làm index lớn lên: tính lại bộ nhớ để ngân sách LRU vẫn đúng
+    tenants.refresh_memory(tenant)
+
+
+def affected_indexes(tenant):
+    # Không có cột tenant thì mọi tenant dùng chung bảng: cập nhật index đã nạp của mọi tenant
+    return tenants.loaded("local_search", tenant if TENANT_COLUMN else None) + \
+        tenants.loaded("alias_index", tenant if TENANT_COLUMN else None)
+
+
+def on_alias_saved(alias, bump=True, tenant=SEARCH_TENANT):
+    for index in affected_indexes(tenant):
+        index.upsert_alias(alias)
+    if bump:
+        bump_kb_version(tenant)
+
+
+def on_alias_deleted(alias_id, tenant=SEARCH_TENANT):
+    for index in affected_indexes(tenant):
+        index.remove_alias(alias_id)
+    bump_kb_version(tenant)
+
+
+def on_chunk_saved(chunk, tenant=SEARCH_TENANT):
+    for index in affected_indexes(tenant):
+        index.upsert_document(chunk)
+    bump_kb_version(tenant)
+
+
+CHUNK_FIELDS = ("id", "procedure_name", "text_content", "category", "subject", "is_active", "effective_date")
+ALIAS_FIELDS = ("id", "document_id", "alias_text", "normalized_alias")
+
+
+def list_rows(table, key, fields, filters, endpoint):
+    """
+    Liệt kê bảng với phân trang keyset, lọc, chọn cột, NDJSON, ETag và gzip.
+    Không truyền limit thì trả toàn bộ danh sách như trước.
+    """
+    try:
+        query = ListQuery(request.args, fields, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # ETag theo phiên bản knowledge base: danh sách không đổi thì trả 304, không chạm DB
+    tenant = request_tenant()
+    if TENANT_COLUMN and table == "documents":
+        query.filters[TENANT_COLUMN] = tenant
+    etag = query.etag((tenant, current_version(tenant)))
+    if etag in (request.headers.get("If-None-Match") or ""):
+        return Response(status=304, headers={"ETag": etag})
+
+    gzip_ok = accepts_gzip(request.headers)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+
+    if query.ndjson:
+        def generate():
+            try:
+                for row in query.iter_rows(supabase, table):
+                    yield (json.dumps(row, ensure_ascii=False, default=str) + "\n").encode()
+            except Exception as e:
+                yield (json.dumps({"error": str(e)}) + "\n").encode()
+
+        body = generate()
+        if gzip_ok:
+            body = gzip_stream(body)
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, mimetype="application/x-ndjson", headers=headers)
+
+    try:
+        with crud_span(endpoint, "supabase"):
+            if query.limit:
+                rows, next_cursor = query.fetch_page(supabase, table)
+            else:
+                rows, next_cursor = query.build(supabase, table).execute().data or [], None
+
+        payload = {key: rows}
+        if query.limit:
+            payload["next_cursor"] = next_cursor
+        if not rows:
+            payload["message"] = f"No {key} available"
+
+        body = app.json.dumps(payload).encode()
+        if gzip_ok and len(body) >= GZIP_MIN_BYTES:
+            body = gzip_body(body)
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, status=200, mimetype="application/json", headers=headers)
 
     except Exception as e:
         return jsonify({
             "error": str(e)
         }), 500
 
+
+@app.route('/api/get-chunks', methods=['GET'])
+def get_chunks():
+    return list_rows("documents", "chunks", CHUNK_FIELDS, ("category", "subject", "is_active"), "get_chunks")
+
+
+@app.route('/api/get-alias', methods=['GET'])
+def get_alias():
+    return list_rows("alias", "alias", ALIAS_FIELDS, ("document_id",), "get_alias")
+
 @app.route('/api/create-alias', methods=['POST'])
 def create_alias():
+    tenant = request_tenant()
     try:
         data = request.json
 
@@ -74,22 +429,23 @@ def create_alias():
         if not data.get("alias_text"):
             return jsonify({"error": "alias_text is required"}), 400
         
-        alias_embedding = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=data.get("alias_text")
-        ).data[0].embedding
-
+        with crud_span("create_alias", "embedding"):
+            alias_embedding = embed_text(data.get("alias_text"), exact=True)
 
         new_alias = {
             "document_id": data.get("document_id") or None,
             "alias_text": data.get("alias_text") or '',
             "normalized_alias": normalize_text(data.get("alias_text")) if data.get("alias_text") else '',
-            "embedding": alias_embedding
+            "embedding": to_pgvector(alias_embedding)
         }
 
-        response = supabase.table("alias") \
-            .insert(new_alias) \
-            .execute()
+        with crud_span("create_alias", "supabase"):
+            response = supabase.table("alias") \
+                .insert(new_alias) \
+                .execute()
+
+        for row in response.data or []:
+            on_alias_saved({**new_alias, **row}, tenant=tenant)
 
         return jsonify({
             "message": "Alias created successfully",
@@ -99,17 +455,79 @@ def create_alias():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- Import alias hàng loạt ---
+
+bulk_import_jobs = BulkImportJobs.from_env()
+BULK_IMPORT_CONCURRENCY = int(os.getenv("BULK_IMPORT_CONCURRENCY", "4"))
+
+
+def embed_batch(texts, endpoint="bulk_alias"):
+    # Một lần gọi embeddings.create cho nhiều input, kết quả theo đúng thứ tự
+    with crud_span(endpoint, "embedding"):
+        return embed_texts(client, embedding_batcher.model, texts)
+
+
+def run_bulk_import(job, tenant=SEARCH_TENANT):
+    saved = []
+
+    def on_saved(alias):
+        on_alias_saved(alias, bump=False, tenant=tenant)
+        saved.append(alias)
+
+    job.run(supabase, embed_batch, embedding_cache, embedding_batcher.model, on_saved,
+            concurrency=BULK_IMPORT_CONCURRENCY, tenant_column=TENANT_COLUMN or None, tenant=tenant)
+    # Một lần bump cho cả job thay vì mỗi alias một lần
+    if saved:
+        bump_kb_version(tenant)
+    metrics.log_event("bulk_alias_import", **{k: v for k, v in job.snapshot().items() if k != "errors"})
+
+
+@app.route('/api/aliases/bulk', methods=['POST'])
+def bulk_create_alias():
+    """
+    Body JSON [{"document_id", "alias_text"}, ...] hoặc CSV (Content-Type: text/csv).
+    Trả 202 kèm job id; theo dõi tiến độ ở GET /api/aliases/bulk/<job_id>.
+    """
+    try:
+        rows = parse_alias_rows(request.content_type, request.get_data())
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not rows:
+        return jsonify({"error": "No aliases to import"}), 400
+
+    tenant = request_tenant()
+    job = bulk_import_jobs.submit(rows, lambda job: run_bulk_import(job, tenant))
+    return jsonify({
+        "message": "Bulk import started",
+        "job_id": job.id,
+        "status_url": f"/api/aliases/bulk/{job.id}",
+        "total": len(rows)
+    }), 202
+
+
+@app.route('/api/aliases/bulk/<job_id>', methods=['GET'])
+def bulk_create_alias_status(job_id):
+    status = bulk_import_jobs.get(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(status), 200
+
 @app.route('/api/delete-alias/<alias_id>', methods=['DELETE'])
 def delete_alias(alias_id):
+    tenant = request_tenant()
     try:
-        response = supabase.table("alias") \
-            .delete() \
-            .eq("id", alias_id) \
-            .execute()
+        with crud_span("delete_alias", "supabase"):
+            response = supabase.table("alias") \
+                .delete() \
+                .eq("id", alias_id) \
+                .execute()
 
         if not response.data:
             return jsonify({"error": "Alias not found"}), 404
 
+        on_alias_deleted(response.data[0]["id"], tenant)
+
         return jsonify({
             "message": "Alias deleted successfully"
         }), 200
@@ -117,8 +535,31 @@ def delete_alias(alias_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- Embedding lại documents khi nội dung đổi (xem reindex.py) ---
+
+REINDEX_ON_WRITE = os.getenv("REINDEX_ON_WRITE", "1") == "1"
+
+
+def on_chunks_reindexed(docs):
+    # Chạy nền, không biết tenant của request: lấy theo TENANT_COLUMN mà reindexer đọc kèm
+    by_tenant = {}
+    for doc in docs:
+        by_tenant.setdefault(doc.get(TENANT_COLUMN) if TENANT_COLUMN else SEARCH_TENANT, []).append(doc)
+    for tenant, group in by_tenant.items():
+        for engine in tenants.loaded("local_search", tenant):
+            for doc in group:
+                if doc["id"] in engine.docs:
+                    engine.upsert_document(doc)
+        bump_kb_version(tenant)
+
+
+reindexer = Reindexer.from_env(
+    supabase, lambda texts: embed_batch(texts, "reindex"), ReindexQueue.from_env(),
+    SEARCH_TENANT, tenant_column=TENANT_COLUMN or None, on_saved=on_chunks_reindexed)
+
 @app.route('/api/update-chunk/<chunk_id>', methods=['PUT'])
 def update_chunk(chunk_id):
+    tenant = request_tenant()
     try:
         data = request.json
 
@@ -128,19 +569,27 @@ def update_chunk(chunk_id):
         if category == "thong_tin_phuong":
             normalized_text = normalize_text(text_content)
 
-        response = supabase.table("documents") \
-            .update({
-                "text_content": data.get("text_content"),
-                "normalized_text": normalized_text,
-                "category": data.get("category") or None,
-                "subject": data.get("subject") or None
-            }) \
-            .eq("id", chunk_id) \
-            .execute()
+        with crud_span("update_chunk", "supabase"):
+            response = supabase.table("documents") \
+                .update({
+                    "text_content": data.get("text_content"),
+                    "normalized_text": normalized_text,
+                    "category": data.get("category") or None,
+                    "subject": data.get("subject") or None
+                }) \
+                .eq("id", chunk_id) \
+                .execute()
         
         if not response.data:
             return jsonify({"error": "Chunk not found"}), 404
 
+        # Lưu lại y nguyên: index trong RAM và cache vẫn đúng, không cần cập nhật hay tăng phiên bản KB
+        if reindexer.queue.mark_saved(tenant, response.data[0]):
+            on_chunk_saved(response.data[0], tenant)
+        if REINDEX_ON_WRITE:
+            # Chỉ embedding lại khi text_content thực sự đổi
+            reindexer.enqueue(response.data[0])
+
         return jsonify({
             "message": "Chunk updated successfully",
             "data": response.data
@@ -154,27 +603,31 @@ def update_chunk(chunk_id):
 
 @app.route('/api/update-alias/<alias_id>', methods=['PUT'])
 def update_alias(alias_id):
+    tenant = request_tenant()
     try:
         data = request.json
 
-        alias_embedding = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=data.get("alias_text")
-        ).data[0].embedding
-
-        response = supabase.table("alias") \
-            .update({
-                "document_id": data.get("document_id") or None,
-                "alias_text": data.get("alias_text") or '',
-                "normalized_alias": normalize_text(data.get("alias_text")) or '',
-                "embedding": alias_embedding
-            }) \
-            .eq("id", alias_id) \
-            .execute()
+        with crud_span("update_alias", "embedding"):
+            alias_embedding = embed_text(data.get("alias_text"), exact=True)
+
+        updated_alias = {
+            "document_id": data.get("document_id") or None,
+            "alias_text": data.get("alias_text") or '',
+            "normalized_alias": normalize_text(data.get("alias_text")) or '',
+            "embedding": to_pgvector(alias_embedding)
+        }
+
+        with crud_span("update_alias", "supabase"):
+            response = supabase.table("alias") \
+                .update(updated_alias) \
+                .eq("id", alias_id) \
+                .execute()
         
         if not response.data:
             return jsonify({"error": "Alias not found"}), 404
 
+        on_alias_saved({**updated_alias, **response.data[0]}, tenant=tenant)
+
         return jsonify({
             "message": "Alias updated successfully",
             "data": response.data
@@ -185,8 +638,36 @@ def update_alias(alias_id):
             "error": str(e)
         }), 500
 
-from flask import Response
-import json
+# Nhật ký câu hỏi cho phân tích: ghi nền theo batch (xem query_log.py)
+query_log = QueryLog.from_env(supabase)
+
+# chat-stream: gửi câu trả lời tạm trước, rồi từng kết quả hybrid; giữ kết nối bằng
+# heartbeat trong lúc chờ OpenAI/RPC. Sự kiện mới có tên (event: partial/reply) nên
+# client cũ chỉ đọc "data:" vẫn nhận đúng sự kiện replies cuối cùng như trước.
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "5"))
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", "16"))
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+SSE_HEARTBEAT = ": keep-alive\n\n"
+
+_stream_pool = None
+_stream_pool_pid = None
+_stream_pool_lock = threading.Lock()
+
+
+def stream_pool():
+    # Tạo lười theo pid: thread không sống sót qua fork của gunicorn
+    global _stream_pool, _stream_pool_pid
+    with _stream_pool_lock:
+        if _stream_pool is None or _stream_pool_pid != os.getpid():
+            _stream_pool = ThreadPoolExecutor(STREAM_WORKERS, thread_name_prefix="chat-stream")
+            _stream_pool_pid = os.getpid()
+        return _stream_pool
+
+
+def sse(payload, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload, default=str)}\n\n"
+
 
 @app.route('/api/chat-stream', methods=['POST'])
 def chat_stream():
@@ -194,37 +675,57 @@ def chat_stream():
     # ✅ LẤY DATA TRƯỚC
     data = request.json
     user_message = data.get('message', '').strip()
+    tenant = request_tenant()
 
     def generate():
+        timings = metrics.start_timings()
 
         yield f"data: {json.dumps({'log': f'Nhận message...'})}\n\n"
 
-        q_format = normalize_text(user_message)
+        with span("normalize"):
+            q_format = normalize_text(user_message)
         yield f"data: {json.dumps({'log': f'Normalized: {q_format}'})}\n\n"
 
-        category, subject = classify(q_format)
+        with span("classify"):
+            category, subject = classify(q_format, tenants.matcher(tenant))
         yield f"data: {json.dumps({'log': f'Category: {category}, Subject: {subject}'})}\n\n"
 
-        query_embedding = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=user_message
-        ).data[0].embedding
-
-        response = supabase.rpc(
-            "search_documents_full_hybrid_v4",
-            {
-                "p_query_format": q_format,
-                "p_query_embedding": query_embedding,
-                "p_tenant": "xa_ba_diem",
-                "p_category": category,
-                "p_subject": subject,
-                "p_limit": 5
-            }
-        ).execute()
-
-        yield f"data: {json.dumps({'replies': response.data})}\n\n"
-
-    return Response(generate(), mimetype='text/event-stream')
+        replies, source, version = fast_answer(q_format, category, subject, tenant=tenant)
+        if replies is None:
+            key = flight_key(q_format, category, subject, 5, version, tenant)
+            future = search_flights.submit(
+                key, lambda cancelled: hybrid_answer(user_message, q_format, category, subject, 5, version,
+                                                     cancelled, tenant),
+                stream_pool())
+            try:
+                partial, partial_source = partial_answer(q_format, category, subject, tenant=tenant)
+                if partial:
+                    yield sse({"replies": partial, "source": partial_source}, "partial")
+                with span("hybrid"):
+                    while True:
+                        try:
+                            replies = future.result(timeout=STREAM_HEARTBEAT_SECONDS)
+                            break
+                        except FutureTimeoutError:
+                            # Ghi định kỳ cũng là cách phát hiện client đã ngắt
+                            yield SSE_HEARTBEAT
+            finally:
+                if not future.done():
+                    # Client ngắt (GeneratorExit): không chờ nữa, hủy nếu không còn ai chờ
+                    search_flights.release(key, future)
+            source = "hybrid"
+
+        for rank, reply in enumerate(replies):
+            yield sse({"rank": rank, "reply": reply, "source": source}, "reply")
+        yield f"data: {json.dumps({'replies': replies, 'source': source}, default=str)}\n\n"
+
+        timings.observe("chat_stream", category, subject, source)
+        metrics.log_event("chat", endpoint="chat_stream", q_format=q_format, category=category,
+                          subject=subject, source=source, timings_ms=timings.spans_ms())
+        query_log.put(query_record("chat_stream", tenant, user_message, q_format, category, subject,
+                                   replies, source, timings))
+
+    return Response(generate(), mimetype='text/event-stream', headers=STREAM_HEADERS)
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -235,47 +736,71 @@ def chat():
     """
     data = request.json
     user_message = data.get('message', '').strip()
+    tenant = request_tenant()
     
     if not user_message:
         return jsonify({"error": "Message cannot be empty"}), 400
 
-    q_format = normalize_text(user_message)
-    category, subject = classify(q_format)
-    print(f"Query: {q_format}\n=> Category: {category}, Subject: {subject}\n")
+    timings = metrics.start_timings()
+
+    with span("normalize"):
+        q_format = normalize_text(user_message)
+    with span("classify"):
+        category, subject = classify(q_format, tenants.matcher(tenant))
 
     log_data = f"""Query: {user_message}\n=> Category: {category}, Subject: {subject}"""
 
-    query_embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=user_message
-    ).data[0].embedding
+    replies, source = answer_query(user_message, q_format, category, subject, tenant=tenant)
 
-    response = supabase.rpc(
-        "search_documents_full_hybrid_v4",
-        {
-            "p_query_format": q_format,
-            "p_query_embedding": query_embedding,
-            "p_tenant": "xa_ba_diem",
-            "p_category": category,
-            "p_subject": subject,
-            "p_limit": 5
-        }
-    ).execute()
+    timings.observe("chat", category, subject, source)
+    metrics.log_event("chat", endpoint="chat", q_format=q_format, category=category,
+                      subject=subject, source=source, timings_ms=timings.spans_ms())
+    query_log.put(query_record("chat", tenant, user_message, q_format, category, subject,
+                               replies, source, timings))
 
     # Return all responses from knowledge base (you can add better matching logic here)
-    return jsonify({
-        "replies": response.data,
+    response = jsonify({
+        "replies": replies,
+        "source": source,
         "message": user_message,
         "log_data":log_data,
         "timestamp": datetime.now().isoformat()
     })
+    if metrics.server_timing_enabled(request.headers):
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
 
 
 
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()})
+    return jsonify({
+        "status": "ok",
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "result_cache": result_cache.stats(),
+        "search_flights": search_flights.stats(),
+        "reindex": reindexer.stats(),
+        "tenants": tenants.stats(),
+        "query_log": query_log.stats(),
+        "timestamp": datetime.now().isoformat()
+    })
+
+metrics.REGISTRY.add_stats("embedding_cache", embedding_cache.stats)
+metrics.REGISTRY.add_stats("embedding_batcher", embedding_batcher.stats)
+metrics.REGISTRY.add_stats("result_cache", result_cache.stats)
+metrics.REGISTRY.add_stats("search_flights", search_flights.stats)
+metrics.REGISTRY.add_stats("bulk_import", bulk_import_jobs.stats)
+metrics.REGISTRY.add_stats("reindex", reindexer.stats)
+metrics.REGISTRY.add_stats("tenants", tenants.stats)
+metrics.REGISTRY.add_stats("query_log", query_log.stats)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text format"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
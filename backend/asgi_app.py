@@ -0,0 +1,277 @@
+"""
+Chế độ phục vụ async (ASGI) cho /api/chat và /api/chat-stream.
+
+    uvicorn asgi_app:application --workers 2
+
+Hai route chat chạy trên Quart với AsyncOpenAI và Supabase async client, nên một
+process giữ được hàng trăm request đang chờ OpenAI/Supabase. Mọi route khác
+(CRUD, health, preflight CORS) được chuyển nguyên cho Flask app trong app.py.
+Cache, alias index và search engine dùng chung với app.py; mọi bước chặn (stat file
+phiên bản KB, nạp index, chấm điểm LocalSearchEngine, SQLite) chạy trong thread.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from datetime import datetime
+
+from asgiref.wsgi import WsgiToAsgi
+from openai import AsyncOpenAI
+from quart import Quart, Response, jsonify, request
+from supabase import acreate_client
+
+import app as core
+import corn
+import metrics
+from metrics import span
+from query_log import query_record
+from embedding_cache import EMBEDDING_MODEL
+from tenants import TENANT_HEADER, UnknownTenant, split_tenant_path
+from utils import classify, normalize_text
+
+quart_app = Quart(__name__)
+
+aclient = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY")
+)
+
+_asupabase = None
+
+
+async def get_async_supabase():
+    # Các request đầu tiên đến cùng lúc chờ chung một lần tạo client, không mỗi request tạo một
+    global _asupabase
+    if _asupabase is None:
+        _asupabase = asyncio.ensure_future(acreate_client(corn.SUPABASE_URL, corn.SUPABASE_KEY))
+    creating = _asupabase
+    try:
+        return await asyncio.shield(creating)
+    except Exception:
+        # Tạo lỗi: request sau thử lại
+        if _asupabase is creating:
+            _asupabase = None
+        raise
+
+
+def run_sync(fn, *args):
+    """
+    Chạy hàm chặn (Supabase, SQLite, file) trong thread pool mặc định, giữ contextvars
+    (RequestTimings) như asyncio.to_thread — hàm này chỉ có từ Python 3.9.
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, fn, *args))
+
+
+@quart_app.before_serving
+async def warm_up():
+    # Nạp index của các tenant "warm" trong thread để không chặn event loop ở request đầu tiên
+    await run_sync(core.warm_up_indexes)
+
+
+@quart_app.after_serving
+async def flush_query_log():
+    # Ghi nốt query log còn trong queue trước khi worker dừng
+    await run_sync(core.query_log.close)
+
+
+@quart_app.errorhandler(UnknownTenant)
+async def unknown_tenant(e):
+    return jsonify({"error": f"Unknown tenant: {e}"}), 404
+
+
+def request_tenant():
+    return core.tenants.resolve(request.headers.get(TENANT_HEADER))
+
+
+@quart_app.after_request
+async def add_cors_headers(response):
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    return response
+
+
+async def embed_async(text):
+    # Tầng RAM tra ngay trên loop; tầng SQLite (đọc/ghi đĩa) chạy trong thread
+    embedding = core.embedding_cache.get_memory(EMBEDDING_MODEL, text)
+    if embedding is not None:
+        return embedding
+    embedding = await run_sync(core.embedding_cache.get, EMBEDDING_MODEL, text)
+    if embedding is None:
+        if core.EMBEDDING_BATCHING:
+            # Batcher chạy trên thread riêng, dùng chung với các route Flask
+            embedding = await asyncio.wrap_future(core.embedding_batcher.submit(text))
+        else:
+            response = await aclient.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text
+            )
+            embedding = response.data[0].embedding
+        await run_sync(core.embedding_cache.set, EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+async def search_documents_async(q_format, query_embedding, category, subject, limit=5, tenant=core.SEARCH_TENANT):
+    if core.SEARCH_BACKEND == "local" and core.has_local_indexes(tenant):
+        # Nạp engine (lần đầu) và chấm điểm cả ma trận đều tốn CPU: chạy trong thread
+        return await run_sync(core.search_documents, q_format, query_embedding, category, subject, limit, tenant)
+
+    supabase = await get_async_supabase()
+    response = await supabase.rpc(
+        "search_documents_full_hybrid_v4",
+        {
+            "p_query_format": q_format,
+            "p_query_embedding": query_embedding,
+            "p_tenant": tenant,
+            "p_category": category,
+            "p_subject": subject,
+            "p_limit": limit
+        }
+    ).execute()
+    return response.data
+
+
+async def fast_answer_async(q_format, category, subject, limit=5, tenant=core.SEARCH_TENANT):
+    # sync_indexes (stat file phiên bản KB), tra result cache và alias index (có thể phải
+    # nạp từ Supabase) đều chặn: chạy trong thread
+    return await run_sync(core.fast_answer, q_format, category, subject, limit, tenant)
+
+
+async def partial_answer_async(q_format, category, subject, limit=5, tenant=core.SEARCH_TENANT):
+    return await run_sync(core.partial_answer, q_format, category, subject, limit, tenant)
+
+
+async def hybrid_answer_async(user_message, q_format, category, subject, version, limit=5,
+                              tenant=core.SEARCH_TENANT):
+    async def hybrid_search():
+        # Chỉ request dẫn đầu gọi embedding; các request trùng câu hỏi chờ kết quả chung
+        with span("embedding"):
+            query_embedding = await embed_async(user_message)
+        with span("search"):
+            replies = await search_documents_async(q_format, query_embedding, category, subject, limit, tenant)
+        core.remember_answer(q_format, category, subject, limit, replies, version, tenant)
+        return replies
+
+    key = core.flight_key(q_format, category, subject, limit, version, tenant)
+    with span("hybrid"):
+        return await core.search_flights.do_async(key, hybrid_search)
+
+
+async def answer_query_async(user_message, q_format, category, subject, limit=5, tenant=core.SEARCH_TENANT):
+    # Tra result cache / alias trước: câu trả lời có sẵn thì không tốn một lần gọi embedding
+    replies, source, version = await fast_answer_async(q_format, category, subject, limit, tenant)
+    if replies is not None:
+        return replies, source
+
+    replies = await hybrid_answer_async(user_message, q_format, category, subject, version, limit, tenant)
+    return replies, "hybrid"
+
+
+@quart_app.route('/api/chat-stream', methods=['POST'])
+async def chat_stream():
+    data = await request.get_json()
+    user_message = data.get('message', '').strip()
+    tenant = request_tenant()
+
+    async def generate():
+        timings = metrics.start_timings()
+
+        yield f"data: {json.dumps({'log': f'Nhận message...'})}\n\n"
+
+        with span("normalize"):
+            q_format = normalize_text(user_message)
+        yield f"data: {json.dumps({'log': f'Normalized: {q_format}'})}\n\n"
+
+        with span("classify"):
+            category, subject = classify(q_format, core.tenants.matcher(tenant))
+        yield f"data: {json.dumps({'log': f'Category: {category}, Subject: {subject}'})}\n\n"
+
+        replies, source, version = await fast_answer_async(q_format, category, subject, tenant=tenant)
+        if replies is None:
+            # Embedding + search chạy song song với câu trả lời tạm
+            search = asyncio.create_task(
+                hybrid_answer_async(user_message, q_format, category, subject, version, tenant=tenant))
+            try:
+                partial, partial_source = await partial_answer_async(q_format, category, subject, tenant=tenant)
+                if partial:
+                    yield core.sse({"replies": partial, "source": partial_source}, "partial")
+                while True:
+                    done, _ = await asyncio.wait({search}, timeout=core.STREAM_HEARTBEAT_SECONDS)
+                    if done:
+                        break
+                    yield core.SSE_HEARTBEAT
+                replies = search.result()
+            finally:
+                # Client ngắt: Quart hủy generator, hủy luôn phần tìm kiếm của request này
+                if not search.done():
+                    search.cancel()
+            source = "hybrid"
+
+        for rank, reply in enumerate(replies):
+            yield core.sse({"rank": rank, "reply": reply, "source": source}, "reply")
+        yield f"data: {json.dumps({'replies': replies, 'source': source}, default=str)}\n\n"
+
+        timings.observe("chat_stream", category, subject, source)
+        metrics.log_event("chat", endpoint="chat_stream", q_format=q_format, category=category,
+                          subject=subject, source=source, timings_ms=timings.spans_ms())
+        core.query_log.put(query_record("chat_stream", tenant, user_message, q_format, category, subject,
+                                        replies, source, timings), block=0)
+
+    return Response(generate(), mimetype='text/event-stream', headers=core.STREAM_HEADERS)
+
+
+@quart_app.route('/api/chat', methods=['POST'])
+async def chat():
+    data = await request.get_json()
+    user_message = data.get('message', '').strip()
+    tenant = request_tenant()
+
+    if not user_message:
+        return jsonify({"error": "Message cannot be empty"}), 400
+
+    timings = metrics.start_timings()
+
+    with span("normalize"):
+        q_format = normalize_text(user_message)
+    with span("classify"):
+        category, subject = classify(q_format, core.tenants.matcher(tenant))
+
+    log_data = f"""Query: {user_message}\n=> Category: {category}, Subject: {subject}"""
+
+    replies, source = await answer_query_async(user_message, q_format, category, subject, tenant=tenant)
+
+    timings.observe("chat", category, subject, source)
+    metrics.log_event("chat", endpoint="chat", q_format=q_format, category=category,
+                      subject=subject, source=source, timings_ms=timings.spans_ms())
+    core.query_log.put(query_record("chat", tenant, user_message, q_format, category, subject,
+                                    replies, source, timings), block=0)
+
+    response = jsonify({
+        "replies": replies,
+        "source": source,
+        "message": user_message,
+        "log_data": log_data,
+        "timestamp": datetime.now().isoformat()
+    })
+    if metrics.server_timing_enabled(request.headers):
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+
+ASYNC_ROUTES = {"/api/chat", "/api/chat-stream"}
+flask_fallback = WsgiToAsgi(core.app)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        # /t/<tenant>/api/... -> /api/... kèm header X-Tenant, như TenantPathMiddleware của Flask
+        tenant, path = split_tenant_path(scope["path"])
+        if tenant is not None:
+            scope = dict(scope, path=path, raw_path=path.encode(),
+                         headers=[*scope["headers"], (TENANT_HEADER.lower().encode(), tenant.encode())])
+    if scope["type"] == "lifespan" or (
+            scope["type"] == "http"
+            and scope["path"] in ASYNC_ROUTES
+            and scope["method"] != "OPTIONS"):
+        await quart_app(scope, receive, send)
+    else:
+        await flask_fallback(scope, receive, send)
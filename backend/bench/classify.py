@@ -0,0 +1,64 @@
+# Micro-benchmark cho utils.classify: chi phí mỗi câu hỏi khi bảng từ khóa tăng lên
+# Chạy: cd backend && python -m bench.classify
+import random
+import time
+
+from utils import KeywordMatcher, KEYWORD_MATCHER, KEYWORD_TABLES, classify, normalize_many
+
+from .corpus import QUERIES as RAW_QUERIES
+
+QUERIES = normalize_many(RAW_QUERIES)
+
+
+SYLLABLES = ["an", "binh", "cong", "dan", "giang", "hoa", "khanh", "long",
+             "minh", "nam", "phu", "quang", "son", "tan", "uyen", "vinh"]
+
+
+def synthetic_tables(size: int) -> dict:
+    rnd = random.Random(size)
+    tables = {cat: list(kws) for cat, kws in _base_tables().items()}
+    cats = list(tables)
+    for i in range(size):
+        kw = " ".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+        tables[cats[i % len(cats)]].append(f"{kw} {i}")
+    return tables
+
+
+def _base_tables() -> dict:
+    return {cat: list(kws) for cat, kws in KEYWORD_TABLES.items()}
+
+
+def naive_scores(tables: dict, q: str) -> dict:
+    return {cat: sum(1 for kw in kws if kw in q) for cat, kws in tables.items()}
+
+
+def per_query_us(fn, rounds: int = 2000) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for q in QUERIES:
+            fn(q)
+    return (time.perf_counter() - start) / (rounds * len(QUERIES)) * 1e6
+
+
+def run() -> list:
+    base = _base_tables()
+    rows = [{
+        "keywords": sum(len(v) for v in base.values()),
+        "trie_us": per_query_us(lambda q: classify(q, KEYWORD_MATCHER)),
+        "naive_us": per_query_us(lambda q: naive_scores(base, q), 500),
+    }]
+    for size in (1_000, 5_000, 20_000):
+        tables = synthetic_tables(size)
+        matcher = KeywordMatcher(tables)
+        rows.append({
+            "keywords": sum(len(v) for v in tables.values()),
+            "trie_us": per_query_us(lambda q: classify(q, matcher)),
+            "naive_us": per_query_us(lambda q: naive_scores(tables, q), 50),
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    print(f"{'keywords':>10} {'trie us/q':>12} {'naive us/q':>12}")
+    for row in run():
+        print(f"{row['keywords']:>10} {row['trie_us']:>12.2f} {row['naive_us']:>12.2f}")
@@ -0,0 +1,50 @@
+# Bộ câu hỏi mẫu của người dân, dùng chung cho các benchmark
+import json
+
+QUERIES = [
+    "Thủ tục đăng ký khai sinh cần những giấy tờ gì?",
+    "đăng ký khai sinh cho con ở đâu",
+    "làm giấy khai tử cho người nhà",
+    "đăng ký kết hôn mất bao lâu",
+    "chứng thực bản sao lệ phí bao nhiêu",
+    "nộp hồ sơ trực tuyến như thế nào",
+    "cấp giấy xác nhận tình trạng hôn nhân",
+    "Giờ làm việc của UBND phường",
+    "lịch làm việc thứ 7",
+    "chủ nhật có làm việc không",
+    "phường làm việc mấy giờ",
+    "Chủ tịch UBND phường là ai?",
+    "phó chủ tịch hđnd phường",
+    "bí thư đảng ủy phường là ai",
+    "bí thư đoàn phường",
+    "khu phố 3 ở đâu",
+    "phường có bao nhiêu khu phố",
+    "danh sách khu phố",
+    "số điện thoại đường dây nóng",
+    "email của ủy ban",
+    "fanpage zalo của phường",
+    "địa chỉ ủy ban nhân dân phường",
+    "cán bộ phụ trách tư pháp",
+    "công chức địa chính",
+    "diện tích và dân số của phường",
+    "xã Bà Điểm thành lập năm nào",
+    "phường nằm ở đâu",
+    "tôi muốn hỏi về công nhân",
+    "xin chào",
+    "cảm ơn",
+]
+
+
+def load_queries(path: str) -> list:
+    """Câu hỏi để phát lại: file JSONL của query log (trường "query") hoặc mỗi dòng một câu."""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = (json.loads(line).get("query") or "").strip()
+            if line:
+                queries.append(line)
+    return queries
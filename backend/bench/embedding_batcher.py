@@ -0,0 +1,75 @@
+# Kiểm tra và đo EmbeddingBatcher với server embeddings giả lập
+# Chạy: cd backend && python -m bench.embedding_batcher
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import OpenAI
+
+from embedding_batcher import EmbeddingBatcher
+
+from .corpus import QUERIES
+from .fake_upstreams import FakeUpstreams, fake_embedding, serve
+
+
+def run(callers: int = 64, latency: float = 0.2, window: float = 0.005, max_batch: int = 16) -> dict:
+    upstreams = FakeUpstreams(embed_latency=latency, dim=32, max_input_chars=200)
+    server = serve(upstreams)
+    client = OpenAI(api_key="fake", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", max_retries=0)
+    batcher = EmbeddingBatcher(client, window=window, max_batch=max_batch)
+
+    texts = [QUERIES[i % len(QUERIES)] + f" {i}" for i in range(callers)]
+    texts[7] = "x" * 500          # server từ chối: chỉ caller này được nhận lỗi
+
+    def call(text):
+        try:
+            return batcher.embed(text)
+        except Exception as e:
+            return e
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(callers) as pool:
+        results = list(pool.map(call, texts))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    for i, (text, result) in enumerate(zip(texts, results)):
+        if i == 7:
+            assert isinstance(result, Exception), "invalid input must fail"
+        else:
+            assert result == fake_embedding(text, 32), f"caller {i} got a wrong vector"
+
+    return {
+        "callers": callers,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "upstream": upstreams.stats(),
+        "batcher": batcher.stats(),
+        "outage": check_outage(callers, window, max_batch),
+    }
+
+
+def check_outage(callers: int, window: float, max_batch: int) -> dict:
+    # OpenAI trả 429: mọi caller nhận lỗi, mỗi batch chỉ một request (không gửi lại từng text)
+    upstreams = FakeUpstreams(dim=32)
+    upstreams.embed_status = 429
+    server = serve(upstreams)
+    client = OpenAI(api_key="fake", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", max_retries=0)
+    batcher = EmbeddingBatcher(client, window=window, max_batch=max_batch)
+
+    def call(i):
+        try:
+            return batcher.embed(f"{QUERIES[i % len(QUERIES)]} {i}")
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(callers) as pool:
+        results = list(pool.map(call, range(callers)))
+    server.shutdown()
+
+    assert all(isinstance(result, Exception) for result in results), "outage must fail every caller"
+    stats = batcher.stats()
+    assert upstreams.embedding_calls == stats["batches"], (upstreams.embedding_calls, stats["batches"])
+    return {"embedding_calls": upstreams.embedding_calls, "batches": stats["batches"], "errors": stats["errors"]}
+
+
+if __name__ == "__main__":
+    print(run())
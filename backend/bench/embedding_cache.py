@@ -0,0 +1,108 @@
+# Kiểm tra EmbeddingCache qua các endpoint Flask, OpenAI/Supabase là server giả lập:
+# - lưu lại alias cùng nội dung không gọi embedding lần nữa (tra exact=True trúng cache)
+# - vector ghi xuống Supabase là float32, kể cả khi cache dùng float16
+# Và tầng SQLite trực tiếp:
+# - ghi nhiều hơn giới hạn số dòng / số byte thì file được dọn, vector vừa đọc được giữ lại
+# - file của bản trước (schema 2, không có accessed_at) được chuyển đổi và vẫn đọc được
+#
+#   cd backend && python -m bench.embedding_cache
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from embedding_cache import SCHEMA_VERSION, EmbeddingCache
+from embedding_codec import to_bytes
+from search_engine import parse_embedding
+
+from .fake_upstreams import FakeUpstreams, fake_embedding, start_backend
+
+
+def run(saves: int = 3) -> dict:
+    upstreams = FakeUpstreams()
+    core, url = start_backend(upstreams, EMBEDDING_CACHE_CODEC="float16", REINDEX_ON_WRITE=0)
+    text = "xin cấp lại giấy khai sinh bản sao"
+
+    with httpx.Client(base_url=url, timeout=30) as client:
+        created = client.post("/api/create-alias", json={"document_id": 1, "alias_text": text})
+        created.raise_for_status()
+        alias_id = created.json()["data"][0]["id"]
+        for _ in range(saves):
+            client.put(f"/api/update-alias/{alias_id}",
+                       json={"document_id": 1, "alias_text": text}).raise_for_status()
+        # Câu hỏi cùng nội dung dùng lại vector đã có
+        client.post("/api/chat", json={"message": text}).raise_for_status()
+
+    stats = core.embedding_cache.stats()
+    calls = upstreams.stats()["embedding_calls"]
+    assert calls == 1, f"re-saving an unchanged alias must not re-embed ({calls} embedding calls)"
+    assert stats["memory_hits"] + stats["disk_hits"] >= saves, stats
+
+    stored = next(row for row in upstreams.tables["alias"] if row["id"] == alias_id)
+    assert np.array_equal(parse_embedding(stored["embedding"]),
+                          np.asarray(fake_embedding(text, upstreams.dim), dtype=np.float32))
+    return {"saves": saves + 1, "embedding_calls": calls, "cache": stats}
+
+
+def disk_rows(path: str) -> tuple:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+
+
+def run_disk_bound(max_rows: int, max_mb: float, writes: int = 3000, dim: int = 256) -> dict:
+    rng = np.random.default_rng(0)
+    path = os.path.join(tempfile.mkdtemp(), "embedding_cache.sqlite3")
+    # Tầng RAM nhỏ để các lần đọc đi xuống SQLite; prune_interval=0: kiểm tra sau mỗi lần ghi
+    cache = EmbeddingCache(path, max_items=10, disk_max_rows=max_rows, disk_max_bytes=int(max_mb * 2 ** 20),
+                           prune_interval=0)
+    hot = [f"câu hỏi nóng {i}" for i in range(20)]
+    for text in hot:
+        cache.set("m", text, rng.standard_normal(dim))
+    started = time.perf_counter()
+    for i in range(writes):
+        cache.set("m", f"câu hỏi {i}", rng.standard_normal(dim))
+        if i % 50 == 0:
+            # Đọc lại các câu nóng: accessed_at mới, không bị dọn
+            for text in hot:
+                assert cache.get("m", text) is not None, text
+    elapsed = time.perf_counter() - started
+
+    rows, size = disk_rows(path)
+    stats = cache.stats()
+    assert (not max_rows or rows <= max_rows) and (not max_mb or size <= max_mb * 2 ** 20), (rows, size)
+    assert cache.get("m", "câu hỏi 0") is None, "oldest untouched row should be pruned"
+    assert all(cache.get("m", text) is not None for text in hot)
+    assert cache.get("m", f"câu hỏi {writes - 1}") is not None
+    assert stats["prune_errors"] == 0, stats
+    return {"writes": writes + len(hot), "disk_rows": rows, "disk_mb": round(size / 2 ** 20, 3),
+            "max_rows": max_rows, "max_mb": max_mb, "pruned": stats["disk_pruned"],
+            "us_per_write": round(elapsed / writes * 1e6, 1)}
+
+
+def run_migration(dim: int = 256) -> dict:
+    # File bản trước: không có accessed_at, user_version 2
+    legacy = os.path.join(tempfile.mkdtemp(), "legacy.sqlite3")
+    with sqlite3.connect(legacy) as conn:
+        conn.execute("CREATE TABLE embeddings (model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL,"
+                     " created_at REAL NOT NULL, PRIMARY KEY (model, key))")
+        conn.execute("INSERT INTO embeddings VALUES ('m', 'cu', ?, ?)",
+                     (to_bytes(np.ones(dim), "float32"), time.time()))
+        conn.execute("PRAGMA user_version = 2")
+    migrated = EmbeddingCache(legacy, max_items=10)
+    assert migrated.get("m", "cu") == [1.0] * dim
+    with sqlite3.connect(legacy) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    return {"from_version": 2, "to_version": SCHEMA_VERSION}
+
+
+if __name__ == "__main__":
+    print(json.dumps({
+        "endpoints": run(),
+        "disk_max_rows": run_disk_bound(max_rows=1000, max_mb=0),
+        "disk_max_bytes": run_disk_bound(max_rows=0, max_mb=0.25),
+        "migration": run_migration(),
+    }, indent=2, ensure_ascii=False))
@@ -0,0 +1,112 @@
+# Báo cáo độ chính xác và mức tiết kiệm của embedding_codec:
+# top-5 của tìm kiếm hybrid (kiểu search_documents_full_hybrid_v4, dùng LocalSearchEngine)
+# trước/sau lượng tử hóa, bộ nhớ ma trận và kích thước payload mỗi vector.
+#
+# Dữ liệu thật (file ghi bởi bench.search_parity --record):
+#   cd backend && python -m bench.embedding_codec --data bench/fixtures/rpc_recorded.json
+# Không có thì dùng dữ liệu tổng hợp dạng cụm:
+#   cd backend && python -m bench.embedding_codec [--docs 5000]
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from embedding_codec import CODECS, dequantize, encode, quantize, to_pgvector
+from search_engine import LocalSearchEngine, parse_embedding
+
+from .snapshot import make_rows
+
+LIMIT = 5
+
+
+def synthetic(n_docs: int, dim: int = 1536, topics: int = 200, seed: int = 0):
+    # Vector dạng cụm: document cùng chủ đề gần nhau, câu hỏi gần một document
+    rng = np.random.default_rng(seed)
+    documents, aliases = make_rows(n_docs, dim=8, seed=seed)
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    for row in (*documents, *aliases):
+        topic = centers[(row["id"] * 7919) % topics]
+        row["embedding"] = (topic + 0.9 * rng.standard_normal(dim)).astype(np.float32).tolist()
+    cases = []
+    for i in rng.choice(len(documents), 100, replace=False):
+        doc = documents[i]
+        vector = np.asarray(doc["embedding"], dtype=np.float32) + 1.2 * rng.standard_normal(dim).astype(np.float32)
+        words = doc["normalized_text"].split()
+        cases.append({"q_format": " ".join(words[:4]), "embedding": vector.tolist(),
+                      "category": None, "subject": None})
+    return documents, aliases, cases
+
+
+def top_ids(engine, cases, quantize_query=None) -> list:
+    results = []
+    for case in cases:
+        query = case["embedding"]
+        if quantize_query:
+            query = dequantize(*quantize(query, quantize_query))
+        results.append([r["id"] for r in engine.search(
+            case["q_format"], query, case["category"], case["subject"], LIMIT)])
+    return results
+
+
+def agreement(expected: list, got: list) -> dict:
+    top1 = np.mean([a[:1] == b[:1] for a, b in zip(expected, got)])
+    top5 = np.mean([len(set(a) & set(b)) / len(a) if a else float(not b) for a, b in zip(expected, got)])
+    return {"top1": round(float(top1), 4), f"top{LIMIT}": round(float(top5), 4)}
+
+
+def python_list_bytes(values: list) -> int:
+    return sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+
+
+def payloads(vector) -> dict:
+    # Vector như OpenAI client trả về: list float Python
+    values = [float(x) for x in np.asarray(vector, dtype=np.float32)]
+    return {
+        "json_list": len(json.dumps(values)),
+        "pgvector_text": len(to_pgvector(values)),
+        **{f"base64_{codec}": len(encode(values, codec)) for codec in CODECS},
+        "python_list_memory": python_list_bytes(values),
+    }
+
+
+def run(data: str = None, n_docs: int = 5000) -> dict:
+    if data:
+        with open(data, encoding="utf-8") as f:
+            recorded = json.load(f)
+        documents, aliases, cases = recorded["documents"], recorded["alias"], recorded["cases"]
+    else:
+        documents, aliases, cases = synthetic(n_docs)
+    dim = len(parse_embedding(cases[0]["embedding"]))
+
+    report = {"source": data or "synthetic", "documents": len(documents), "aliases": len(aliases),
+              "queries": len(cases), "dim": dim}
+
+    baseline = LocalSearchEngine(dim)
+    baseline.load(documents, aliases)
+    expected = top_ids(baseline, cases)
+
+    for codec in CODECS:
+        engine = LocalSearchEngine(dim, codec)
+        engine.load(documents, aliases)
+        matrix_bytes = engine._matrix[:engine._n_rows].nbytes
+        if engine._scales is not None:
+            matrix_bytes += engine._scales[:engine._n_rows].nbytes
+        report[codec] = {
+            "matrix_bytes": matrix_bytes,
+            # Chỉ lượng tử hóa phía documents
+            "agreement": agreement(expected, top_ids(engine, cases)),
+            # Cả vector câu hỏi cũng qua codec (như khi lấy từ EmbeddingCache)
+            "agreement_quantized_query": agreement(expected, top_ids(engine, cases, codec)),
+        }
+
+    report["payload_bytes_per_vector"] = payloads(cases[0]["embedding"])
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", help="file ghi bởi bench.search_parity --record")
+    parser.add_argument("--docs", type=int, default=5000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.data, args.docs), indent=2))
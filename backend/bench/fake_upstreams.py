@@ -0,0 +1,350 @@
+# Server giả lập OpenAI embeddings và Supabase (PostgREST) để đo tải offline
+#
+#   cd backend && python -m bench.fake_upstreams --port 8900 --embed-latency-ms 300 --rpc-latency-ms 150
+#
+# Sau đó chạy backend với:
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 SUPABASE_URL=http://127.0.0.1:8900 SUPABASE_KEY=fake
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+EMBEDDING_DIM = 1536
+
+DOCUMENTS = [
+    {"id": 1, "procedure_name": "Đăng ký khai sinh", "text_content": "Thủ tục đăng ký khai sinh tại UBND phường.",
+     "category": "thu_tuc_hanh_chinh", "subject": "tu_phap_ho_tich", "is_active": True, "effective_date": None},
+    {"id": 2, "procedure_name": "Đăng ký kết hôn", "text_content": "Thủ tục đăng ký kết hôn trong nước.",
+     "category": "thu_tuc_hanh_chinh", "subject": "tu_phap_ho_tich", "is_active": True, "effective_date": None},
+    {"id": 3, "procedure_name": None, "text_content": "UBND phường làm việc từ thứ 2 đến thứ 6, sáng thứ 7.",
+     "category": "thong_tin_phuong", "subject": "lich_lam_viec", "is_active": True, "effective_date": None},
+    {"id": 4, "procedure_name": None, "text_content": "Chủ tịch UBND phường phụ trách chung.",
+     "category": "thong_tin_phuong", "subject": "lanh_dao", "is_active": True, "effective_date": None},
+]
+
+
+def _compare_key(value):
+    # id trong query string là chuỗi; so sánh như số nếu được
+    try:
+        return (0, float(value), "")
+    except (TypeError, ValueError):
+        return (1, 0.0, str(value))
+
+
+def _equal(current, value: str) -> bool:
+    if isinstance(current, bool):
+        return str(current).lower() == value
+    return _compare_key(current) == _compare_key(value)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list:
+    # Vector tất định theo nội dung, cùng text luôn ra cùng vector
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    rnd = random.Random(seed)
+    return [rnd.uniform(-1, 1) for _ in range(dim)]
+
+
+class FakeUpstreams:
+
+    def __init__(self, embed_latency: float = 0.0, rpc_latency: float = 0.0,
+                 table_latency: float = 0.0, dim: int = EMBEDDING_DIM, max_input_chars: int = 8000):
+        self.embed_latency = embed_latency
+        self.max_input_chars = max_input_chars
+        # Đặt thành 429/503... để giả lập OpenAI quá tải
+        self.embed_status = 200
+        self.rpc_latency = rpc_latency
+        self.table_latency = table_latency
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.embedding_calls = 0
+        self.embedding_inputs = 0
+        self.rpc_calls = 0
+        self.tables = {
+            "documents": [dict(d, normalized_text=None, embedding=fake_embedding(d["text_content"], dim))
+                          for d in DOCUMENTS],
+            "alias": [],
+        }
+
+    def embeddings(self, body: dict):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        with self.lock:
+            self.embedding_calls += 1
+            self.embedding_inputs += len(inputs)
+        time.sleep(self.embed_latency)
+        if self.embed_status != 200:
+            return self.embed_status, {"error": {"message": "simulated outage", "type": "server_error"}}
+        # Giống OpenAI: một input không hợp lệ làm hỏng cả request
+        if any(not text or len(text) > self.max_input_chars for text in inputs):
+            return 400, {"error": {"message": "invalid input", "type": "invalid_request_error"}}
+        return 200, {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, self.dim)}
+                     for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    def rpc(self, name: str, body: dict) -> list:
+        with self.lock:
+            self.rpc_calls += 1
+        time.sleep(self.rpc_latency)
+        rows = [d for d in self.tables["documents"]
+                if (not body.get("p_category") or d["category"] == body["p_category"])
+                and (not body.get("p_subject") or d["subject"] == body["p_subject"])
+                and d.get("tenant", body.get("p_tenant")) == body.get("p_tenant")]
+        return [dict({k: v for k, v in d.items() if k != "embedding"}, score=0.5)
+                for d in rows[:body.get("p_limit") or 5]]
+
+    # --- PostgREST tối giản: đủ cho các query mà backend dùng ---
+
+    def _matches(self, row: dict, filters: list) -> bool:
+        for column, expr in filters:
+            op, _, value = expr.partition(".")
+            current = row.get(column)
+            if op == "eq" and not _equal(current, value):
+                return False
+            if op == "gt" and not (current is not None and _compare_key(current) > _compare_key(value)):
+                return False
+            if op == "in" and not any(_equal(current, v) for v in value.strip("()").split(",")):
+                return False
+            if op == "is" and value == "null" and current is not None:
+                return False
+        return True
+
+    def select(self, table: str, params: list = ()) -> list:
+        time.sleep(self.table_latency)
+        params = list(params)
+        options = {k: v for k, v in params if k in ("select", "order", "limit", "offset", "on_conflict")}
+        filters = [(k, v) for k, v in params if k not in options]
+        with self.lock:
+            rows = [dict(row) for row in self.tables.get(table, []) if self._matches(row, filters)]
+        if options.get("order"):
+            column, _, direction = options["order"].partition(".")
+            rows.sort(key=lambda row: _compare_key(row.get(column)), reverse=direction.startswith("desc"))
+        offset = int(options.get("offset") or 0)
+        rows = rows[offset:offset + int(options["limit"])] if options.get("limit") else rows[offset:]
+        columns = [c.strip() for c in (options.get("select") or "*").split(",")]
+        if "*" not in columns:
+            rows = [{c: row.get(c) for c in columns} for row in rows]
+        return rows
+
+    def insert(self, table: str, body, upsert: bool = False) -> list:
+        time.sleep(self.table_latency)
+        saved = []
+        with self.lock:
+            rows = self.tables.setdefault(table, [])
+            by_id = {row.get("id"): row for row in rows}
+            for item in body if isinstance(body, list) else [body]:
+                existing = by_id.get(item.get("id")) if "id" in item else None
+                if existing is not None:
+                    if not upsert:
+                        return None
+                    existing.update(item)
+                    saved.append(dict(existing))
+                    continue
+                row = dict(item)
+                row.setdefault("id", max((r.get("id") or 0 for r in rows), default=0) + 1)
+                rows.append(row)
+                by_id[row["id"]] = row
+                saved.append(dict(row))
+        return saved
+
+    def update(self, table: str, params: list, body: dict) -> list:
+        time.sleep(self.table_latency)
+        filters = [(k, v) for k, v in params if k not in ("select", "order", "limit")]
+        with self.lock:
+            rows = [row for row in self.tables.get(table, []) if self._matches(row, filters)]
+            for row in rows:
+                row.update(body)
+            return [dict(row) for row in rows]
+
+    def delete(self, table: str, params: list) -> list:
+        time.sleep(self.table_latency)
+        filters = [(k, v) for k, v in params if k not in ("select", "order", "limit")]
+        with self.lock:
+            rows = self.tables.get(table, [])
+            removed = [row for row in rows if self._matches(row, filters)]
+            self.tables[table] = [row for row in rows if row not in removed]
+            return removed
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"embedding_calls": self.embedding_calls, "embedding_inputs": self.embedding_inputs,
+                    "rpc_calls": self.rpc_calls}
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_handler(upstreams: FakeUpstreams):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, payload) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _split(self):
+            path, _, query = self.path.partition("?")
+            return path, parse_qsl(query, keep_blank_values=True)
+
+        def _send_rows(self, status: int, rows: list) -> None:
+            if "return=minimal" in (self.headers.get("Prefer") or ""):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self._send(status, rows)
+
+        def do_POST(self):
+            path, params = self._split()
+            if path.endswith("/embeddings"):
+                self._send(*upstreams.embeddings(self._body()))
+            elif path.startswith("/rest/v1/rpc/"):
+                self._send(200, upstreams.rpc(path.rsplit("/", 1)[1], self._body()))
+            elif path.startswith("/rest/v1/"):
+                upsert = "resolution=merge-duplicates" in (self.headers.get("Prefer") or "")
+                rows = upstreams.insert(path.rsplit("/", 1)[1], self._body(), upsert)
+                if rows is None:
+                    self._send(409, {"code": "23505", "message": "duplicate key value violates unique constraint"})
+                else:
+                    self._send_rows(201, rows)
+            else:
+                self._send(404, {"message": "not found"})
+
+        def do_GET(self):
+            path, params = self._split()
+            if path == "/stats":
+                self._send(200, upstreams.stats())
+            elif path.startswith("/rest/v1/"):
+                self._send(200, upstreams.select(path.rsplit("/", 1)[1], params))
+            else:
+                self._send(404, {"message": "not found"})
+
+        def do_PATCH(self):
+            path, params = self._split()
+            if path.startswith("/rest/v1/"):
+                self._send_rows(200, upstreams.update(path.rsplit("/", 1)[1], params, self._body()))
+            else:
+                self._send(404, {"message": "not found"})
+
+        def do_DELETE(self):
+            path, params = self._split()
+            # postgrest-py gửi kèm body "{}"; phải đọc hết để không lẫn vào request kế tiếp (keep-alive)
+            self._body()
+            if path.startswith("/rest/v1/"):
+                self._send_rows(200, upstreams.delete(path.rsplit("/", 1)[1], params))
+            else:
+                self._send(404, {"message": "not found"})
+
+    return Handler
+
+
+def serve(upstreams: FakeUpstreams, host: str = "127.0.0.1", port: int = 0) -> FakeServer:
+    server = FakeServer((host, port), make_handler(upstreams))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _handle_request(server, request, address):
+    # Như socketserver.ThreadingMixIn.process_request_thread, nhưng trên thread của pool
+    try:
+        server.finish_request(request, address)
+    except Exception:
+        server.handle_error(request, address)
+    finally:
+        server.shutdown_request(request)
+
+
+def start_backend(upstreams: FakeUpstreams, threads: int = 0, **env):
+    """
+    Chạy backend Flask (app.py) trong process này, nối với upstreams; env ghi đè biến
+    môi trường trước khi import app. threads > 0: chỉ chừng đó request được xử lý cùng
+    lúc, như một worker gunicorn --threads N; 0: mỗi request một thread.
+    Trả về (module app, base url).
+    """
+    base = f"http://127.0.0.1:{serve(upstreams).server_address[1]}"
+    os.environ.update({
+        "OPENAI_API_KEY": "fake", "OPENAI_BASE_URL": f"{base}/v1",
+        "SUPABASE_URL": base, "SUPABASE_KEY": "fake",
+        "EMBEDDING_CACHE_PATH": "", "LOG_SAMPLE_RATE": "0",
+        "KB_VERSION_PATH": os.path.join(tempfile.mkdtemp(), "kb_version"),
+        "REINDEX_QUEUE_PATH": os.path.join(tempfile.mkdtemp(), "reindex.sqlite3"),
+        "QUERY_LOG_FALLBACK_PATH": os.path.join(tempfile.mkdtemp(), "query_log.jsonl"),
+        **{key: str(value) for key, value in env.items()},
+    })
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import app as core
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    if threads:
+        # HTTP/1.0: mỗi kết nối đóng sau một response, không giữ chỗ trong pool khi rảnh
+        handler = type("PooledRequestHandler", (WSGIRequestHandler,), {"protocol_version": "HTTP/1.0"})
+        server = make_server("127.0.0.1", 0, core.app, request_handler=handler)
+        pool = ThreadPoolExecutor(threads, thread_name_prefix="flask")
+        server.process_request = lambda request, address: pool.submit(_handle_request, server, request, address)
+    else:
+        server = make_server("127.0.0.1", 0, core.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return core, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_asgi_backend(timeout: float = 30) -> str:
+    """
+    Chạy asgi_app (uvicorn, một worker) trên thread trong process này, dùng chung module
+    app với start_backend (gọi start_backend trước). Trả về base url.
+    """
+    import socket
+
+    import uvicorn
+
+    import asgi_app
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app.application, log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    deadline = time.monotonic() + timeout
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("uvicorn did not start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--embed-latency-ms", type=float, default=300)
+    parser.add_argument("--rpc-latency-ms", type=float, default=150)
+    parser.add_argument("--table-latency-ms", type=float, default=20)
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM)
+    args = parser.parse_args()
+
+    server = FakeServer((args.host, args.port), make_handler(FakeUpstreams(
+        args.embed_latency_ms / 1000, args.rpc_latency_ms / 1000, args.table_latency_ms / 1000, args.dim)))
+    print(f"fake upstreams on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,92 @@
+# Load driver: gửi song song các câu hỏi trong corpus tới một backend đang chạy
+#
+#   cd backend && python -m bench.load --url http://127.0.0.1:5000 --endpoint /api/chat -c 64 -n 2000
+#
+# --unique thêm số thứ tự vào câu hỏi để bỏ qua mọi tầng cache, đo đúng pipeline.
+# --corpus phát lại câu hỏi thật từ file query log (QUERY_LOG_SINK=jsonl) thay cho corpus mẫu.
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import httpx
+
+from .corpus import QUERIES, load_queries
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def chat_requests(endpoint: str, unique: bool, queries: list = QUERIES):
+    def make(i: int):
+        message = queries[i % len(queries)]
+        if unique:
+            message = f"{message} {i}"
+        return "POST", endpoint, {"json": {"message": message}}
+    return make
+
+
+async def run_requests(url: str, make_request, concurrency: int, total: int) -> dict:
+    """make_request(i) -> (method, path, kwargs của httpx); chạy `total` request với `concurrency` worker."""
+    counter = itertools.count()
+    latencies = []
+    errors = {}
+
+    async def worker(client: httpx.AsyncClient):
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            method, path, kwargs = make_request(i)
+            start = time.perf_counter()
+            try:
+                # Đọc hết body (kể cả SSE) trước khi tính thời gian
+                response = await client.request(method, path, **kwargs)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError as e:
+                key = f"{e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+                errors[key] = errors.get(key, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": sum(errors.values()),
+        "error_types": errors,
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run(url: str, endpoint: str, concurrency: int, total: int, unique: bool,
+              queries: list = QUERIES) -> dict:
+    return {"endpoint": endpoint,
+            **await run_requests(url, chat_requests(endpoint, unique, queries), concurrency, total)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--endpoint", default="/api/chat")
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("-n", "--requests", type=int, default=1000)
+    parser.add_argument("--unique", action="store_true")
+    parser.add_argument("--corpus", help="file JSONL của query log hoặc mỗi dòng một câu hỏi")
+    args = parser.parse_args()
+
+    queries = load_queries(args.corpus) if args.corpus else QUERIES
+    print(json.dumps(asyncio.run(run(args.url, args.endpoint, args.concurrency, args.requests, args.unique,
+                                     queries))))
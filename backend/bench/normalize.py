@@ -0,0 +1,87 @@
+# So sánh utils.normalize_text với bản cũ (NFD + generator + regex + replace)
+# Chạy: cd backend && python -m bench.normalize
+import re
+import time
+import unicodedata
+
+from utils import _normalize, normalize_many, normalize_text
+
+
+def legacy_normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFD", text)
+    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+    text = re.sub(r"[^\w\s]", "", text)
+    text = text.replace("  ", " ")
+    text = text.replace('_', ' ')
+    text = text.replace('.', ' ')
+    text = text.replace('Đ', 'D')
+    text = text.replace('đ', 'd')
+    text = text.replace(',', '')
+    return text.lower().strip()
+
+
+# Câu một dòng, khoảng trắng đơn: bản mới phải cho kết quả giống hệt bản cũ.
+# (Bản mới gộp mọi chuỗi khoảng trắng/xuống dòng thành một dấu cách.)
+GOLDEN = [
+    "Thủ tục đăng ký khai sinh cần những giấy tờ gì?",
+    "Giờ làm việc của UBND phường Bà Điểm",
+    "Chủ tịch UBND phường là ai?",
+    "ĐỊA CHỈ, SỐ ĐIỆN THOẠI đường dây nóng",
+    "Khu phố 3 ở đâu... có bao nhiêu hộ dân?",
+    "Xã Bà Điểm thành lập năm nào",
+    "Lệ phí chứng thực bản sao: 2.000đ/trang",
+    "thu_tuc_hanh_chinh tu_phap_ho_tich",
+    "Nộp hồ sơ trực tuyến tại dichvucong.gov.vn",
+    "Ạ Ặ Ẩ Ễ Ộ Ờ Ử Ỹ ạ ặ ẩ ễ ộ ờ ử ỹ ă â ê ô ơ ư Ă Â Ê Ô Ơ Ư",
+    "Làm thế nào để đăng ký kết hôn (có yếu tố nước ngoài)?",
+    "email: ubnd@badiem.gov.vn - zalo 0909 123 456",
+    "Thứ 2 đến thứ 6, T7 buổi sáng; CN nghỉ",
+    "Café Ñandú Ærø straße",
+    "",
+    "   ",
+]
+
+PARAGRAPH = (
+    "Ủy ban nhân dân phường Bà Điểm tiếp nhận hồ sơ đăng ký khai sinh, khai tử, "
+    "kết hôn và chứng thực bản sao từ bản chính vào các ngày làm việc trong tuần. "
+    "Công dân có thể nộp trực tuyến qua Cổng dịch vụ công quốc gia; lệ phí theo quy định. "
+)
+
+
+def check_golden() -> None:
+    for text in GOLDEN:
+        expected = legacy_normalize_text(text)
+        got = normalize_text(text)
+        assert got == expected, f"{text!r}: {got!r} != {expected!r}"
+
+
+def per_call_us(fn, texts, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+
+
+def run() -> list:
+    check_golden()
+    queries = [t for t in GOLDEN if t.strip()]
+    chunks = [PARAGRAPH * n for n in (4, 16, 64)]
+    return [
+        {"case": "query (cached)", "legacy_us": per_call_us(legacy_normalize_text, queries, 500),
+         "new_us": per_call_us(normalize_text, queries, 500)},
+        {"case": "query (uncached)", "legacy_us": per_call_us(legacy_normalize_text, queries, 500),
+         "new_us": per_call_us(_normalize, queries, 500)},
+        *[{"case": f"chunk {len(c)} chars", "legacy_us": per_call_us(legacy_normalize_text, [c], 50),
+           "new_us": per_call_us(_normalize, [c], 50)} for c in chunks],
+        {"case": "normalize_many x100 chunks", "legacy_us": per_call_us(
+            lambda cs: [legacy_normalize_text(c) for c in cs], [chunks[:1] * 100], 5),
+         "new_us": per_call_us(normalize_many, [chunks[:1] * 100], 5)},
+    ]
+
+
+if __name__ == "__main__":
+    print(f"{'case':<28} {'legacy us':>12} {'new us':>12} {'speedup':>8}")
+    for row in run():
+        print(f"{row['case']:<28} {row['legacy_us']:>12.1f} {row['new_us']:>12.1f} "
+              f"{row['legacy_us'] / row['new_us']:>7.1f}x")
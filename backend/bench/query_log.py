@@ -0,0 +1,146 @@
+# Kiểm tra và đo query_log.py (ghi nhật ký câu hỏi kiểu write-behind):
+# - độ trễ /api/chat khi bật query log, so với một lần insert đồng bộ vào Supabase
+# - mọi record tới bảng query_log theo batch, đủ trường
+# - Supabase lỗi -> file JSONL dự phòng; queue đầy -> bỏ và đếm; dừng process -> ghi nốt
+# Backend Flask chạy trong process này, OpenAI/Supabase là server giả lập.
+#
+#   cd backend && python -m bench.query_log [-n 300 -c 16 --table-latency-ms 50]
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from query_log import JsonlSink, QueryLog
+
+from .corpus import QUERIES
+from .fake_upstreams import FakeUpstreams, start_backend
+
+
+class SlowSink:
+
+    def __init__(self, delay: float, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.records = []
+
+    def write(self, records: list) -> None:
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("simulated supabase outage")
+        self.records.extend(records)
+
+
+def record(i: int) -> dict:
+    return {"query": QUERIES[i % len(QUERIES)], "document_ids": [i], "scores": [0.5]}
+
+
+def check_fallback() -> dict:
+    path = os.path.join(tempfile.mkdtemp(), "fallback.jsonl")
+    log = QueryLog(SlowSink(0, fail=True), JsonlSink(path), batch_size=50, flush_interval=0.05)
+    for i in range(120):
+        log.put(record(i))
+    log.close()
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    stats = log.stats()
+    assert len(lines) == 120 and stats["fallback_written"] == 120 and stats["errors"] == stats["batches"], stats
+    return {"fallback_lines": len(lines), "errors": stats["errors"], "last_error": stats["last_error"]}
+
+
+def check_rotation() -> dict:
+    # File JSONL vượt max_bytes: đổi thành .1, dung lượng không vượt quá 2 * max_bytes
+    path = os.path.join(tempfile.mkdtemp(), "log.jsonl")
+    sink = JsonlSink(path, max_bytes=4096)
+    for i in range(200):
+        sink.write([record(i)])
+    sizes = [os.path.getsize(p) for p in (path, path + ".1")]
+    assert sink.rotations > 0 and max(sizes) <= 4096, (sink.rotations, sizes)
+    return {"rotations": sink.rotations, "bytes": sizes}
+
+
+def check_backpressure() -> dict:
+    # Sink chậm, queue nhỏ: put không bao giờ chờ, phần vượt bị bỏ và được đếm
+    sink = SlowSink(0.05)
+    log = QueryLog(sink, max_queue=100, batch_size=20, flush_interval=0.01)
+    start = time.perf_counter()
+    accepted = sum(log.put(record(i)) for i in range(2000))
+    put_seconds = time.perf_counter() - start
+    log.close()
+    stats = log.stats()
+    assert stats["enqueued"] == accepted and stats["dropped"] == 2000 - accepted > 0, stats
+    assert len(sink.records) == accepted, (len(sink.records), accepted)
+    return {"put": 2000, "accepted": accepted, "dropped": stats["dropped"],
+            "put_us": round(put_seconds / 2000 * 1e6, 2)}
+
+
+def check_shutdown_flush() -> dict:
+    # Chưa tới hạn flush theo thời gian/kích thước: close() vẫn ghi hết
+    sink = SlowSink(0)
+    log = QueryLog(sink, batch_size=1000, flush_interval=60)
+    for i in range(50):
+        log.put(record(i))
+    time.sleep(0.05)
+    assert not sink.records
+    log.close()
+    assert len(sink.records) == 50, len(sink.records)
+    return {"flushed_on_close": len(sink.records)}
+
+
+def run(n: int = 300, concurrency: int = 16, table_latency: float = 0.05) -> dict:
+    upstreams = FakeUpstreams(table_latency=table_latency)
+    core, url = start_backend(upstreams, QUERY_LOG_SINK="supabase", QUERY_LOG_FLUSH_SECONDS=0.2)
+
+    def call(client, i):
+        start = time.perf_counter()
+        client.post("/api/chat", json={"message": f"{QUERIES[i % len(QUERIES)]} {i}"}).raise_for_status()
+        return time.perf_counter() - start
+
+    with httpx.Client(base_url=url, timeout=60) as client:
+        client.post("/api/chat", json={"message": "khởi động"}).raise_for_status()
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(lambda i: call(client, i), range(n)))
+
+    # Một insert đồng bộ như khi ghi log ngay trong request
+    start = time.perf_counter()
+    core.query_log.sink.write([record(0)])
+    sync_insert = time.perf_counter() - start
+
+    deadline = time.monotonic() + 10
+    while core.query_log.stats()["written"] < n + 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    rows = [row for row in upstreams.tables["query_log"] if row.get("endpoint") == "chat"]
+    assert len(rows) == n + 1, len(rows)
+    missing = {"ts", "tenant", "query", "q_format", "category", "subject", "source",
+               "document_ids", "scores", "timings_ms", "total_ms"} - rows[-1].keys()
+    assert not missing, missing
+    stats = core.query_log.stats()
+
+    return {
+        "requests": n,
+        "table_latency_ms": table_latency * 1000,
+        "chat_p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "sync_insert_ms": round(sync_insert * 1000, 2),
+        "rows": len(rows),
+        "batches": stats["batches"],
+        "avg_batch_size": stats["avg_batch_size"],
+        "sample": rows[-1],
+        "fallback": check_fallback(),
+        "rotation": check_rotation(),
+        "backpressure": check_backpressure(),
+        "shutdown": check_shutdown_flush(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=300)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--table-latency-ms", type=float, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.requests, args.concurrency, args.table_latency_ms / 1000),
+                     indent=2, ensure_ascii=False, default=str))
@@ -0,0 +1,119 @@
+# Kiểm tra và đo pipeline embedding lại (reindex.py) với server OpenAI/PostgREST giả lập
+# Chạy: cd backend && python -m bench.reindex [--docs 2000]
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from openai import OpenAI
+from supabase import create_client
+
+from reindex import Reindexer, ReindexQueue, backfill, drain, embed_texts
+from search_engine import parse_embedding
+
+from .fake_upstreams import FakeUpstreams, fake_embedding, serve
+
+DIM = 32
+
+
+def make_documents(n: int) -> list:
+    return [{"id": i, "procedure_name": None, "text_content": f"Nội dung văn bản số {i} về thủ tục hành chính.",
+             "category": "thu_tuc_hanh_chinh", "subject": "tu_phap_ho_tich", "is_active": True,
+             "effective_date": None, "embedding": None} for i in range(1, n + 1)]
+
+
+def run(docs: int = 2000, embed_latency: float = 0.05, batch_size: int = 128, page_size: int = 500) -> dict:
+    upstreams = FakeUpstreams(embed_latency=embed_latency, dim=DIM)
+    upstreams.tables["documents"] = make_documents(docs)
+    server = serve(upstreams)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    client = OpenAI(api_key="fake", base_url=f"{base}/v1", max_retries=0)
+    supabase = create_client(base, "fake")
+
+    queue = ReindexQueue(os.path.join(tempfile.mkdtemp(), "reindex.sqlite3"))
+    reindexer = Reindexer(supabase, lambda texts: embed_texts(client, "text-embedding-3-small", texts),
+                          queue, batch_size=batch_size)
+    quiet = lambda *args: None
+    report = {"docs": docs}
+
+    def vectors_ok():
+        # Vector được ghi dạng text pgvector (float32)
+        return all(d["embedding"] is not None and np.allclose(
+            parse_embedding(d["embedding"]), fake_embedding(d["text_content"], DIM), rtol=1e-6)
+            for d in upstreams.tables["documents"])
+
+    # 1. Backfill lần đầu: mọi document đều được embedding
+    start = time.perf_counter()
+    embedded = backfill(reindexer, page_size=page_size, log=quiet)
+    elapsed = time.perf_counter() - start
+    assert embedded == docs and vectors_ok()
+    report["backfill"] = {"embedded": embedded, "docs_per_sec": round(embedded / elapsed, 1),
+                          "embedding_calls": upstreams.stats()["embedding_calls"]}
+
+    # 2. Chạy lại: hash không đổi nên không gọi embedding
+    calls = upstreams.stats()["embedding_calls"]
+    assert backfill(reindexer, page_size=page_size, log=quiet) == 0
+    assert upstreams.stats()["embedding_calls"] == calls
+    report["rerun_embedded"] = 0
+
+    # 3. Ghi qua hàng đợi: 50 document sửa nội dung, 50 document lưu lại y nguyên
+    for doc in upstreams.tables["documents"][:50]:
+        doc["text_content"] += " (sửa đổi)"
+        reindexer.queue.enqueue(reindexer.tenant, doc)
+    for doc in upstreams.tables["documents"][50:100]:
+        reindexer.queue.enqueue(reindexer.tenant, doc)
+    depth = queue.depth(reindexer.tenant)
+    assert depth == 50, depth
+    assert drain(reindexer, log=quiet) == 50 and vectors_ok()
+    assert queue.depth(reindexer.tenant) == 0
+    report["queue"] = {"changed": 50, "unchanged": 50, "queued": depth}
+
+    # 4. Dừng giữa chừng rồi chạy tiếp từ checkpoint
+    failing_after = {"calls": 0}
+
+    def flaky(texts):
+        failing_after["calls"] += 1
+        if failing_after["calls"] == 6:
+            raise RuntimeError("simulated crash")
+        return embed_texts(client, "text-embedding-3-small", texts)
+
+    reindexer.embed_batch = flaky
+    try:
+        backfill(reindexer, force=True, page_size=page_size, log=quiet)
+        raise AssertionError("expected the simulated crash")
+    except RuntimeError:
+        pass
+    done_before_crash = reindexer.stats()["documents"]
+    resumed = []
+    backfill(reindexer, force=True, page_size=page_size, log=resumed.append)
+    assert resumed[0].startswith("resuming"), resumed[:1]
+    report["resume"] = {"checkpoint": resumed[0], "documents_total": reindexer.stats()["documents"],
+                        "before_crash": done_before_crash}
+
+    # 5. Document bị xoá trong lúc đang embedding: không được tạo lại khi ghi vector
+    reindexer.embed_batch = lambda texts: embed_texts(client, "text-embedding-3-small", texts)
+    for doc in upstreams.tables["documents"][:10]:
+        doc["text_content"] += " (xoá)"
+        reindexer.queue.enqueue(reindexer.tenant, doc)
+    claimed = reindexer.queue.claim(reindexer.tenant, 10)
+    rows = supabase.table("documents").select("id, text_content").in_("id", [i for i, _ in claimed]).execute().data
+    deleted = [row["id"] for row in rows[:5]]
+    upstreams.tables["documents"] = [d for d in upstreams.tables["documents"] if d["id"] not in deleted]
+    reindexer.process(rows)
+    reindexer.queue.complete(reindexer.tenant, claimed)
+    assert not any(d["id"] in deleted for d in upstreams.tables["documents"]), "deleted documents resurrected"
+    report["deleted_during_embedding"] = len(deleted)
+
+    report["stats"] = reindexer.stats()
+    server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--embed-latency-ms", type=float, default=50)
+    parser.add_argument("--batch-size", type=int, default=128)
+    args = parser.parse_args()
+    print(run(args.docs, args.embed_latency_ms / 1000, args.batch_size))
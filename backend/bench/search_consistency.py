@@ -0,0 +1,139 @@
+# Kiểm tra tự nhất quán của LocalSearchEngine (offline, không cần Supabase/OpenAI)
+#
+# So engine (ma trận numpy, postings BM25) với reference_search bên dưới: Python thuần,
+# từng hàng một, viết lại định nghĩa điểm của RPC search_documents_full_hybrid_v4.
+# Fixture đi kèm do chính reference_search tính ra, nên bench chỉ bắt được chỗ engine
+# lệch khỏi định nghĩa đó; nó KHÔNG chứng minh engine khớp RPC thật trên Postgres.
+# Đối chiếu với RPC thật: bench.search_parity --record.
+#
+#   cd backend && python -m bench.search_consistency
+# Tạo lại fixture (bộ dữ liệu nhỏ tổng hợp):
+#   cd backend && python -m bench.search_consistency --regenerate
+import argparse
+import json
+import math
+import os
+import random
+import sys
+from collections import Counter
+
+from search_engine import BM25_B, BM25_K1, LEXICAL_WEIGHT, SEMANTIC_WEIGHT
+from utils import classify, normalize_text
+
+from .corpus import QUERIES
+from .search_parity import LIMIT, compare
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "search_reference.json")
+
+
+# --- Bản cài đặt tham chiếu: Python thuần, từng hàng một, theo đúng định nghĩa điểm của RPC ---
+
+def _unit(vector):
+    if vector is None:
+        return None
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm > 0 else None
+
+
+def reference_search(documents: list, aliases: list, q_format: str, embedding, category, subject,
+                     limit: int = LIMIT) -> list:
+    """
+    Mỗi document và mỗi alias (có document) là một hàng; điểm hàng =
+    SEMANTIC_WEIGHT * cosine + LEXICAL_WEIGHT * BM25 (chia cho BM25 lớn nhất);
+    điểm document = điểm lớn nhất trong các hàng của nó. Lọc is_active/category/subject.
+    """
+    doc_ids = {doc["id"] for doc in documents}
+    rows = [(doc["id"], doc.get("normalized_text") or normalize_text(doc.get("text_content") or ""),
+             doc.get("embedding")) for doc in documents]
+    rows += [(alias["document_id"], alias.get("normalized_alias") or normalize_text(alias.get("alias_text") or ""),
+              alias.get("embedding")) for alias in aliases if alias.get("document_id") in doc_ids]
+
+    tfs = [Counter(text.split()) for _, text, _ in rows]
+    lengths = [sum(tf.values()) for tf in tfs]
+    avg_len = sum(lengths) / len(rows)
+    lexical = [0.0] * len(rows)
+    for token in set(q_format.split()):
+        df = sum(1 for tf in tfs if token in tf)
+        if not df:
+            continue
+        idf = math.log(1 + (len(rows) - df + 0.5) / (df + 0.5))
+        for r, tf in enumerate(tfs):
+            if token in tf:
+                lexical[r] += idf * tf[token] * (BM25_K1 + 1) / (
+                    tf[token] + BM25_K1 * (1 - BM25_B + BM25_B * lengths[r] / avg_len))
+    top = max(lexical)
+    if top > 0:
+        lexical = [score / top for score in lexical]
+
+    query = _unit(embedding)
+    best = {}
+    for r, (doc_id, _, vector) in enumerate(rows):
+        vector = _unit(vector)
+        semantic = sum(a * b for a, b in zip(query, vector)) if query and vector else 0.0
+        score = SEMANTIC_WEIGHT * semantic + LEXICAL_WEIGHT * lexical[r]
+        best[doc_id] = max(best.get(doc_id, -math.inf), score)
+
+    results = []
+    for doc in documents:
+        if doc.get("is_active") is False or (category and doc["category"] != category) \
+                or (subject and doc["subject"] != subject):
+            continue
+        results.append({"id": doc["id"], "score": round(best[doc["id"]], 6)})
+    results.sort(key=lambda r: -r["score"])
+    return results[:limit]
+
+
+def make_reference(path: str, dim: int = 32, docs_per_group: int = 10, seed: int = 0) -> None:
+    # Mỗi nhóm (category, subject) của corpus có một tâm vector và bộ từ riêng
+    rnd = random.Random(seed)
+    groups = {}
+    for query in QUERIES:
+        q_format = normalize_text(query)
+        groups.setdefault(classify(q_format), []).append(q_format)
+    centers = {key: [rnd.gauss(0, 1) for _ in range(dim)] for key in groups}
+    filler = "theo quy dinh tai uy ban nhan dan can cu ho so giay to".split()
+
+    def near(center, spread):
+        return [round(c + rnd.gauss(0, spread), 4) for c in center]
+
+    documents, aliases = [], []
+    for (category, subject), phrases in groups.items():
+        words = [w for phrase in phrases for w in phrase.split()]
+        for _ in range(docs_per_group):
+            doc_id = len(documents) + 1
+            text = " ".join(rnd.choice(words + filler) for _ in range(rnd.randint(12, 30)))
+            documents.append({"id": doc_id, "procedure_name": None, "text_content": text, "normalized_text": text,
+                              "category": category, "subject": subject, "is_active": rnd.random() > 0.1,
+                              "effective_date": None, "embedding": near(centers[(category, subject)], 1.0)})
+            alias_text = rnd.choice(phrases)
+            aliases.append({"id": doc_id, "document_id": doc_id, "alias_text": alias_text,
+                            "normalized_alias": alias_text,
+                            "embedding": near(centers[(category, subject)], 0.8) if rnd.random() > 0.2 else None})
+
+    cases = []
+    for query in QUERIES:
+        q_format = normalize_text(query)
+        category, subject = classify(q_format)
+        embedding = near(centers[(category, subject)], 1.2)
+        cases.append({"query": query, "q_format": q_format, "category": category, "subject": subject,
+                      "embedding": embedding,
+                      "replies": reference_search(documents, aliases, q_format, embedding, category, subject)})
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"source": "reference", "documents": documents, "alias": aliases, "cases": cases}, f,
+                  ensure_ascii=False)
+    print(f"wrote {len(documents)} documents, {len(aliases)} aliases, {len(cases)} cases -> {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default=FIXTURE)
+    parser.add_argument("--regenerate", action="store_true", help="tạo lại fixture bằng reference_search")
+    parser.add_argument("--min-overlap", type=float, default=0.8)
+    args = parser.parse_args()
+
+    if args.regenerate:
+        make_reference(args.path)
+    else:
+        sys.exit(0 if compare(args.path, args.min_overlap) else 1)
@@ -0,0 +1,97 @@
+# Đối chiếu LocalSearchEngine với kết quả đã ghi lại của RPC search_documents_full_hybrid_v4
+#
+# Ghi lại từ RPC thật (cần Supabase + OpenAI), rồi đối chiếu offline:
+#   cd backend && python -m bench.search_parity --record bench/fixtures/rpc_recorded.json
+#   cd backend && python -m bench.search_parity bench/fixtures/rpc_recorded.json
+#
+# Repo không kèm file ghi từ RPC thật. bench.search_consistency chạy offline nhưng chỉ
+# so engine với bản cài đặt tham chiếu của chính repo, không thay được phép đối chiếu này.
+import argparse
+import json
+import sys
+
+from search_engine import ALIAS_COLUMNS, DOCUMENT_COLUMNS, LocalSearchEngine, fetch_all
+from utils import classify, normalize_text
+
+from .corpus import QUERIES
+
+LIMIT = 5
+
+
+def record(path: str) -> None:
+    from app import embed_text
+    from corn import supabase
+
+    documents = fetch_all(supabase, "documents", DOCUMENT_COLUMNS)
+    aliases = fetch_all(supabase, "alias", ALIAS_COLUMNS)
+
+    cases = []
+    for query in QUERIES:
+        q_format = normalize_text(query)
+        category, subject = classify(q_format)
+        embedding = embed_text(query)
+        response = supabase.rpc(
+            "search_documents_full_hybrid_v4",
+            {
+                "p_query_format": q_format,
+                "p_query_embedding": embedding,
+                "p_tenant": "xa_ba_diem",
+                "p_category": category,
+                "p_subject": subject,
+                "p_limit": LIMIT
+            }
+        ).execute()
+        cases.append({
+            "query": query,
+            "q_format": q_format,
+            "category": category,
+            "subject": subject,
+            "embedding": embedding,
+            "replies": response.data,
+        })
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"source": "rpc", "documents": documents, "alias": aliases, "cases": cases}, f,
+                  ensure_ascii=False)
+    print(f"recorded {len(cases)} cases -> {path}")
+
+
+def compare(path: str, min_overlap: float) -> bool:
+    with open(path, encoding="utf-8") as f:
+        recorded = json.load(f)
+
+    dim = len(recorded["cases"][0]["embedding"]) if recorded["cases"] else 1536
+    engine = LocalSearchEngine(dim)
+    engine.load(recorded["documents"], recorded["alias"])
+
+    source = recorded.get("source", "rpc")
+    top1 = 0
+    overlaps = []
+    for case in recorded["cases"]:
+        expected = [r["id"] for r in case["replies"] or []]
+        got = [r["id"] for r in engine.search(
+            case["q_format"], case["embedding"], case["category"], case["subject"], LIMIT)]
+        if expected[:1] == got[:1]:
+            top1 += 1
+        overlap = len(set(expected) & set(got)) / len(expected) if expected else float(not got)
+        overlaps.append(overlap)
+        if overlap < 1:
+            print(f"  {case['query']!r}: {source}={expected} local={got}")
+
+    mean_overlap = sum(overlaps) / len(overlaps) if overlaps else 1.0
+    print(f"{source}: cases={len(overlaps)} "
+          f"top1_agreement={top1 / max(len(overlaps), 1):.3f} top{LIMIT}_overlap={mean_overlap:.3f}")
+    return mean_overlap >= min_overlap
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="file ghi lại từ RPC (bench/fixtures/rpc_recorded.json)")
+    parser.add_argument("--record", action="store_true", help="ghi lại từ RPC thật")
+    parser.add_argument("--min-overlap", type=float, default=0.8)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.path)
+    else:
+        sys.exit(0 if compare(args.path, args.min_overlap) else 1)
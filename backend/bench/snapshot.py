@@ -0,0 +1,157 @@
+# Kiểm tra và đo snapshot memmap (kb_snapshot.py): thời gian nạp, kết quả tìm kiếm
+# và bộ nhớ dùng chung giữa các process
+# Chạy: cd backend && python -m bench.snapshot [--docs 5000 --workers 4]
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from alias_index import AliasIndex
+from kb_snapshot import KBSnapshot, SnapshotFile, export_snapshot
+from search_engine import LocalSearchEngine
+from utils import normalize_text
+
+from .corpus import QUERIES
+
+DIM = 1536
+
+
+def make_rows(n_docs: int, dim: int = DIM, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    words = [w for q in QUERIES for w in normalize_text(q).split()]
+    documents, aliases = [], []
+    for i in range(1, n_docs + 1):
+        text = " ".join(rng.choice(words, 40))
+        documents.append({"id": i, "procedure_name": f"Thủ tục {i}", "text_content": text,
+                          "normalized_text": normalize_text(text), "category": f"c{i % 4}", "subject": f"s{i % 7}",
+                          "is_active": i % 50 != 0, "effective_date": None,
+                          "embedding": rng.standard_normal(dim).astype(np.float32).tolist()})
+        aliases.append({"id": i, "document_id": i, "alias_text": " ".join(rng.choice(words, 5)),
+                        "normalized_alias": None, "embedding": rng.standard_normal(dim).astype(np.float32).tolist()})
+    return documents, aliases
+
+
+def queries(dim: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    return [(normalize_text(q), rng.standard_normal(dim).astype(np.float32)) for q in QUERIES]
+
+
+def top_ids(engine, qs, limit: int = 5):
+    return [[r["id"] for r in engine.search(q, v, limit=limit)] for q, v in qs]
+
+
+def mapping_memory(path: str) -> dict:
+    # Rss: trang của file mà process đang giữ; Pss: phần chia đều khi nhiều process cùng map
+    rss = pss = 0
+    current = False
+    with open("/proc/self/smaps") as f:
+        for line in f:
+            if not line[0].isupper() or ":" not in line.split()[0]:
+                current = line.rstrip().endswith(os.path.basename(path))
+            elif current and line.startswith("Rss:"):
+                rss += int(line.split()[1])
+            elif current and line.startswith("Pss:"):
+                pss += int(line.split()[1])
+    return {"rss_kb": rss, "pss_kb": pss}
+
+
+def fork_workers(path: str, qs, workers: int) -> list:
+    # Mỗi worker mở snapshot và tìm kiếm; đo khi tất cả đang cùng giữ mapping
+    reports = []
+    read_fds, children = [], []
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    for _ in range(workers):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            engine = LocalSearchEngine.from_snapshot(KBSnapshot(path))
+            top_ids(engine, qs)
+            os.write(ready_w, b"x")
+            os.read(go_r, 1)
+            os.write(w, json.dumps(mapping_memory(path)).encode())
+            os._exit(0)
+        os.close(w)
+        read_fds.append(r)
+        children.append(pid)
+    for _ in range(workers):
+        os.read(ready_r, 1)
+    os.write(go_w, b"x" * workers)
+    for r, pid in zip(read_fds, children):
+        reports.append(json.loads(read_all(r)))
+        os.close(r)
+        os.waitpid(pid, 0)
+    return reports
+
+
+def read_all(fd: int) -> bytes:
+    # Đọc tới EOF (worker đóng pipe khi thoát)
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def run(n_docs: int = 5000, workers: int = 4) -> dict:
+    documents, aliases = make_rows(n_docs)
+    qs = queries(DIM)
+    tmp = tempfile.mkdtemp()
+    report = {"documents": n_docs, "aliases": len(aliases)}
+
+    start = time.perf_counter()
+    baseline = LocalSearchEngine(DIM)
+    baseline.load(documents, aliases)
+    report["load_from_rows_s"] = round(time.perf_counter() - start, 3)
+    expected = top_ids(baseline, qs)
+
+    for dtype in ("float32", "float16", "int8"):
+        path = os.path.join(tmp, f"kb_{dtype}.bin")
+        start = time.perf_counter()
+        export_snapshot(path, documents, aliases, dtype)
+        export_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine = LocalSearchEngine.from_snapshot(KBSnapshot(path))
+        open_s = time.perf_counter() - start
+        got = top_ids(engine, qs)
+        agreement = np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(expected, got)])
+        if dtype == "float32":
+            assert got == expected, "float32 snapshot must rank exactly like the in-memory engine"
+
+        report[dtype] = {"bytes": os.path.getsize(path), "export_s": round(export_s, 3),
+                         "open_s": round(open_s, 3), "top5_agreement": round(float(agreement), 4)}
+
+    # Cập nhật tăng dần sau khi mở snapshot vẫn hoạt động (copy-on-write)
+    path = os.path.join(tmp, "kb_float32.bin")
+    engine = LocalSearchEngine.from_snapshot(KBSnapshot(path))
+    doc = dict(documents[0], text_content="văn bản mới hoàn toàn", normalized_text="van ban moi hoan toan")
+    engine.upsert_document(doc)
+    assert engine.docs[doc["id"]]["text_content"] == "văn bản mới hoàn toàn"
+    assert KBSnapshot(path).rows("documents")[doc["id"]]["text_content"] == documents[0]["text_content"]
+    index = AliasIndex.from_snapshot(KBSnapshot(path))
+    assert index.lookup(normalize_text("Thủ tục 7"))[0]["id"] == 7
+
+    # Hot-swap: thay file bằng os.replace, SnapshotFile mở bản mới
+    watched = SnapshotFile(path)
+    first = watched.current()
+    export_snapshot(path, documents[:10], aliases[:10], "float32", kb_version=1)
+    second = watched.current()
+    assert second is not first and second.n_documents == 10 and first.n_documents == n_docs
+    export_snapshot(path, documents, aliases, "float32")
+
+    report["workers"] = fork_workers(path, qs, workers)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    print(run(args.docs, args.workers))
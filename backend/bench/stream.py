@@ -0,0 +1,125 @@
+# Đo /api/chat-stream so với /api/chat: thời gian tới sự kiện đầu tiên, tới câu trả lời
+# dùng được đầu tiên (partial/reply) và tới sự kiện cuối; kiểm tra hủy khi client ngắt.
+# Backend Flask chạy trong process này, OpenAI/Supabase là server giả lập.
+#
+#   cd backend && python -m bench.stream [-n 50 --embed-latency-ms 300 --rpc-latency-ms 150]
+import argparse
+import json
+import statistics
+import time
+
+import httpx
+
+from utils import normalize_text
+
+from .corpus import QUERIES
+from .fake_upstreams import FakeUpstreams, start_backend
+
+# Alias mẫu để đường trả lời tạm (khớp một phần alias) có dữ liệu
+ALIASES = [(1, "khai sinh"), (1, "làm giấy khai sinh"), (2, "kết hôn"), (3, "giờ làm việc"),
+           (3, "lịch làm việc"), (4, "chủ tịch ubnd phường")]
+
+
+def start_stream_backend(upstreams: FakeUpstreams, heartbeat: float):
+    upstreams.tables["alias"] = [{"id": i, "document_id": doc_id, "alias_text": text,
+                                  "normalized_alias": normalize_text(text), "embedding": None}
+                                 for i, (doc_id, text) in enumerate(ALIASES, 1)]
+    return start_backend(upstreams, STREAM_HEARTBEAT_SECONDS=heartbeat)
+
+
+def events(response):
+    # (thời điểm, tên sự kiện) cho mỗi khối SSE; heartbeat là comment ":"
+    buffer = ""
+    for text in response.iter_text():
+        buffer += text
+        while "\n\n" in buffer:
+            block, buffer = buffer.split("\n\n", 1)
+            now = time.perf_counter()
+            if block.startswith(":"):
+                yield now, "heartbeat", None
+                continue
+            name, payload = "message", None
+            for line in block.split("\n"):
+                if line.startswith("event: "):
+                    name = line[len("event: "):]
+                elif line.startswith("data: "):
+                    payload = json.loads(line[len("data: "):])
+            yield now, name, payload
+
+
+def measure_stream(client: httpx.Client, message: str) -> dict:
+    start = time.perf_counter()
+    marks = {}
+    with client.stream("POST", "/api/chat-stream", json={"message": message}) as response:
+        headers = response.headers
+        for now, name, payload in events(response):
+            marks.setdefault("first_event", now)
+            if name in ("partial", "reply") or (payload and "replies" in payload):
+                marks.setdefault("first_answer", now)
+            if name == "partial":
+                marks.setdefault("partial_source", payload["source"])
+            if name == "message" and payload and "replies" in payload:
+                marks["final"] = now
+                marks["source"] = payload["source"]
+    assert headers.get("x-accel-buffering") == "no", headers
+    return {key: (value - start if isinstance(value, float) else value) for key, value in marks.items()}
+
+
+def ms(values: list) -> dict:
+    values = [v * 1000 for v in values]
+    return {"p50_ms": round(statistics.median(values), 1), "max_ms": round(max(values), 1)} if values else {}
+
+
+def check_disconnect(core, url: str, upstreams: FakeUpstreams) -> dict:
+    # Ngắt ở heartbeat đầu tiên (đang chờ embedding): embedding chạy xong nhưng không gọi RPC
+    rpc_before = upstreams.stats()["rpc_calls"]
+    cancelled_before = core.search_flights.stats()["cancelled"]
+    with httpx.Client(base_url=url, timeout=30) as client:
+        with client.stream("POST", "/api/chat-stream", json={"message": "câu hỏi rồi bỏ đi giữa chừng"}) as response:
+            next(name for _, name, _ in events(response) if name == "heartbeat")
+    time.sleep(upstreams.embed_latency + 0.5)
+    report = {"rpc_calls_after_disconnect": upstreams.stats()["rpc_calls"] - rpc_before,
+              "cancelled": core.search_flights.stats()["cancelled"] - cancelled_before}
+    assert report == {"rpc_calls_after_disconnect": 0, "cancelled": 1}, report
+    return report
+
+
+def run(n: int = 50, embed_latency: float = 0.3, rpc_latency: float = 0.15, heartbeat: float = 0.1) -> dict:
+    upstreams = FakeUpstreams(embed_latency=embed_latency, rpc_latency=rpc_latency)
+    core, url = start_stream_backend(upstreams, heartbeat)
+
+    chat, streams = [], []
+    with httpx.Client(base_url=url, timeout=30) as client:
+        client.post("/api/chat", json={"message": "khởi động"}).raise_for_status()
+        for i in range(n):
+            # Số thứ tự riêng cho mỗi lần để bỏ qua result cache
+            message = f"{QUERIES[i % len(QUERIES)]} {i}"
+            start = time.perf_counter()
+            client.post("/api/chat", json={"message": message}).raise_for_status()
+            chat.append(time.perf_counter() - start)
+            streams.append(measure_stream(client, f"{message} stream"))
+
+    with_partial = [s for s in streams if "partial_source" in s]
+    return {
+        "requests": n,
+        "embed_latency_ms": embed_latency * 1000,
+        "rpc_latency_ms": rpc_latency * 1000,
+        "chat_total": ms(chat),
+        "stream_first_event": ms([s["first_event"] for s in streams]),
+        "stream_first_answer": ms([s["first_answer"] for s in streams]),
+        "stream_final": ms([s["final"] for s in streams]),
+        "partial_answers": len(with_partial),
+        "partial_first_answer": ms([s["first_answer"] for s in with_partial]),
+        "disconnect": check_disconnect(core, url, upstreams),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=50)
+    parser.add_argument("--embed-latency-ms", type=float, default=300)
+    parser.add_argument("--rpc-latency-ms", type=float, default=150)
+    parser.add_argument("--heartbeat-ms", type=float, default=100)
+    args = parser.parse_args()
+    print(json.dumps(run(args.requests, args.embed_latency_ms / 1000, args.rpc_latency_ms / 1000,
+                         args.heartbeat_ms / 1000), indent=2))
@@ -0,0 +1,233 @@
+# Bộ benchmark đầy đủ, chạy offline: backend Flask trong process này nối với OpenAI/Supabase
+# giả lập (bench.fake_upstreams), tải lên /api/chat, /api/chat-stream và các endpoint CRUD,
+# cùng micro-benchmark normalize_text/classify. Kết quả ghi ra file JSON để so giữa các lần chạy.
+#
+#   cd backend && python -m bench.suite -o before.json
+#   ... sửa code ...
+#   cd backend && python -m bench.suite -o after.json --baseline before.json
+#
+# Các kịch bản *_asgi chạy cùng tải chat lên asgi_app (Quart + uvicorn, một worker) trong
+# cùng process, nối với cùng upstream giả lập, để so trực tiếp với Flask ở cùng số worker.
+# Mặc định Flask chạy mỗi request một thread; --flask-threads N giới hạn như một worker
+# gunicorn --threads N, là cấu hình mà ASGI thay thế:
+#
+#   cd backend && python -m bench.suite --only chat chat_asgi -c 64 --flask-threads 8 \
+#       --embed-latency-ms 300 --rpc-latency-ms 150
+#
+# Với --baseline, chỉ số nào chậm hơn quá --tolerance (mặc định 20%) được liệt kê và
+# lệnh thoát với mã 1. Client tải và backend dùng chung một process (chung GIL): so sánh
+# giữa các lần chạy trên cùng máy, không đọc như số tuyệt đối của production.
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from utils import normalize_text
+
+from . import classify as classify_bench
+from . import normalize as normalize_bench
+from .corpus import QUERIES, load_queries
+from .fake_upstreams import DOCUMENTS, FakeUpstreams, fake_embedding, start_asgi_backend, start_backend
+from .load import chat_requests, run_requests
+
+# Chỉ số càng nhỏ càng tốt / càng lớn càng tốt khi so với baseline
+LOWER_IS_BETTER = ("p50_ms", "p99_ms")
+HIGHER_IS_BETTER = ("rps",)
+# Kịch bản gửi tới asgi_app thay vì Flask
+ASGI_SCENARIOS = ("chat_asgi", "chat_stream_asgi")
+
+
+def make_documents(n: int, dim: int) -> list:
+    # Nhân bản các document mẫu, giữ nguyên category/subject để classify khớp như thật
+    documents = []
+    for i in range(n):
+        template = DOCUMENTS[i % len(DOCUMENTS)]
+        text = f"{template['text_content']} (mục {i + 1})"
+        documents.append(dict(template, id=i + 1, text_content=text,
+                              normalized_text=normalize_text(text), embedding=fake_embedding(text, dim)))
+    return documents
+
+
+def scenarios(upstreams: FakeUpstreams, queries: list) -> list:
+    """(tên, make_request) theo thứ tự chạy; các bước CRUD sau dùng alias do bước trước tạo."""
+    created = []
+
+    def alias_ids():
+        # Alias do create_alias tạo, theo thứ tự id
+        if not created:
+            created.extend(sorted(row["id"] for row in upstreams.tables["alias"]
+                                  if str(row.get("alias_text", "")).startswith("bench alias")))
+        return created
+
+    documents = upstreams.tables["documents"]
+    editable = [d["id"] for d in documents if d["category"] == "thong_tin_phuong"]
+
+    def update_chunk(i):
+        doc_id = editable[i % len(editable)]
+        return "PUT", f"/api/update-chunk/{doc_id}", {"json": {
+            "category": "thong_tin_phuong", "subject": documents[doc_id - 1]["subject"],
+            "text_content": f"{documents[doc_id - 1]['text_content']} cập nhật {i}"}}
+
+    return [
+        ("chat", chat_requests("/api/chat", unique=True, queries=queries)),
+        # Lặp lại corpus: phần lớn trả từ result cache
+        ("chat_cached", chat_requests("/api/chat", unique=False, queries=queries)),
+        # Hậu tố riêng để không trùng result cache với kịch bản chat
+        ("chat_stream", chat_requests("/api/chat-stream", unique=True,
+                                      queries=[f"{q} (stream)" for q in queries])),
+        # Cùng tải như chat / chat_stream nhưng qua asgi_app; hậu tố riêng để không trúng result cache
+        ("chat_asgi", chat_requests("/api/chat", unique=True, queries=[f"{q} (asgi)" for q in queries])),
+        ("chat_stream_asgi", chat_requests("/api/chat-stream", unique=True,
+                                           queries=[f"{q} (asgi stream)" for q in queries])),
+        ("get_chunks", lambda i: ("GET", "/api/get-chunks", {"params": {"limit": 50}})),
+        ("get_alias", lambda i: ("GET", "/api/get-alias", {"params": {"limit": 50}})),
+        ("create_alias", lambda i: ("POST", "/api/create-alias", {"json": {
+            "document_id": documents[i % len(documents)]["id"], "alias_text": f"bench alias {i}"}})),
+        ("update_alias", lambda i: ("PUT", f"/api/update-alias/{alias_ids()[i % len(alias_ids())]}", {"json": {
+            "document_id": documents[i % len(documents)]["id"], "alias_text": f"bench alias {i} sửa"}})),
+        ("update_chunk", update_chunk),
+        ("delete_alias", lambda i: ("DELETE", f"/api/delete-alias/{alias_ids()[i % len(alias_ids())]}", {})),
+    ]
+
+
+def micro() -> dict:
+    results = {}
+    for row in normalize_bench.run():
+        results[f"normalize/{row['case']}_us"] = round(row["new_us"], 3)
+    for row in classify_bench.run():
+        results[f"classify/{row['keywords']} keywords_us"] = round(row["trie_us"], 3)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(requests: int = 200, concurrency: int = 16, docs: int = 200, embed_latency: float = 0.1,
+        rpc_latency: float = 0.05, table_latency: float = 0.02, queries: list = QUERIES,
+        only=None, with_micro: bool = True, flask_threads: int = 0, **env) -> dict:
+    upstreams = FakeUpstreams(embed_latency, rpc_latency, table_latency)
+    upstreams.tables["documents"] = make_documents(docs, upstreams.dim)
+    core, url = start_backend(upstreams, threads=flask_threads, **env)
+
+    only = set(only or ())
+    if only & {"update_alias", "delete_alias"}:
+        # Hai kịch bản này sửa/xóa alias do create_alias tạo
+        only.add("create_alias")
+    asgi_url = start_asgi_backend() if not only or only & set(ASGI_SCENARIOS) else None
+
+    async def run_all():
+        results = {}
+        await run_requests(url, chat_requests("/api/chat", unique=False, queries=["khởi động"]), 1, 1)
+        if asgi_url:
+            # Câu khác với Flask để đi hết pipeline (tạo Supabase async client), không trúng result cache
+            await run_requests(asgi_url, chat_requests("/api/chat", unique=False, queries=["khởi động asgi"]), 1, 1)
+        for name, make_request in scenarios(upstreams, queries):
+            if only and name not in only:
+                continue
+            target = asgi_url if name in ASGI_SCENARIOS else url
+            results[name] = await run_requests(target, make_request, concurrency, requests)
+        return results
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "requests": requests,
+            "concurrency": concurrency,
+            "docs": docs,
+            "queries": len(queries),
+            "embed_latency_ms": embed_latency * 1000,
+            "rpc_latency_ms": rpc_latency * 1000,
+            "table_latency_ms": table_latency * 1000,
+            "flask_threads": flask_threads,
+            "env": env,
+        },
+        "scenarios": asyncio.run(run_all()),
+        "micro": micro() if with_micro else {},
+        "upstreams": upstreams.stats(),
+        "health": {name: core.app.test_client().get("/api/health").json.get(name)
+                   for name in ("embedding_cache", "result_cache", "search_flights", "query_log")},
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    """Các chỉ số xấu đi quá `tolerance` so với baseline: (tên, trước, sau, tỉ lệ)."""
+    regressions = []
+    for name, now in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        if now.get("errors", 0) > before.get("errors", 0):
+            regressions.append((f"{name}.errors", before.get("errors", 0), now["errors"], None))
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if not before.get(key) or not now.get(key):
+                continue
+            ratio = now[key] / before[key]
+            worse = ratio > 1 + tolerance if key in LOWER_IS_BETTER else ratio < 1 / (1 + tolerance)
+            if worse:
+                regressions.append((f"{name}.{key}", before[key], now[key], round(ratio, 3)))
+    for name, now in current["micro"].items():
+        before = baseline.get("micro", {}).get(name)
+        if before and now / before > 1 + tolerance:
+            regressions.append((name, before, now, round(now / before, 3)))
+    return regressions
+
+
+def print_table(results: dict) -> None:
+    print(f"{'scenario':<16} {'rps':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}", file=sys.stderr)
+    for name, row in results["scenarios"].items():
+        print(f"{name:<16} {row['rps']:>10.1f} {row['p50_ms']:>10.2f} {row['p99_ms']:>10.2f} {row['errors']:>8}",
+              file=sys.stderr)
+    for name, us in results["micro"].items():
+        print(f"{name:<44} {us:>10.2f} us", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="file kết quả của lần chạy trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="số request mỗi kịch bản")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--corpus", help="file JSONL của query log hoặc mỗi dòng một câu hỏi")
+    parser.add_argument("--only", nargs="*",
+                        help="chỉ chạy các kịch bản này (chat, chat_stream, chat_asgi, get_alias, ...)")
+    parser.add_argument("--no-micro", action="store_true")
+    parser.add_argument("--embed-latency-ms", type=float, default=100)
+    parser.add_argument("--rpc-latency-ms", type=float, default=50)
+    parser.add_argument("--table-latency-ms", type=float, default=20)
+    parser.add_argument("--flask-threads", type=int, default=0,
+                        help="số thread của backend Flask (0: mỗi request một thread)")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="biến môi trường cho backend, ví dụ SEARCH_BACKEND=local")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    results = run(args.requests, args.concurrency, args.docs, args.embed_latency_ms / 1000,
+                  args.rpc_latency_ms / 1000, args.table_latency_ms / 1000,
+                  load_queries(args.corpus) if args.corpus else QUERIES, args.only, not args.no_micro,
+                  args.flask_threads, **dict(item.split("=", 1) for item in args.env))
+    results["meta"]["seconds"] = round(time.perf_counter() - started, 1)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+    print_table(results)
+    print(f"results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for name, before, now, ratio in regressions:
+            print(f"REGRESSION {name}: {before} -> {now}" + (f" ({ratio}x)" if ratio else ""), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
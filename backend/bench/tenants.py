@@ -0,0 +1,186 @@
+# Tải nhiều tenant: bộ nhớ index và độ trễ khi số tenant đang dùng tăng dần, với
+# ngân sách TENANT_MEMORY_BUDGET_MB cố định (tenant ít dùng bị bỏ theo LRU rồi nạp lại).
+# Backend Flask chạy trong process này (SEARCH_BACKEND=local, TENANT_COLUMN=tenant),
+# OpenAI/Supabase là server giả lập.
+#
+# Mỗi phase nạp trước các tenant đang dùng rồi mới đo. Khi ngân sách chứa đủ các tenant
+# đó (mặc định: 60 tenant x ~1.1MB trong 96MB), bench kiểm tra không có lần nạp lại hay
+# bỏ tenant nào trong lúc đo và p99 <= --max-p99-ms. Ngân sách nhỏ hơn (vd --budget-mb 16)
+# chỉ in số liệu để thấy cái giá của việc nạp lại liên tục.
+# Cuối cùng kiểm tra sửa knowledge base của một tenant chỉ làm tenant đó nạp lại.
+#
+#   cd backend && python -m bench.tenants [--tenants 60 --docs 60 --budget-mb 96 --max-p99-ms 1000]
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+
+from embedding_codec import to_pgvector
+from kb_version import KBVersion
+
+from .corpus import QUERIES
+from .fake_upstreams import FakeUpstreams, start_backend
+from .load import percentile
+
+DIM = 1536
+
+
+def tenant_id(i: int) -> str:
+    return f"phuong_{i:03d}"
+
+
+def make_tables(n_tenants: int, n_docs: int) -> dict:
+    # Vector dạng text pgvector như PostgREST trả về; alias không có embedding để dữ liệu giả nhẹ hơn
+    rng = np.random.default_rng(0)
+    documents, aliases = [], []
+    for t in range(n_tenants):
+        for j in range(n_docs):
+            doc_id = t * n_docs + j + 1
+            text = f"{QUERIES[j % len(QUERIES)]} ({tenant_id(t)} mục {j})"
+            documents.append({"id": doc_id, "tenant": tenant_id(t), "procedure_name": f"Thủ tục {doc_id}",
+                              "text_content": text, "normalized_text": None, "category": None, "subject": None,
+                              "is_active": True, "effective_date": None,
+                              "embedding": to_pgvector(rng.standard_normal(DIM))})
+            aliases.append({"id": doc_id, "document_id": doc_id, "alias_text": f"hỏi về mục {j}",
+                            "normalized_alias": f"hoi ve muc {j}", "embedding": None})
+    return {"documents": documents, "alias": aliases}
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return 0.0
+
+
+def ask(client, t: int, n_docs: int, message: str) -> float:
+    start = time.perf_counter()
+    response = client.post("/api/chat", headers={"X-Tenant": tenant_id(t)}, json={"message": message})
+    elapsed = time.perf_counter() - start
+    response.raise_for_status()
+    # Chỉ trả về document của đúng tenant
+    ids = [r["id"] for r in response.json()["replies"]]
+    assert all(t * n_docs < doc_id <= (t + 1) * n_docs for doc_id in ids), (t, ids)
+    return elapsed
+
+
+def phase(core, url: str, active: int, n_docs: int, requests: int, concurrency: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    jobs = [(rnd.randrange(active), i) for i in range(requests)]
+    latencies, errors = [], 0
+
+    with httpx.Client(base_url=url, timeout=60) as client, ThreadPoolExecutor(concurrency) as pool:
+        # Nạp trước các tenant đang dùng; lần nạp đầu không tính vào độ trễ
+        started = time.perf_counter()
+        list(pool.map(lambda t: ask(client, t, n_docs, f"khởi động {seed}"), range(active)))
+        warm_seconds = time.perf_counter() - started
+        warmed = core.tenants.stats()
+
+        start = time.perf_counter()
+        for future in [pool.submit(ask, client, t, n_docs, f"{QUERIES[i % len(QUERIES)]} {seed}-{i}")
+                       for t, i in jobs]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+        elapsed = time.perf_counter() - start
+
+    after = core.tenants.stats()
+    return {
+        "active_tenants": active,
+        "requests": len(latencies),
+        "errors": errors,
+        "warm_seconds": round(warm_seconds, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "loaded_tenants": after["loaded"],
+        "index_memory_mb": round(after["memory_bytes"] / 2 ** 20, 2),
+        # Ngân sách chứa đủ các tenant đang dùng: sau khi nạp trước không phải bỏ tenant nào
+        "fits_budget": warmed["evictions"] == after["evictions"] == 0,
+        "loads": after["loads"] - warmed["loads"],
+        "evictions": after["evictions"] - warmed["evictions"],
+        "rss_mb": rss_mb(),
+    }
+
+
+def check_writes(core, url: str, active: int, n_docs: int) -> dict:
+    """Sửa knowledge base của một tenant: chỉ tenant đó nạp lại index và mất result cache."""
+    with httpx.Client(base_url=url, timeout=60) as client:
+        for t in range(active):
+            ask(client, t, n_docs, "kiểm tra ghi")
+        before = core.tenants.stats()
+        hits = core.result_cache.stats()["hits"]
+
+        # Worker khác sửa tenant 0 (cùng file KB_VERSION_PATH, bộ đếm riêng của tenant)
+        KBVersion(os.environ["KB_VERSION_PATH"]).bump(tenant_id(0))
+        for t in range(active):
+            ask(client, t, n_docs, "kiểm tra ghi")
+        remote = core.tenants.stats()
+        assert remote["invalidations"] - before["invalidations"] == 1, remote
+        assert remote["loads"] - before["loads"] == len(core.tenants.loaders), remote
+        # Các tenant khác vẫn trả lời từ result cache
+        assert core.result_cache.stats()["hits"] - hits == active - 1, core.result_cache.stats()
+
+        # Sửa tenant 1 qua API trong process này: index được cập nhật tăng dần, không nạp lại,
+        # và memory_bytes tính lại theo index đã lớn lên
+        response = client.post("/api/create-alias", headers={"X-Tenant": tenant_id(1)},
+                               json={"document_id": n_docs + 1, "alias_text": "câu hỏi mới thêm cho tenant một"})
+        response.raise_for_status()
+        for t in range(active):
+            ask(client, t, n_docs, "kiểm tra ghi")
+        local = core.tenants.stats()
+        assert local["loads"] == remote["loads"] and local["invalidations"] == remote["invalidations"], local
+        assert local["tenants"][tenant_id(1)] > remote["tenants"][tenant_id(1)], local
+    return {"remote_write_loads": remote["loads"] - before["loads"],
+            "local_write_loads": local["loads"] - remote["loads"]}
+
+
+def run(n_tenants: int = 60, n_docs: int = 60, budget_mb: float = 96, requests: int = 400,
+        concurrency: int = 16, steps=(1, 5, 15, 30, 60), max_p99_ms: float = 1000) -> dict:
+    upstreams = FakeUpstreams(dim=DIM)
+    upstreams.tables.update(make_tables(n_tenants, n_docs))
+    config_path = os.path.join(tempfile.mkdtemp(), "tenants.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump({tenant_id(t): {"names": [f"phường {t}"], "warm": t == 0} for t in range(n_tenants)}, f)
+
+    core, url = start_backend(upstreams, TENANTS_PATH=config_path, TENANT_COLUMN="tenant",
+                              SEARCH_BACKEND="local", TENANT_MEMORY_BUDGET_MB=budget_mb)
+    with httpx.Client(base_url=url, timeout=30) as client:
+        assert client.post("/api/chat", headers={"X-Tenant": "khong_ton_tai"},
+                           json={"message": "xin chào"}).status_code == 404
+        # Tiền tố đường dẫn tương đương header
+        response = client.post(f"/t/{tenant_id(1)}/api/chat", json={"message": "hỏi về mục 3"})
+        assert response.json()["replies"][0]["id"] == n_docs + 4, response.json()
+    # Đợi thread nạp sẵn các tenant "warm" của worker xong để nó không chen vào phần đo
+    core.warm_up_indexes()
+
+    phases = [phase(core, url, min(active, n_tenants), n_docs, requests, concurrency, seed)
+              for seed, active in enumerate(steps)]
+    for result in phases:
+        if result["fits_budget"]:
+            assert result["errors"] == 0 and result["loads"] == 0 and result["evictions"] == 0, result
+            assert result["p99_ms"] <= max_p99_ms, result
+    writes = check_writes(core, url, min(max(steps), n_tenants), n_docs) if phases[-1]["fits_budget"] else None
+    return {"tenants": n_tenants, "docs_per_tenant": n_docs, "dim": DIM, "budget_mb": budget_mb,
+            "max_p99_ms": max_p99_ms, "phases": phases, "writes": writes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=60)
+    parser.add_argument("--docs", type=int, default=60)
+    parser.add_argument("--budget-mb", type=float, default=96)
+    parser.add_argument("-n", "--requests", type=int, default=400)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--max-p99-ms", type=float, default=1000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.tenants, args.docs, args.budget_mb, args.requests, args.concurrency,
+                         max_p99_ms=args.max_p99_ms), indent=2))
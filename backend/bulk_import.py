@@ -0,0 +1,339 @@
+import csv
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_codec import to_pgvector
+from search_engine import fetch_tenant_rows
+from utils import normalize_many
+
+# Số input mỗi lần gọi embeddings.create (API nhận tối đa 2048)
+EMBED_BATCH_SIZE = 256
+# Số dòng mỗi lần insert vào bảng alias
+INSERT_CHUNK_SIZE = 500
+EXISTING_PAGE_SIZE = 1000
+# Ghi file trạng thái tối đa một lần mỗi SAVE_INTERVAL giây khi chỉ có bộ đếm thay đổi
+SAVE_INTERVAL = 1.0
+FINISHED = ("done", "failed")
+
+
+def parse_alias_rows(content_type: str, raw: bytes) -> list:
+    """
+    JSON: [{"document_id": ..., "alias_text": ...}, ...] hoặc {"aliases": [...]}
+    CSV (text/csv): dòng đầu là tiêu đề, có cột document_id và alias_text
+    """
+    if "csv" in (content_type or ""):
+        reader = csv.DictReader(io.StringIO(raw.decode("utf-8-sig")))
+        return [dict(row) for row in reader]
+    data = json.loads(raw or b"null")
+    if isinstance(data, dict):
+        data = data.get("aliases")
+    if not isinstance(data, list):
+        raise ValueError('expected a JSON list of {"document_id", "alias_text"} or {"aliases": [...]}')
+    return data
+
+
+def existing_normalized_aliases(supabase, tenant_column: str = None, tenant: str = None) -> set:
+    # Có tenant_column: chỉ alias của các document thuộc tenant, trùng với tenant khác không tính
+    if tenant_column:
+        _, aliases = fetch_tenant_rows(supabase, "id", "id, normalized_alias", tenant_column, tenant)
+        return {row["normalized_alias"] for row in aliases if row.get("normalized_alias")}
+    # Đọc normalized_alias đã có theo từng trang (keyset theo id)
+    seen = set()
+    cursor = None
+    while True:
+        query = supabase.table("alias").select("id, normalized_alias")
+        if cursor is not None:
+            query = query.gt("id", cursor)
+        rows = query.order("id").limit(EXISTING_PAGE_SIZE).execute().data or []
+        seen.update(row["normalized_alias"] for row in rows if row.get("normalized_alias"))
+        if len(rows) < EXISTING_PAGE_SIZE:
+            return seen
+        cursor = rows[-1]["id"]
+
+
+class BulkAliasImport:
+    """
+    Một lần import alias hàng loạt, chạy nền:
+    kiểm tra + normalize -> bỏ trùng normalized_alias -> embedding theo batch -> insert theo chunk.
+    Lỗi được ghi theo số thứ tự dòng (tính từ 1) trong dữ liệu gửi lên.
+    """
+
+    def __init__(self, rows: list, status_dir: str = None, save_interval: float = SAVE_INTERVAL):
+        self.id = uuid.uuid4().hex
+        self.rows = rows
+        self.status_dir = status_dir
+        self.save_interval = save_interval
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+        self.status = {
+            "id": self.id,
+            "status": "queued",
+            "total": len(rows),
+            "valid": 0,
+            "duplicates": 0,
+            "embedded": 0,
+            "inserted": 0,
+            "failed": 0,
+            "errors": [],
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        self._save(force=True)
+
+    def _add(self, errors=(), **counts) -> None:
+        with self._lock:
+            for key, value in counts.items():
+                self.status[key] += value
+            self.status["errors"].extend(errors)
+            self.status["failed"] += len(errors)
+            self._save()
+
+    def _set(self, **fields) -> None:
+        # Đổi trạng thái (running/done/failed) luôn được ghi ngay
+        with self._lock:
+            self.status.update(fields)
+            self._save(force=True)
+
+    def _save(self, force: bool = False) -> None:
+        # Ghi trạng thái ra file để worker gunicorn khác cũng trả lời được GET status;
+        # bộ đếm tăng liên tục nên chỉ ghi lại sau save_interval giây
+        if not self.status_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at < self.save_interval:
+            return
+        self._saved_at = now
+        path = os.path.join(self.status_dir, f"{self.id}.json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.status, f, ensure_ascii=False, default=str)
+        os.replace(tmp, path)
+
+    def path(self) -> str:
+        return os.path.join(self.status_dir, f"{self.id}.json") if self.status_dir else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.status, "errors": list(self.status["errors"])}
+
+    def run(self, supabase, embed_batch, embedding_cache, model: str, on_saved, concurrency: int = 4,
+            tenant_column: str = None, tenant: str = None) -> None:
+        """
+        embed_batch(texts) -> list vector, một lần gọi API cho cả list
+        on_saved(row) được gọi cho từng alias đã insert (cập nhật index trong RAM)
+        tenant_column/tenant: chỉ bỏ trùng với alias đã có của tenant đó
+        """
+        self._set(status="running", started_at=time.time())
+        try:
+            pending = self._prepare(existing_normalized_aliases(supabase, tenant_column, tenant))
+            vectors = self._embed(pending, embed_batch, embedding_cache, model, concurrency)
+            self._insert(pending, vectors, supabase, on_saved, concurrency)
+            self._set(status="done", finished_at=time.time())
+        except Exception as e:
+            self._set(status="failed", error=str(e), finished_at=time.time())
+
+    def _prepare(self, existing: set) -> list:
+        texts = [row.get("alias_text") if isinstance(row, dict) else None for row in self.rows]
+        texts = [text.strip() if isinstance(text, str) else "" for text in texts]
+        normalized = normalize_many(texts)
+
+        errors = []
+        pending = []
+        duplicates = 0
+        seen = set(existing)
+        for i, (row, text, norm) in enumerate(zip(self.rows, texts, normalized), start=1):
+            if not text:
+                errors.append({"row": i, "error": "alias_text is required"})
+                continue
+            if norm in seen:
+                duplicates += 1
+                continue
+            seen.add(norm)
+            pending.append({
+                "row": i,
+                "document_id": row.get("document_id") or None,
+                "alias_text": text,
+                "normalized_alias": norm,
+            })
+        self._add(errors, valid=len(pending), duplicates=duplicates)
+        return pending
+
+    def _embed(self, pending, embed_batch, embedding_cache, model, concurrency) -> dict:
+        vectors = {}
+        missing = []
+        for item in pending:
+            # Vector được ghi xuống Supabase: chỉ nhận bản không mất mát trong cache
+            embedding = embedding_cache.get(model, item["alias_text"], exact=True)
+            if embedding is None:
+                missing.append(item)
+            else:
+                vectors[item["row"]] = embedding
+        self._add(embedded=len(vectors))
+
+        def embed_chunk(chunk):
+            try:
+                result = embed_batch([item["alias_text"] for item in chunk])
+            except Exception as e:
+                self._add([{"row": item["row"], "error": f"embedding failed: {e}"} for item in chunk])
+                return {}
+            for item, embedding in zip(chunk, result):
+                embedding_cache.set(model, item["alias_text"], embedding, exact=True)
+            self._add(embedded=len(chunk))
+            return {item["row"]: embedding for item, embedding in zip(chunk, result)}
+
+        chunks = [missing[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)]
+        with ThreadPoolExecutor(max(1, concurrency)) as pool:
+            for result in pool.map(embed_chunk, chunks):
+                vectors.update(result)
+        return vectors
+
+    def _insert(self, pending, vectors, supabase, on_saved, concurrency) -> None:
+        records = [(item["row"], {
+            "document_id": item["document_id"],
+            "alias_text": item["alias_text"],
+            "normalized_alias": item["normalized_alias"],
+            "embedding": to_pgvector(vectors[item["row"]]),
+        }) for item in pending if item["row"] in vectors]
+
+        def insert_chunk(chunk):
+            errors = []
+            try:
+                data = supabase.table("alias").insert([record for _, record in chunk]).execute().data or []
+                saved = list(zip((record for _, record in chunk), data))
+            except Exception:
+                # Cả chunk lỗi (vd. document_id không tồn tại): thử lại từng dòng để biết dòng nào hỏng
+                saved = []
+                for row_number, record in chunk:
+                    try:
+                        data = supabase.table("alias").insert(record).execute().data or []
+                        saved.extend((record, row) for row in data)
+                    except Exception as e:
+                        errors.append({"row": row_number, "error": str(e)})
+            for record, row in saved:
+                on_saved({**record, **row})
+            self._add(errors, inserted=len(saved))
+
+        chunks = [records[i:i + INSERT_CHUNK_SIZE] for i in range(0, len(records), INSERT_CHUNK_SIZE)]
+        with ThreadPoolExecutor(max(1, concurrency)) as pool:
+            list(pool.map(insert_chunk, chunks))
+
+
+class BulkImportJobs:
+    """
+    Nhận job import và chạy trên thread nền; request HTTP chỉ tạo job rồi trả về ngay.
+    Số job chạy cùng lúc bị giới hạn để không dồn quá nhiều lời gọi OpenAI/Supabase.
+    Job đã xong quá ttl giây bị bỏ khỏi RAM và file trạng thái của nó bị xóa.
+    """
+
+    def __init__(self, status_dir: str = None, max_running: int = 1, ttl: float = 86400.0):
+        self.status_dir = status_dir
+        if status_dir:
+            os.makedirs(status_dir, exist_ok=True)
+        self.max_running = max_running
+        self.ttl = ttl
+        self.evicted = 0
+        self._jobs = {}
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            status_dir=os.getenv("BULK_IMPORT_STATUS_DIR", "bulk_import_jobs") or None,
+            max_running=int(os.getenv("BULK_IMPORT_MAX_JOBS", "1")),
+            ttl=float(os.getenv("BULK_IMPORT_JOB_TTL_SECONDS", "86400")),
+        )
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Tạo trong từng process (an toàn khi gunicorn fork)
+        if self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.max_running, thread_name_prefix="bulk-import")
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def submit(self, rows: list, run) -> BulkAliasImport:
+        # run(job) chạy trên thread nền
+        self.prune()
+        job = BulkAliasImport(rows, self.status_dir)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool().submit(run, job)
+        return job
+
+    def _expired(self, status: dict, now: float) -> bool:
+        return status.get("status") in FINISHED and (status.get("finished_at") or now) < now - self.ttl
+
+    def prune(self) -> None:
+        """Bỏ các job đã xong quá ttl giây (cả job của worker khác, qua file trạng thái)."""
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if self._expired(job.status, now)]
+            for job in expired:
+                del self._jobs[job.id]
+        paths = [job.path() for job in expired if job.path()]
+        if self.status_dir:
+            try:
+                names = os.listdir(self.status_dir)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                path = os.path.join(self.status_dir, name)
+                if not name.endswith(".json") or path in paths:
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        status = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if self._expired(status, now):
+                    paths.append(path)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.evicted += len(expired)
+
+    def get(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is not None and self._expired(job.status, time.time()):
+            self.prune()
+            return None
+        if job is not None:
+            return job.snapshot()
+        # Job do worker khác nhận: đọc file trạng thái
+        if self.status_dir and re.fullmatch(r"[0-9a-f]{32}", job_id):
+            path = os.path.join(self.status_dir, f"{job_id}.json")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    status = json.load(f)
+            except FileNotFoundError:
+                return None
+            if self._expired(status, time.time()):
+                self.prune()
+                return None
+            return status
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        states = [job.status["status"] for job in jobs]
+        return {
+            "jobs": len(jobs),
+            "queued": states.count("queued"),
+            "running": states.count("running"),
+            "evicted": self.evicted,
+        }
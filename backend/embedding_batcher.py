@@ -0,0 +1,171 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from openai import BadRequestError
+
+from embedding_cache import EMBEDDING_MODEL
+
+
+class _Item:
+    __slots__ = ("text", "future", "enqueued_at")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class EmbeddingBatcher:
+    """
+    Gom các text cần embedding từ nhiều request trong một cửa sổ ngắn (window)
+    hoặc tới khi đủ max_batch, rồi gửi một lần embeddings.create với cả danh sách.
+
+    Mỗi caller nhận Future của riêng mình. Nếu batch bị từ chối vì input không hợp lệ
+    (400), từng text được gửi lại riêng để lỗi chỉ rơi vào đúng text gây ra nó; các lỗi
+    khác (rate limit, mất kết nối, timeout) làm hỏng cả batch, không nhân số request
+    lên. Dùng được từ thread (embed) và từ event loop (asyncio.wrap_future(submit(...))).
+    """
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL, window: float = 0.005,
+                 max_batch: int = 64, max_concurrency: int = 8):
+        self.client = client
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        self._queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.max_batch_seen = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    @classmethod
+    def from_env(cls, client):
+        return cls(
+            client,
+            window=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000,
+            max_batch=int(os.getenv("EMBEDDING_BATCH_MAX", "64")),
+            max_concurrency=int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "8")),
+        )
+
+    def _ensure_started(self) -> None:
+        # Khởi động thread khi dùng lần đầu trong mỗi process (an toàn khi gunicorn fork)
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="embed-batch")
+            threading.Thread(target=self._collect, name="embed-batcher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, text: str) -> Future:
+        item = _Item(text)
+        if not text or not text.strip():
+            item.future.set_exception(ValueError("text to embed is empty"))
+            return item.future
+        self._ensure_started()
+        self._queue.put(item)
+        return item.future
+
+    def embed(self, text: str):
+        return self.submit(text).result()
+
+    def _collect(self) -> None:
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            deadline = first.enqueued_at + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list) -> None:
+        # Bỏ các text mà caller đã hủy trước khi batch được gửi
+        batch = [item for item in batch if not item.future.done()]
+        if not batch:
+            return
+        now = time.monotonic()
+        delays = [now - item.enqueued_at for item in batch]
+        with self._stats_lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.total_queue_delay += sum(delays)
+            self.max_queue_delay = max(self.max_queue_delay, max(delays))
+
+        texts = list(dict.fromkeys(item.text for item in batch))
+        try:
+            vectors = self._create(texts)
+        except Exception as e:
+            if len(texts) == 1 or not isinstance(e, BadRequestError):
+                self._fail(batch, e)
+                return
+            # Gửi lại song song từng text để chỉ text lỗi nhận exception
+            vectors = {}
+            with ThreadPoolExecutor(min(len(texts), self.max_concurrency)) as retry_pool:
+                retries = {text: retry_pool.submit(self._create, [text]) for text in texts}
+            for text, retry in retries.items():
+                try:
+                    vectors.update(retry.result())
+                except Exception as item_error:
+                    self._fail([item for item in batch if item.text == text], item_error)
+
+        for item in batch:
+            if item.future.done():
+                continue
+            if item.text in vectors:
+                self._resolve(item.future, result=vectors[item.text])
+            else:
+                self._fail([item], RuntimeError("embedding missing from batch response"))
+
+    def _create(self, texts: list) -> dict:
+        response = self.client.embeddings.create(model=self.model, input=texts)
+        return {texts[d.index]: d.embedding for d in response.data}
+
+    def _fail(self, items: list, error: Exception) -> None:
+        with self._stats_lock:
+            self.errors += len(items)
+        for item in items:
+            self._resolve(item.future, error=error)
+
+    @staticmethod
+    def _resolve(future: Future, result=None, error=None) -> None:
+        # Caller có thể hủy Future bất cứ lúc nào (asyncio cancel)
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "errors": self.errors,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_queue_delay_ms": round(self.total_queue_delay / self.items * 1000, 3) if self.items else 0.0,
+                "max_queue_delay_ms": round(self.max_queue_delay * 1000, 3),
+                "pending": self._queue.qsize(),
+            }
@@ -0,0 +1,260 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_codec import blob_codec, from_bytes, to_bytes
+from utils import normalize_text
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# PRAGMA user_version của file SQLite: 0 = vector float32 thô, 2 = blob của embedding_codec.to_bytes,
+# 3 = thêm cột accessed_at cho việc dọn theo LRU
+SCHEMA_VERSION = 3
+MIGRATE_BATCH = 1000
+# Dọn xuống còn tỉ lệ này của giới hạn, để không phải dọn lại ngay ở lần kiểm tra sau
+PRUNE_TARGET = 0.9
+
+
+class EmbeddingCache:
+    """
+    Cache embedding theo (model, normalize_text(text)), hai tầng:
+    - LRU trong process, giới hạn số phần tử và TTL
+    - SQLite trên đĩa (WAL), giữ qua restart và dùng chung giữa các gunicorn worker,
+      giới hạn theo số dòng và số byte: tối đa mỗi prune_interval giây một lần ghi
+      sẽ xóa các dòng có accessed_at cũ nhất. accessed_at được cập nhật khi đọc
+      trúng trên đĩa; vector nóng nằm ở tầng RAM nên chỉ chậm tối đa khoảng TTL.
+
+    Cả hai tầng lưu vector đã mã hóa theo codec (xem embedding_codec.py) thay vì
+    list float Python: float16 tốn 3 KB cho 1536 chiều, list tốn khoảng 50 KB.
+    Vector được ghi xuống Supabase lấy và lưu với exact=True: bản đó luôn được giữ
+    float32 và chỉ bản float32 mới được tính là hit, để giá trị lưu không phụ thuộc
+    vào trạng thái cache.
+    """
+
+    def __init__(self, db_path: str = None, max_items: int = 10000, ttl: float = 3600, codec: str = "float16",
+                 disk_max_rows: int = 100000, disk_max_bytes: int = 512 * 1024 * 1024,
+                 prune_interval: float = 60):
+        self.db_path = db_path
+        self.max_items = max_items
+        self.ttl = ttl
+        self.codec = codec
+        # 0: không giới hạn
+        self.disk_max_rows = disk_max_rows
+        self.disk_max_bytes = disk_max_bytes
+        self.prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+        self._memory_bytes = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_pruned = 0
+        self.prune_errors = 0
+        self.last_error = None
+
+        if self.db_path:
+            self._migrate()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            db_path=os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3") or None,
+            max_items=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("EMBEDDING_CACHE_TTL", "3600")),
+            codec=os.getenv("EMBEDDING_CACHE_CODEC", "float16"),
+            disk_max_rows=int(os.getenv("EMBEDDING_CACHE_DISK_MAX_ROWS", "100000")),
+            disk_max_bytes=int(float(os.getenv("EMBEDDING_CACHE_DISK_MAX_MB", "512")) * 1024 * 1024),
+            prune_interval=float(os.getenv("EMBEDDING_CACHE_PRUNE_INTERVAL", "60")),
+        )
+
+    def _db(self):
+        # sqlite3 connection không dùng chung giữa các thread được
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self) -> None:
+        # BEGIN IMMEDIATE: nhiều worker khởi động cùng lúc chỉ một worker chuyển đổi
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'embeddings'").fetchone()
+            if exists is None:
+                conn.execute(
+                    "CREATE TABLE embeddings ("
+                    " model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL,"
+                    " created_at REAL NOT NULL, accessed_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (model, key))"
+                )
+                version = SCHEMA_VERSION
+            if version < 2:
+                # Bảng cũ lưu float32 thô: đóng gói lại thành blob float32 (không mất mát)
+                cursor = 0
+                while True:
+                    rows = conn.execute(
+                        "SELECT rowid, vector FROM embeddings WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (cursor, MIGRATE_BATCH),
+                    ).fetchall()
+                    if not rows:
+                        break
+                    conn.executemany(
+                        "UPDATE embeddings SET vector = ? WHERE rowid = ?",
+                        [(to_bytes(np.frombuffer(vector, dtype="<f4"), "float32"), rowid) for rowid, vector in rows],
+                    )
+                    cursor = rows[-1][0]
+            if version < 3:
+                # DEFAULT để worker bản cũ (INSERT không có accessed_at) vẫn ghi được
+                conn.execute("ALTER TABLE embeddings ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE embeddings SET accessed_at = created_at")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_memory(self, model: str, text: str):
+        """Chỉ tra tầng trong process (không đụng SQLite); None nếu không có, không tính là miss."""
+        return self._get_memory((model, normalize_text(text)))
+
+    def _get_memory(self, key, exact: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                blob, expires_at = entry
+                if exact and blob_codec(blob) != "float32":
+                    return None
+                if expires_at > now:
+                    self._lru.move_to_end(key)
+                    self.memory_hits += 1
+                    return from_bytes(blob).tolist()
+                del self._lru[key]
+                self._memory_bytes -= len(blob)
+        return None
+
+    def get(self, model: str, text: str, exact: bool = False):
+        """exact=True: chỉ trả vector lưu không mất mát (float32), dùng cho vector sẽ được ghi lại."""
+        key = (model, normalize_text(text))
+        embedding = self._get_memory(key, exact)
+        if embedding is not None:
+            return embedding
+
+        if self.db_path:
+            row = self._db().execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND key = ?", key
+            ).fetchone()
+            if row is not None and (not exact or blob_codec(row[0]) == "float32"):
+                self._db().execute(
+                    "UPDATE embeddings SET accessed_at = ? WHERE model = ? AND key = ?", (time.time(), *key)
+                )
+                self._remember(key, row[0])
+                with self._lock:
+                    self.disk_hits += 1
+                return from_bytes(row[0]).tolist()
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, model: str, text: str, embedding, exact: bool = False) -> None:
+        # exact=True: lưu float32 để get(..., exact=True) sau đó trúng cache
+        key = (model, normalize_text(text))
+        blob = to_bytes(embedding, "float32" if exact else self.codec)
+        self._remember(key, blob)
+        if self.db_path:
+            now = time.time()
+            self._db().execute(
+                "INSERT OR REPLACE INTO embeddings (model, key, vector, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (*key, blob, now, now),
+            )
+            self._maybe_prune()
+
+    def _maybe_prune(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = time.monotonic()
+        try:
+            self.prune()
+        except sqlite3.Error as e:
+            # Không làm hỏng request: lần ghi sau (sau prune_interval) thử lại
+            with self._lock:
+                self.prune_errors += 1
+                self.last_error = str(e)
+
+    def prune(self) -> int:
+        """
+        Xóa các dòng có accessed_at cũ nhất cho tới khi tầng SQLite còn dưới PRUNE_TARGET
+        của disk_max_rows/disk_max_bytes (số byte ước lượng theo kích thước vector trung
+        bình). Trả về số dòng đã xóa. Trang trống được SQLite dùng lại, file không phình thêm.
+        """
+        if not self.db_path or not (self.disk_max_rows or self.disk_max_bytes):
+            return 0
+        conn = self._db()
+        # BEGIN IMMEDIATE: nhiều worker dọn cùng lúc không xóa trùng phần vượt
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+            excess = 0
+            if self.disk_max_rows and rows > self.disk_max_rows:
+                excess = rows - int(self.disk_max_rows * PRUNE_TARGET)
+            if self.disk_max_bytes and size > self.disk_max_bytes:
+                excess = max(excess, rows - int(self.disk_max_bytes * PRUNE_TARGET / (size / rows)))
+            if excess:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN"
+                    " (SELECT rowid FROM embeddings ORDER BY accessed_at LIMIT ?)", (excess,)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self.disk_pruned += excess
+        return excess
+
+    def _remember(self, key, blob: bytes) -> None:
+        blob = bytes(blob)
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old[0])
+            self._lru[key] = (blob, time.monotonic() + self.ttl)
+            self._memory_bytes += len(blob)
+            while len(self._lru) > self.max_items:
+                _, (evicted, _) = self._lru.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def embed(self, text: str, compute, model: str = EMBEDDING_MODEL, exact: bool = False):
+        # compute(text) -> vector, chỉ được gọi khi cả hai tầng cache đều miss
+        embedding = self.get(model, text, exact)
+        if embedding is None:
+            embedding = compute(text)
+            self.set(model, text, embedding, exact)
+        return embedding
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+                "memory_items": len(self._lru),
+                "memory_bytes": self._memory_bytes,
+                "disk_pruned": self.disk_pruned,
+                "prune_errors": self.prune_errors,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,108 @@
+"""
+Mã hóa embedding gọn cho lưu trữ và truyền tải.
+
+Codec:
+    float32  4 byte/chiều, không mất mát
+    float16  2 byte/chiều
+    int8     1 byte/chiều + 1 scale float32 cho mỗi vector (đối xứng: x ≈ code * scale)
+
+Định dạng nhị phân (to_bytes/from_bytes), base64 khi cần đi qua JSON (encode/decode):
+
+    b"EV" | codec (uint8) | 0 (uint8) | dim (uint32) | scale (float32) | dữ liệu
+
+to_pgvector() tạo chuỗi "[...]" cho cột vector của Supabase: pgvector lưu float4,
+nên 9 chữ số có nghĩa là đủ để không mất gì mà ngắn hơn nhiều so với JSON list
+float Python.
+"""
+import base64
+import struct
+
+import numpy as np
+
+CODECS = ("float32", "float16", "int8")
+CODEC_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2"), "int8": np.dtype("i1")}
+MAGIC = b"EV"
+HEADER = struct.Struct("<2sBBIf")
+# Số hàng đổi sang float32 mỗi lần khi tính điểm trên ma trận float16/int8
+SCORE_BLOCK_ROWS = 4096
+
+
+def quantize(vector, codec: str = "float16"):
+    """Trả về (codes, scale); scale chỉ có nghĩa với int8, các codec khác là 1.0."""
+    vector = np.asarray(vector, dtype=np.float32)
+    if codec == "int8":
+        peak = float(np.abs(vector).max(initial=0.0))
+        scale = peak / 127 if peak > 0 else 1.0
+        return np.clip(np.rint(vector / scale), -127, 127).astype(np.int8), scale
+    return vector.astype(CODEC_DTYPES[codec]), 1.0
+
+
+def dequantize(codes, scale: float = 1.0) -> np.ndarray:
+    vector = np.asarray(codes).astype(np.float32)
+    if codes.dtype == np.int8:
+        vector *= np.float32(scale)
+    return vector
+
+
+def quantize_matrix(matrix, codec: str = "float16"):
+    """(n, dim) float32 -> (codes, scales); scales là None trừ khi codec là int8."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if codec != "int8":
+        return matrix.astype(CODEC_DTYPES[codec]), None
+    peaks = np.abs(matrix).max(axis=1) if len(matrix) else np.zeros(0, dtype=np.float32)
+    scales = np.where(peaks > 0, peaks / 127, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def dot_scores(codes, scales, query) -> np.ndarray:
+    """
+    codes @ query cho ma trận đã lượng tử hóa, không giải nén cả ma trận:
+    đổi từng khối hàng sang float32 để vẫn dùng BLAS, rồi nhân scale theo hàng.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    if codes.dtype == np.float32:
+        return codes @ query
+    n = len(codes)
+    scores = np.empty(n, dtype=np.float32)
+    for start in range(0, n, SCORE_BLOCK_ROWS):
+        stop = min(start + SCORE_BLOCK_ROWS, n)
+        scores[start:stop] = codes[start:stop].astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales[:n]
+    return scores
+
+
+def to_bytes(vector, codec: str = "float16") -> bytes:
+    codes, scale = quantize(vector, codec)
+    return HEADER.pack(MAGIC, CODECS.index(codec), 0, len(codes), scale) + codes.tobytes()
+
+
+def blob_codec(blob: bytes) -> str:
+    """Codec của blob tạo bởi to_bytes; chỉ float32 là không mất mát."""
+    magic, codec_id = HEADER.unpack_from(blob)[:2]
+    if magic != MAGIC:
+        raise ValueError("not an encoded embedding")
+    return CODECS[codec_id]
+
+
+def from_bytes(blob: bytes) -> np.ndarray:
+    blob = bytes(blob)
+    magic, codec_id, _, dim, scale = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("not an encoded embedding")
+    codes = np.frombuffer(blob, dtype=CODEC_DTYPES[CODECS[codec_id]], count=dim, offset=HEADER.size)
+    return dequantize(codes, scale)
+
+
+def encode(vector, codec: str = "float16") -> str:
+    return base64.b64encode(to_bytes(vector, codec)).decode("ascii")
+
+
+def decode(text: str) -> np.ndarray:
+    return from_bytes(base64.b64decode(text))
+
+
+def to_pgvector(vector) -> str:
+    values = np.asarray(vector, dtype=np.float32).tolist()
+    return "[" + ",".join(f"{x:.9g}" for x in values) + "]"
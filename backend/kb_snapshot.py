@@ -0,0 +1,372 @@
+"""
+Snapshot knowledge base trên đĩa, mở bằng numpy.memmap để mọi gunicorn worker
+dùng chung cùng một vùng page cache thay vì mỗi worker tự nạp từ Supabase.
+
+    python kb_snapshot.py export --out kb_snapshot.bin [--dtype float16|int8] [--tenant xa_ba_diem]
+    python kb_snapshot.py info kb_snapshot.bin
+
+Bố cục file (little-endian, mỗi section căn lề 64 byte):
+
+    MAGIC (8 byte) | độ dài header (uint32) | header JSON | section ...
+
+Header ghi format, kb_version lúc export, tenant và cột tenant đã lọc (null: cả bảng),
+dim, dtype, số documents/alias, kiểu id và vị trí (offset, dtype, shape) của từng section:
+
+    embeddings            (n_rows, dim) float32|float16|int8, đã chuẩn hóa L2;
+                          hàng 0..n_docs-1 là documents, tiếp theo là alias
+    embedding_scales      (n_rows,) float32, chỉ có với int8 (xem embedding_codec.py)
+    row_doc               (n_rows,) int32, hàng -> chỉ số document
+    row_text.*            text dùng cho BM25 của từng hàng
+    documents.is_active   (n_docs,) int8: 1 / 0 / -1 (null)
+    <bảng>.<cột>.offsets  (n+1,) int64, vị trí trong section text
+    <bảng>.<cột>.null     (n,) uint8
+    text                  UTF-8 của mọi cột chuỗi, nối liền nhau
+
+Export ghi ra file tạm rồi os.replace, nên worker đang đọc không bao giờ thấy
+file dở dang; SnapshotFile nhận ra file mới qua stat và mở lại (hot-swap).
+Snapshot chỉ được dùng khi kb_version của nó không cũ hơn phiên bản hiện tại,
+nên sau khi admin sửa dữ liệu cần export lại (vd. chạy định kỳ).
+"""
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from embedding_codec import quantize_matrix
+from search_engine import fetch_tenant_rows, parse_embedding
+from tenants import DEFAULT_TENANT
+from utils import normalize_text
+
+MAGIC = b"KBSNAP\x00\x01"
+FORMAT_VERSION = 1
+ALIGN = 64
+
+TEXT_COLUMNS = {
+    "documents": ("id", "procedure_name", "text_content", "normalized_text", "category", "subject",
+                  "effective_date"),
+    "alias": ("id", "document_id", "alias_text", "normalized_alias"),
+}
+EXPORT_COLUMNS = {
+    "documents": "id, procedure_name, text_content, normalized_text, category, subject, is_active, "
+                 "effective_date, embedding",
+    "alias": "id, document_id, alias_text, normalized_alias, embedding",
+}
+
+
+# --- Ghi ---
+
+class _Writer:
+
+    def __init__(self):
+        self.sections = {}
+        self.blobs = []
+        self.text = bytearray()
+
+    def add(self, name: str, array: np.ndarray) -> None:
+        array = np.ascontiguousarray(array)
+        self.sections[name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        self.blobs.append((name, array))
+
+    def add_text(self, name: str, values: list) -> None:
+        offsets = np.zeros(len(values) + 1, dtype="<i8")
+        offsets[0] = len(self.text)
+        nulls = np.zeros(len(values), dtype=np.uint8)
+        for i, value in enumerate(values):
+            if value is None:
+                nulls[i] = 1
+            else:
+                self.text += str(value).encode("utf-8")
+            offsets[i + 1] = len(self.text)
+        self.add(f"{name}.offsets", offsets)
+        self.add(f"{name}.null", nulls)
+
+    def write(self, path: str, header: dict) -> None:
+        self.add("text", np.frombuffer(bytes(self.text), dtype=np.uint8))
+
+        # Header có offset của chính các section, nên tính offset với header đủ dài rồi mới ghi
+        def layout(header_len):
+            offset = _align(len(MAGIC) + 4 + header_len)
+            for name, array in self.blobs:
+                self.sections[name]["offset"] = offset
+                offset = _align(offset + array.nbytes)
+
+        header = {**header, "sections": self.sections}
+        header_len = len(json.dumps(header).encode()) + 1024
+        layout(header_len)
+        encoded = json.dumps(header).encode()
+        assert len(encoded) <= header_len
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(encoded)) + encoded)
+            for name, array in self.blobs:
+                f.seek(self.sections[name]["offset"])
+                f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _id_type(ids: list) -> str:
+    return "int" if all(isinstance(i, int) for i in ids) else "str"
+
+
+def export_snapshot(path: str, documents: list, aliases: list, dtype: str = "float32",
+                    kb_version: int = 0, dim: int = None, tenant: str = None, tenant_column: str = None) -> dict:
+    """Ghi snapshot từ các dòng của bảng documents và alias; trả về header."""
+    doc_index = {doc["id"]: i for i, doc in enumerate(documents)}
+    # Alias chưa gắn document nào thì không bao giờ được trả về (giống LocalSearchEngine)
+    aliases = [alias for alias in aliases if alias.get("document_id") in doc_index]
+
+    vectors = [parse_embedding(row.get("embedding")) for row in (*documents, *aliases)]
+    if dim is None:
+        dim = next((len(v) for v in vectors if v is not None), 1536)
+    matrix = np.zeros((len(vectors), dim), dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        if vector is not None:
+            norm = float(np.linalg.norm(vector))
+            if norm > 0:
+                matrix[row] = vector / norm
+
+    writer = _Writer()
+    codes, scales = quantize_matrix(matrix, dtype)
+    writer.add("embeddings", codes)
+    if scales is not None:
+        writer.add("embedding_scales", scales.astype("<f4"))
+    writer.add("row_doc", np.array([doc_index[doc["id"]] for doc in documents]
+                                   + [doc_index[alias["document_id"]] for alias in aliases], dtype="<i4"))
+    writer.add("documents.is_active", np.array(
+        [-1 if doc.get("is_active") is None else int(bool(doc["is_active"])) for doc in documents], dtype=np.int8))
+
+    for table, rows in (("documents", documents), ("alias", aliases)):
+        for column in TEXT_COLUMNS[table]:
+            writer.add_text(f"{table}.{column}", [row.get(column) for row in rows])
+    # Text BM25 của từng hàng, tính sẵn để worker không phải normalize lại
+    writer.add_text("row_text", [doc.get("normalized_text") or normalize_text(doc.get("text_content") or "")
+                                 for doc in documents]
+                    + [alias.get("normalized_alias") or normalize_text(alias.get("alias_text") or "")
+                       for alias in aliases])
+
+    header = {
+        "format": FORMAT_VERSION,
+        "created_at": time.time(),
+        "kb_version": kb_version,
+        "tenant": tenant,
+        "tenant_column": tenant_column,
+        "dim": dim,
+        "dtype": np.dtype(dtype).name,
+        "documents": len(documents),
+        "aliases": len(aliases),
+        "id_types": {"documents": _id_type([doc["id"] for doc in documents]),
+                     "alias": _id_type([alias["id"] for alias in aliases])},
+    }
+    writer.write(path, header)
+    return header
+
+
+# --- Đọc ---
+
+class TextColumn:
+
+    def __init__(self, snapshot, name: str, kind: str = "str"):
+        self._text = snapshot.section("text")
+        self._offsets = snapshot.section(f"{name}.offsets")
+        self._null = snapshot.section(f"{name}.null")
+        self._convert = int if kind == "int" else str
+
+    def __len__(self) -> int:
+        return len(self._null)
+
+    def __getitem__(self, i: int):
+        if self._null[i]:
+            return None
+        value = bytes(self._text[self._offsets[i]:self._offsets[i + 1]]).decode("utf-8")
+        return self._convert(value) if self._convert is int else value
+
+    def tolist(self) -> list:
+        return [self[i] for i in range(len(self))]
+
+
+class SnapshotRows:
+    """
+    Mapping id -> dict của một bảng, đọc lười từ snapshot (không giữ bản sao
+    text trong RAM của worker). Dòng được cập nhật sau khi mở snapshot nằm
+    trong một dict riêng, ưu tiên hơn dữ liệu trong file.
+    """
+
+    def __init__(self, snapshot, table: str):
+        self._snapshot = snapshot
+        self._table = table
+        self._index = snapshot.id_index(table)
+        self._overlay = {}
+
+    def _read(self, i: int) -> dict:
+        row = {column: self._snapshot.column(self._table, column)[i] for column in TEXT_COLUMNS[self._table]}
+        if self._table == "documents":
+            active = int(self._snapshot.section("documents.is_active")[i])
+            row["is_active"] = None if active < 0 else bool(active)
+        return row
+
+    def get(self, key, default=None):
+        if key in self._overlay:
+            return self._overlay[key]
+        i = self._index.get(key)
+        return default if i is None else self._read(i)
+
+    def __getitem__(self, key):
+        row = self.get(key)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def __setitem__(self, key, row) -> None:
+        self._overlay[key] = row
+
+    def __contains__(self, key) -> bool:
+        return key in self._overlay or key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index.keys() | self._overlay.keys())
+
+
+class KBSnapshot:
+
+    def __init__(self, path: str):
+        self.path = path
+        # mode "c": trang chỉ bị sao chép riêng cho process khi bị ghi (cập nhật tăng dần)
+        self._mm = np.memmap(path, dtype=np.uint8, mode="c")
+        if bytes(self._mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a knowledge base snapshot")
+        (header_len,) = struct.unpack("<I", bytes(self._mm[len(MAGIC):len(MAGIC) + 4]))
+        start = len(MAGIC) + 4
+        self.header = json.loads(bytes(self._mm[start:start + header_len]))
+        if self.header["format"] != FORMAT_VERSION:
+            raise ValueError(f"unsupported snapshot format {self.header['format']}")
+
+        self.kb_version = self.header["kb_version"]
+        self.tenant = self.header.get("tenant")
+        self.tenant_column = self.header.get("tenant_column")
+        self.dim = self.header["dim"]
+        self.n_documents = self.header["documents"]
+        self.n_aliases = self.header["aliases"]
+        self.n_rows = self.n_documents + self.n_aliases
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._ids = {}
+
+    def section(self, name: str) -> np.ndarray:
+        spec = self.header["sections"][name]
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        start = spec["offset"]
+        return self._mm[start:start + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self.section("embeddings")
+
+    def column(self, table: str, name: str) -> TextColumn:
+        key = (table, name)
+        column = self._columns.get(key)
+        if column is None:
+            kind = "str"
+            if name == "id":
+                kind = self.header["id_types"][table]
+            elif (table, name) == ("alias", "document_id"):
+                kind = self.header["id_types"]["documents"]
+            column = self._columns[key] = TextColumn(self, f"{table}.{name}", kind)
+        return column
+
+    def ids(self, table: str) -> list:
+        with self._lock:
+            if table not in self._ids:
+                self._ids[table] = self.column(table, "id").tolist()
+            return self._ids[table]
+
+    def id_index(self, table: str) -> dict:
+        return {row_id: i for i, row_id in enumerate(self.ids(table))}
+
+    def rows(self, table: str) -> SnapshotRows:
+        return SnapshotRows(self, table)
+
+    def row_texts(self) -> TextColumn:
+        return TextColumn(self, "row_text")
+
+    def info(self) -> dict:
+        info = {k: v for k, v in self.header.items() if k != "sections"}
+        info.update(path=self.path, bytes=len(self._mm))
+        return info
+
+
+class SnapshotFile:
+    """
+    Theo dõi một đường dẫn snapshot; export mới thay file bằng os.replace,
+    current() nhận ra qua stat và mở file mới. Snapshot cũ vẫn dùng được cho
+    tới khi không còn ai giữ tham chiếu.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._snapshot = None
+
+    def key(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def current(self):
+        key = self.key()
+        with self._lock:
+            if key != self._stat:
+                self._snapshot = KBSnapshot(self.path) if key is not None else None
+                self._stat = key
+            return self._snapshot
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Snapshot knowledge base dùng chung giữa các worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="export từ bảng documents và alias trên Supabase")
+    export.add_argument("--out", default=os.getenv("KB_SNAPSHOT_PATH") or "kb_snapshot.bin")
+    export.add_argument("--dtype", choices=("float32", "float16", "int8"), default="float32")
+    export.add_argument("--tenant", default=DEFAULT_TENANT)
+    export.add_argument("--tenant-column", default=os.getenv("TENANT_COLUMN", ""),
+                        help="cột lọc tenant trong bảng documents (bỏ trống: cả bảng)")
+    info = sub.add_parser("info", help="in header của snapshot")
+    info.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        print(json.dumps(KBSnapshot(args.path).info(), ensure_ascii=False, indent=2))
+        return
+
+    import corn
+    from kb_version import KBVersion
+
+    # Đọc phiên bản trước khi lấy dữ liệu: sửa đổi xen giữa sẽ làm snapshot bị coi là cũ
+    tenant_column = args.tenant_column or None
+    version = KBVersion(os.getenv("KB_VERSION_PATH", "kb_version")).current(args.tenant if tenant_column else None)
+    started = time.perf_counter()
+    documents, aliases = fetch_tenant_rows(corn.supabase, EXPORT_COLUMNS["documents"], EXPORT_COLUMNS["alias"],
+                                           tenant_column, args.tenant)
+    header = export_snapshot(args.out, documents, aliases, args.dtype, version,
+                             tenant=args.tenant if tenant_column else None, tenant_column=tenant_column)
+    print(f"wrote {args.out}: {header['documents']} documents, {header['aliases']} aliases, "
+          f"dim={header['dim']} {header['dtype']}, kb_version={version}, "
+          f"{os.path.getsize(args.out)} bytes in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def _file_lock(path: str):
+    # Khóa giữa các process trên một file .lock riêng (flock, hoặc msvcrt trên Windows)
+    with open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class _Counter:
+    """
+    Một bộ đếm. Khi có path, bộ đếm nằm trong một file dùng chung giữa các gunicorn
+    worker, nên worker nào sửa thì mọi worker khác đều thấy. bump() giữ khóa trên
+    <path>.lock và ghi giá trị mới ra file tạm rồi os.replace, nên current()
+    không cần khóa và không bao giờ đọc phải file đang ghi dở.
+    Không có path thì chỉ đếm trong process.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._value = 0
+        self._stat = None
+
+    def current(self) -> int:
+        if not self.path:
+            return self._value
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if stat != self._stat:
+                self._value = self._read()
+                self._stat = stat
+            return self._value
+
+    def _read(self) -> int:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self) -> int:
+        with self._lock:
+            if not self.path:
+                self._value += 1
+                return self._value
+            with _file_lock(self.path + ".lock"):
+                value = self._read() + 1
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    f.write(str(value))
+                self._replace(tmp)
+            self._stat = None
+            return value
+
+    def _replace(self, tmp: str, attempts: int = 20) -> None:
+        # Windows không cho thay file đang được process khác mở đọc: thử lại một lúc
+        for attempt in range(attempts):
+            try:
+                os.replace(tmp, self.path)
+                return
+            except PermissionError:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.01)
+
+
+class KBVersion:
+    """
+    Phiên bản knowledge base, tăng mỗi khi admin sửa documents/alias.
+
+    Có một bộ đếm chung (scope None, file <path>) và một bộ đếm cho mỗi scope
+    (tenant, file <path>.tenant.<scope>). Phiên bản của một scope là tổng hai bộ
+    đếm: sửa một tenant chỉ làm tenant đó đổi phiên bản, sửa chung (không tách
+    được theo tenant) thì mọi tenant đều đổi.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def _counter(self, scope) -> _Counter:
+        with self._lock:
+            counter = self._counters.get(scope)
+            if counter is None:
+                path = f"{self.path}.tenant.{scope}" if self.path and scope is not None else self.path
+                counter = self._counters[scope] = _Counter(path)
+            return counter
+
+    def current(self, scope: str = None) -> int:
+        version = self._counter(None).current()
+        if scope is not None:
+            version += self._counter(scope).current()
+        return version
+
+    def bump(self, scope: str = None) -> int:
+        self._counter(scope).bump()
+        return self.current(scope)
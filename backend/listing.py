@@ -0,0 +1,100 @@
+import gzip
+import hashlib
+import json
+import zlib
+
+# Helper cho các endpoint liệt kê (get-chunks, get-alias): phân trang keyset,
+# lọc, chọn cột, stream NDJSON, ETag và gzip.
+
+MAX_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 500
+GZIP_MIN_BYTES = 1024
+
+
+class ListQuery:
+    """
+    Tham số query string:
+      limit     số dòng mỗi trang; không có thì trả toàn bộ như trước
+      cursor    id cuối của trang trước (next_cursor)
+      fields    danh sách cột, phân cách bằng dấu phẩy
+      format    "ndjson" để stream từng dòng
+      và các filter được phép của từng bảng (category, subject, is_active, ...)
+    """
+
+    def __init__(self, args, allowed_fields, allowed_filters):
+        fields = [f.strip() for f in (args.get("fields") or "").split(",") if f.strip()]
+        unknown = [f for f in fields if f not in allowed_fields]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        # id luôn có để làm cursor
+        self.fields = list(dict.fromkeys(["id", *(fields or allowed_fields)]))
+
+        self.limit = None
+        if args.get("limit"):
+            self.limit = int(args.get("limit"))
+            if not 1 <= self.limit <= MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+        self.cursor = args.get("cursor") or None
+        self.ndjson = args.get("format") == "ndjson"
+
+        self.filters = {}
+        for name in allowed_filters:
+            value = args.get(name)
+            if value is None or value == "":
+                continue
+            if name == "is_active":
+                if value.lower() not in ("true", "false"):
+                    raise ValueError("is_active must be true or false")
+                value = value.lower() == "true"
+            self.filters[name] = value
+
+    def etag(self, version) -> str:
+        key = json.dumps([version, self.fields, self.limit, self.cursor, self.ndjson, self.filters],
+                         sort_keys=True, default=str)
+        return 'W/"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+    def build(self, supabase, table: str, cursor=None, limit=None):
+        query = supabase.table(table).select(", ".join(self.fields))
+        for name, value in self.filters.items():
+            query = query.eq(name, value)
+        cursor = cursor if cursor is not None else self.cursor
+        if cursor is not None:
+            query = query.gt("id", cursor)
+        query = query.order("id")
+        if limit:
+            query = query.limit(limit)
+        return query
+
+    def fetch_page(self, supabase, table: str):
+        # Lấy thêm 1 dòng để biết còn trang sau hay không
+        rows = self.build(supabase, table, limit=self.limit + 1).execute().data or []
+        next_cursor = rows[self.limit - 1]["id"] if len(rows) > self.limit else None
+        return rows[:self.limit], next_cursor
+
+    def iter_rows(self, supabase, table: str, page_size: int = STREAM_PAGE_SIZE):
+        cursor = self.cursor
+        while True:
+            rows = self.build(supabase, table, cursor=cursor, limit=page_size).execute().data or []
+            yield from rows
+            if len(rows) < page_size:
+                return
+            cursor = rows[-1]["id"]
+
+
+def accepts_gzip(headers) -> bool:
+    return "gzip" in (headers.get("Accept-Encoding") or "").lower()
+
+
+def gzip_body(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=6)
+
+
+def gzip_stream(chunks):
+    # Nén từng phần và flush để client nhận được dữ liệu ngay, không đợi hết
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,257 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Giây; đủ mịn cho normalize/classify (micro giây) lẫn embedding/RPC (trăm mili giây)
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + inner + "}"
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}   # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name)) for name in self.labelnames)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def _quantile(self, counts: list, q: float) -> float:
+        # Ước lượng như histogram_quantile của Prometheus: nội suy tuyến tính trong bucket
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        quantile_lines = [f"# HELP {self.name}_quantile {self.help} (ước lượng p50/p95/p99)",
+                          f"# TYPE {self.name}_quantile gauge"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            counts, total = values[:-1], values[-1]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+            for q in QUANTILES:
+                quantile_lines.append(
+                    f"{self.name}_quantile{_format_labels({**labels, 'quantile': q})} {round(self._quantile(counts, q), 6)}")
+        return lines + quantile_lines
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name)) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+        self._stats = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def add_stats(self, prefix: str, stats_fn) -> None:
+        # stats_fn() -> dict; mỗi giá trị số được xuất thành gauge <prefix>_<key>
+        self._stats.append((prefix, stats_fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats_fn in self._stats:
+            for key, value in stats_fn().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CHAT_STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_seconds", "Thời gian từng bước của /api/chat và /api/chat-stream",
+    ("endpoint", "stage", "category", "subject", "source"))
+CHAT_REQUESTS = REGISTRY.counter(
+    "chat_requests_total", "Số request chat theo nguồn trả lời", ("endpoint", "source"))
+CRUD_CALL_SECONDS = REGISTRY.histogram(
+    "crud_call_seconds", "Thời gian các lời gọi ngoài (OpenAI/Supabase) của endpoint CRUD",
+    ("endpoint", "call"))
+
+
+# --- Đo thời gian theo request ---
+
+class RequestTimings:
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def spans_ms(self) -> dict:
+        return {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()}
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.spans.items()]
+        parts.append(f"total;dur={self.total() * 1000:.3f}")
+        return ", ".join(parts)
+
+    def observe(self, endpoint: str, category, subject, source) -> None:
+        labels = {"endpoint": endpoint, "category": category or "none",
+                  "subject": subject or "none", "source": source or "none"}
+        for name, seconds in self.spans.items():
+            CHAT_STAGE_SECONDS.observe(seconds, stage=name, **labels)
+        CHAT_STAGE_SECONDS.observe(self.total(), stage="total", **labels)
+        CHAT_REQUESTS.inc(endpoint=endpoint, source=labels["source"])
+
+
+_current_timings = ContextVar("request_timings", default=None)
+
+
+def start_timings() -> RequestTimings:
+    timings = RequestTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(name: str):
+    # Ghi vào RequestTimings của request hiện tại (nếu có); asyncio task kế thừa context
+    timings = _current_timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def crud_span(endpoint: str, call: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CRUD_CALL_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, call=call)
+
+
+# Header Server-Timing: bật cho mọi response bằng SERVER_TIMING=1, hoặc theo từng request với "X-Timing: 1"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+
+def server_timing_enabled(request_headers) -> bool:
+    return SERVER_TIMING or request_headers.get("X-Timing") == "1"
+
+
+# --- Log có cấu trúc, lấy mẫu, không chặn request ---
+# Request chỉ đưa record vào queue; QueueListener ghi ra stdout trên thread riêng.
+
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+query_logger = logging.getLogger("chatbot.query")
+query_logger.setLevel(logging.INFO)
+query_logger.propagate = False
+_log_queue = queue.SimpleQueue()
+query_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = None
+_log_listener_pid = None
+_log_listener_lock = threading.Lock()
+
+
+def _ensure_log_listener() -> None:
+    # Thread ghi log được khởi động trong từng process (an toàn khi gunicorn fork)
+    global _log_listener, _log_listener_pid
+    if _log_listener_pid == os.getpid():
+        return
+    with _log_listener_lock:
+        if _log_listener_pid != os.getpid():
+            _log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+            _log_listener.start()
+            atexit.register(_log_listener.stop)
+            _log_listener_pid = os.getpid()
+
+
+def log_event(event: str, **fields) -> None:
+    if LOG_SAMPLE_RATE < 1.0 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    _ensure_log_listener()
+    query_logger.info(json.dumps({"event": event, "ts": time.time(), **fields}, ensure_ascii=False, default=str))
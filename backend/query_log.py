@@ -0,0 +1,285 @@
+"""
+Ghi nhật ký câu hỏi (query log) cho phân tích, kiểu write-behind.
+
+Handler chat chỉ đưa record vào một queue có giới hạn (put không gọi mạng); thread
+nền gom record thành batch (đủ batch_size hoặc sau flush_interval giây) và ghi một
+lần vào sink. Queue đầy thì request chờ tối đa `block` giây rồi bỏ record (đếm ở
+dropped) — không bao giờ làm chậm chat vì Supabase chậm.
+
+Sink (QUERY_LOG_SINK):
+    off       tắt (mặc định)
+    jsonl     mỗi record một dòng JSON trong QUERY_LOG_PATH (chạy offline / kiểm thử)
+    supabase  insert hàng loạt vào bảng QUERY_LOG_TABLE (mặc định query_log), cần tạo bảng trước
+
+Batch ghi Supabase lỗi được ghi sang file JSONL dự phòng (QUERY_LOG_FALLBACK_PATH)
+để không mất dữ liệu. Mỗi file JSONL vượt QUERY_LOG_MAX_MB được đổi tên thành
+<path>.1 (thay bản cũ) rồi ghi file mới, nên đĩa dùng tối đa gấp đôi giới hạn.
+Khi process thoát, phần còn trong queue được ghi nốt.
+
+Bảng Supabase (tạo trước khi đặt QUERY_LOG_SINK=supabase):
+
+    create table query_log (
+      id bigserial primary key,
+      ts timestamptz not null,
+      tenant text, endpoint text,
+      query text, q_format text, category text, subject text, source text,
+      document_ids bigint[], scores real[],
+      timings_ms jsonb, total_ms real
+    );
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+_STOP = object()
+
+
+def query_record(endpoint: str, tenant: str, query: str, q_format: str, category, subject,
+                 replies, source, timings) -> dict:
+    """Record cho một câu hỏi; chỉ giữ id và score của câu trả lời."""
+    replies = replies or []
+    return {
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "tenant": tenant,
+        "endpoint": endpoint,
+        "query": query,
+        "q_format": q_format,
+        "category": category,
+        "subject": subject,
+        "source": source,
+        "document_ids": [r.get("id") for r in replies],
+        "scores": [r.get("score") for r in replies],
+        "timings_ms": timings.spans_ms(),
+        "total_ms": round(timings.total() * 1000, 3),
+    }
+
+
+class JsonlSink:
+
+    def __init__(self, path: str, max_bytes: int = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotations = 0
+        self._lock = threading.Lock()
+
+    def write(self, records: list) -> None:
+        data = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records).encode("utf-8")
+        with self._lock:
+            if self.max_bytes:
+                self._rotate(len(data))
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def _rotate(self, incoming: int) -> None:
+        # Chỉ giữ một bản cũ: <path>.1
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if size and size + incoming > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+            self.rotations += 1
+
+
+class SupabaseSink:
+
+    def __init__(self, supabase, table: str = "query_log"):
+        self.supabase = supabase
+        self.table = table
+
+    def write(self, records: list) -> None:
+        self.supabase.table(self.table).insert(records).execute()
+
+
+class QueryLog:
+
+    def __init__(self, sink, fallback=None, max_queue: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 2.0, block: float = 0.0):
+        self.sink = sink
+        self.fallback = fallback
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self._queue = queue.Queue(max_queue)
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.batches = 0
+        self.written = 0
+        self.fallback_written = 0
+        self.errors = 0
+        self.last_error = None
+        self.max_batch_seen = 0
+        self.flush_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, supabase):
+        kind = os.getenv("QUERY_LOG_SINK", "off")
+        fallback_path = os.getenv("QUERY_LOG_FALLBACK_PATH", "query_log.jsonl")
+        max_bytes = int(float(os.getenv("QUERY_LOG_MAX_MB", "100")) * 1024 * 1024) or None
+        if kind == "off":
+            sink, fallback = None, None
+        elif kind == "jsonl":
+            sink, fallback = JsonlSink(os.getenv("QUERY_LOG_PATH", "query_log.jsonl"), max_bytes), None
+        elif kind == "supabase":
+            sink = SupabaseSink(supabase, os.getenv("QUERY_LOG_TABLE", "query_log"))
+            fallback = JsonlSink(fallback_path, max_bytes) if fallback_path else None
+        else:
+            raise ValueError(f"unknown QUERY_LOG_SINK: {kind!r}")
+        return cls(
+            sink,
+            fallback,
+            max_queue=int(os.getenv("QUERY_LOG_MAX_QUEUE", "10000")),
+            batch_size=int(os.getenv("QUERY_LOG_BATCH_SIZE", "200")),
+            flush_interval=float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "2")),
+            block=float(os.getenv("QUERY_LOG_BLOCK_MS", "0")) / 1000,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+
+    def _ensure_started(self) -> None:
+        # Thread ghi được khởi động trong từng process (an toàn khi gunicorn fork)
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+            self._pid = os.getpid()
+
+    def put(self, record: dict, block: float = None) -> bool:
+        """
+        Đưa record vào queue; False nếu queue vẫn đầy sau `block` giây (record bị bỏ).
+        Trên event loop gọi với block=0 để không bao giờ chặn.
+        """
+        if not self.enabled:
+            return False
+        self._ensure_started()
+        block = self.block if block is None else block
+        try:
+            if block > 0:
+                self._queue.put(record, timeout=block)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+        with self._stats_lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stop = True
+                    break
+                batch.append(record)
+            self._flush(batch)
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self) -> None:
+        batch = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _STOP:
+                batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch: list) -> None:
+        start = time.perf_counter()
+        try:
+            self.sink.write(batch)
+            written, fallback_written = len(batch), 0
+        except Exception as e:
+            with self._stats_lock:
+                self.errors += 1
+                self.last_error = str(e)
+            written, fallback_written = 0, self._write_fallback(batch)
+        with self._stats_lock:
+            self.batches += 1
+            self.written += written
+            self.fallback_written += fallback_written
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.flush_seconds += time.perf_counter() - start
+
+    def _write_fallback(self, batch: list) -> int:
+        if self.fallback is None:
+            with self._stats_lock:
+                self.dropped += len(batch)
+            return 0
+        try:
+            self.fallback.write(batch)
+            return len(batch)
+        except Exception as e:
+            with self._stats_lock:
+                self.errors += 1
+                self.last_error = f"fallback: {e}"
+                self.dropped += len(batch)
+            return 0
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Ghi nốt các record còn trong queue rồi dừng thread (gọi khi process thoát)."""
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            return
+        # Dấu dừng luôn vào được queue dù queue đang đầy
+        with self._queue.mutex:
+            self._queue.queue.append(_STOP)
+            self._queue.unfinished_tasks += 1
+            self._queue.not_empty.notify()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "enabled": self.enabled,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "written": self.written,
+                "fallback_written": self.fallback_written,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "avg_batch_size": round((self.written + self.fallback_written) / self.batches, 2)
+                if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_flush_ms": round(self.flush_seconds / self.batches * 1000, 3) if self.batches else 0.0,
+                "pending": self._queue.qsize(),
+            }
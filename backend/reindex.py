@@ -0,0 +1,471 @@
+"""
+Pipeline embedding lại documents theo content hash.
+
+Mỗi lần ghi document (update-chunk) tính hash của nội dung được embedding; chỉ
+document có hash khác lần embedding gần nhất mới được đưa vào hàng đợi. Worker
+nền lấy từng batch trong hàng đợi, gọi embeddings.create một lần cho cả batch và
+ghi vector về bảng documents hàng loạt.
+
+Hàng đợi, hash đã embedding và checkpoint nằm trong SQLite (WAL), dùng chung
+giữa các gunicorn worker và với CLI:
+
+    python reindex.py                  # embedding các document chưa có / đã đổi
+    python reindex.py --force          # embedding lại toàn bộ tenant
+    python reindex.py --missing-only   # chỉ các dòng embedding IS NULL
+    python reindex.py --drain          # xử lý hết hàng đợi rồi thoát
+
+CLI lưu checkpoint sau mỗi trang, chạy lại sẽ tiếp tục từ chỗ dừng (--restart để làm lại từ đầu).
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from postgrest.exceptions import APIError
+
+from embedding_cache import EMBEDDING_MODEL
+from embedding_codec import to_pgvector
+from tenants import DEFAULT_TENANT
+
+REINDEX_COLUMNS = "id, text_content"
+# Các cột ảnh hưởng tới index trong RAM và câu trả lời (không gồm embedding)
+INDEXED_COLUMNS = ("procedure_name", "text_content", "normalized_text", "category", "subject",
+                   "is_active", "effective_date")
+
+
+def document_text(doc: dict) -> str:
+    return (doc.get("text_content") or "").strip()
+
+
+def content_hash(text: str, model: str = EMBEDDING_MODEL) -> str:
+    # Đổi model cũng coi như nội dung đổi
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+def row_hash(doc: dict) -> str:
+    return hashlib.sha256(json.dumps([doc.get(column) for column in INDEXED_COLUMNS], default=str,
+                                     ensure_ascii=False).encode()).hexdigest()
+
+
+def embed_texts(client, model: str, texts: list) -> list:
+    response = client.embeddings.create(model=model, input=texts)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class ReindexQueue:
+    """
+    - document_hashes: hash của nội dung đã được embedding cho từng document
+    - reindex_queue: document chờ embedding; mỗi document một dòng, lần ghi sau thay lần trước.
+      Worker "thuê" dòng trong lease giây, hết hạn mà chưa xong thì worker khác lấy lại.
+    - saved_hashes: hash các cột được index (row_hash) của lần ghi gần nhất qua API
+    - checkpoints: cursor của CLI backfill
+    """
+
+    def __init__(self, db_path: str = "reindex_queue.sqlite3", lease: float = 120):
+        self.db_path = db_path
+        self.lease = lease
+        self._local = threading.local()
+        self._db().executescript(
+            "CREATE TABLE IF NOT EXISTS document_hashes ("
+            " tenant TEXT NOT NULL, doc_id TEXT NOT NULL, content_hash TEXT NOT NULL,"
+            " embedded_at REAL NOT NULL, PRIMARY KEY (tenant, doc_id));"
+            "CREATE TABLE IF NOT EXISTS reindex_queue ("
+            " tenant TEXT NOT NULL, doc_id TEXT NOT NULL, content_hash TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL, available_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT, PRIMARY KEY (tenant, doc_id));"
+            "CREATE INDEX IF NOT EXISTS reindex_queue_available ON reindex_queue (tenant, available_at);"
+            "CREATE TABLE IF NOT EXISTS saved_hashes ("
+            " tenant TEXT NOT NULL, doc_id TEXT NOT NULL, row_hash TEXT NOT NULL,"
+            " saved_at REAL NOT NULL, PRIMARY KEY (tenant, doc_id));"
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " name TEXT PRIMARY KEY, cursor TEXT, updated_at REAL NOT NULL);"
+        )
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            db_path=os.getenv("REINDEX_QUEUE_PATH", "reindex_queue.sqlite3"),
+            lease=float(os.getenv("REINDEX_LEASE_SECONDS", "120")),
+        )
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def embedded_hashes(self, tenant: str, doc_ids: list) -> dict:
+        if not doc_ids:
+            return {}
+        rows = self._db().execute(
+            "SELECT doc_id, content_hash FROM document_hashes WHERE tenant = ? AND doc_id IN ({})"
+            .format(",".join("?" * len(doc_ids))), (tenant, *map(str, doc_ids))
+        ).fetchall()
+        return dict(rows)
+
+    def enqueue(self, tenant: str, doc: dict, model: str = EMBEDDING_MODEL) -> bool:
+        """Đưa document vào hàng đợi nếu nội dung khác lần embedding gần nhất."""
+        doc_id = str(doc["id"])
+        digest = content_hash(document_text(doc), model)
+        if self.embedded_hashes(tenant, [doc_id]).get(doc_id) == digest:
+            return False
+        now = time.time()
+        self._db().execute(
+            "INSERT INTO reindex_queue (tenant, doc_id, content_hash, enqueued_at, available_at)"
+            " VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (tenant, doc_id) DO UPDATE SET content_hash = excluded.content_hash,"
+            " enqueued_at = excluded.enqueued_at, available_at = excluded.available_at, attempts = 0"
+            " WHERE reindex_queue.content_hash != excluded.content_hash",
+            (tenant, doc_id, digest, now, now),
+        )
+        return True
+
+    def mark_saved(self, tenant: str, doc: dict) -> bool:
+        """Ghi nhận document vừa lưu; False nếu các cột được index giống hệt lần lưu trước."""
+        cursor = self._db().execute(
+            "INSERT INTO saved_hashes (tenant, doc_id, row_hash, saved_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (tenant, doc_id) DO UPDATE SET row_hash = excluded.row_hash, saved_at = excluded.saved_at"
+            " WHERE saved_hashes.row_hash != excluded.row_hash",
+            (tenant, str(doc["id"]), row_hash(doc), time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def claim(self, tenant: str, limit: int) -> list:
+        # BEGIN IMMEDIATE: hai worker không lấy trùng dòng
+        conn = self._db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT doc_id, content_hash FROM reindex_queue"
+                " WHERE tenant = ? AND available_at <= ? ORDER BY enqueued_at LIMIT ?",
+                (tenant, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE reindex_queue SET available_at = ? WHERE tenant = ? AND doc_id = ?",
+                [(now + self.lease, tenant, doc_id) for doc_id, _ in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def complete(self, tenant: str, claimed: list) -> None:
+        # Chỉ xoá nếu không có lần ghi mới hơn thay hash trong lúc đang embedding
+        self._db().executemany(
+            "DELETE FROM reindex_queue WHERE tenant = ? AND doc_id = ? AND content_hash = ?",
+            [(tenant, doc_id, digest) for doc_id, digest in claimed],
+        )
+
+    def retry_later(self, tenant: str, claimed: list, error: str) -> None:
+        # Lùi dần: 2, 4, 8, ... tối đa 10 phút
+        self._db().executemany(
+            "UPDATE reindex_queue SET attempts = attempts + 1, last_error = ?,"
+            " available_at = ? + min(600, 1 << min(attempts + 1, 10))"
+            " WHERE tenant = ? AND doc_id = ? AND content_hash = ?",
+            [(error, time.time(), tenant, doc_id, digest) for doc_id, digest in claimed],
+        )
+
+    def record(self, tenant: str, hashes: dict) -> None:
+        now = time.time()
+        self._db().executemany(
+            "INSERT OR REPLACE INTO document_hashes (tenant, doc_id, content_hash, embedded_at) VALUES (?, ?, ?, ?)",
+            [(tenant, str(doc_id), digest, now) for doc_id, digest in hashes.items()],
+        )
+
+    def depth(self, tenant: str = None) -> int:
+        if tenant is None:
+            return self._db().execute("SELECT COUNT(*) FROM reindex_queue").fetchone()[0]
+        return self._db().execute("SELECT COUNT(*) FROM reindex_queue WHERE tenant = ?", (tenant,)).fetchone()[0]
+
+    def get_checkpoint(self, name: str):
+        row = self._db().execute("SELECT cursor FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_checkpoint(self, name: str, cursor) -> None:
+        if cursor is None:
+            self._db().execute("DELETE FROM checkpoints WHERE name = ?", (name,))
+            return
+        self._db().execute(
+            "INSERT OR REPLACE INTO checkpoints (name, cursor, updated_at) VALUES (?, ?, ?)",
+            (name, str(cursor), time.time()),
+        )
+
+
+class Reindexer:
+    """
+    Embedding + ghi vector cho một tenant.
+    embed_batch(texts) -> list vector; on_saved(docs) nhận từng batch document kèm embedding mới
+    (và cột tenant_column nếu có, để biết tenant nào phải đổi phiên bản knowledge base).
+    """
+
+    def __init__(self, supabase, embed_batch, queue: ReindexQueue, tenant: str = DEFAULT_TENANT,
+                 model: str = EMBEDDING_MODEL, batch_size: int = 128, write_concurrency: int = 8,
+                 interval: float = 1.0, on_saved=None, tenant_column: str = None):
+        self.supabase = supabase
+        self.embed_batch = embed_batch
+        self.queue = queue
+        self.tenant = tenant
+        self.model = model
+        self.batch_size = batch_size
+        self.write_concurrency = write_concurrency
+        self.interval = interval
+        self.on_saved = on_saved
+        self.tenant_column = tenant_column
+        # Bulk upsert cần mọi cột NOT NULL; nếu bảng không cho thì chuyển sang update từng dòng
+        self._bulk_upsert = True
+
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.documents = 0
+        self.skipped = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.last_error = None
+
+    @classmethod
+    def from_env(cls, supabase, embed_batch, queue: ReindexQueue, tenant: str = DEFAULT_TENANT, on_saved=None,
+                 tenant_column: str = None):
+        return cls(
+            supabase, embed_batch, queue, tenant,
+            batch_size=int(os.getenv("REINDEX_BATCH_SIZE", "128")),
+            write_concurrency=int(os.getenv("REINDEX_WRITE_CONCURRENCY", "8")),
+            interval=float(os.getenv("REINDEX_INTERVAL", "1.0")),
+            on_saved=on_saved,
+            tenant_column=tenant_column,
+        )
+
+    # --- Embedding + ghi ---
+
+    def process(self, docs: list, force: bool = False) -> int:
+        """
+        Embedding các document có nội dung khác hash đã ghi nhận (force: tất cả).
+        Trả về số document đã ghi vector mới.
+        """
+        started = time.perf_counter()
+        hashes = {str(doc["id"]): content_hash(document_text(doc), self.model) for doc in docs}
+        known = {} if force else self.queue.embedded_hashes(self.tenant, list(hashes))
+        todo = [doc for doc in docs
+                if document_text(doc) and known.get(str(doc["id"])) != hashes[str(doc["id"])]]
+
+        written = 0
+        for i in range(0, len(todo), self.batch_size):
+            batch = todo[i:i + self.batch_size]
+            vectors = self.embed_batch([document_text(doc) for doc in batch])
+            self._write([(doc, vector) for doc, vector in zip(batch, vectors)])
+            self.queue.record(self.tenant, {doc["id"]: hashes[str(doc["id"])] for doc in batch})
+            written += len(batch)
+            with self._stats_lock:
+                self.batches += 1
+
+        with self._stats_lock:
+            self.documents += written
+            self.skipped += len(docs) - written
+            self.busy_seconds += time.perf_counter() - started
+        return written
+
+    def _write(self, pairs: list) -> None:
+        # Upsert sẽ tạo lại document bị xoá trong lúc đang embedding: chỉ ghi các id còn tồn tại
+        existing = {row["id"] for row in self.supabase.table("documents").select("id")
+                    .in_("id", [doc["id"] for doc, _ in pairs]).execute().data or []}
+        pairs = [(doc, vector) for doc, vector in pairs if doc["id"] in existing]
+        if not pairs:
+            return
+        if self._bulk_upsert:
+            try:
+                self.supabase.table("documents").upsert(
+                    [{"id": doc["id"], "embedding": to_pgvector(vector)} for doc, vector in pairs],
+                    on_conflict="id", default_to_null=False, returning="minimal"
+                ).execute()
+                self._after_write(pairs)
+                return
+            except APIError:
+                self._bulk_upsert = False
+
+        def update(pair):
+            doc, vector = pair
+            self.supabase.table("documents").update({"embedding": to_pgvector(vector)}, returning="minimal") \
+                .eq("id", doc["id"]).execute()
+
+        with ThreadPoolExecutor(max(1, self.write_concurrency)) as pool:
+            list(pool.map(update, pairs))
+        self._after_write(pairs)
+
+    def _after_write(self, pairs: list) -> None:
+        if self.on_saved is not None:
+            self.on_saved([{**doc, "embedding": vector} for doc, vector in pairs])
+
+    # --- Worker đọc hàng đợi ---
+
+    def enqueue(self, doc: dict) -> bool:
+        queued = self.queue.enqueue(self.tenant, doc, self.model)
+        if queued:
+            self.start()
+            self._wakeup.set()
+        return queued
+
+    def drain_once(self) -> int:
+        """Xử lý một batch trong hàng đợi; trả về số dòng đã lấy."""
+        claimed = self.queue.claim(self.tenant, self.batch_size)
+        if not claimed:
+            return 0
+        try:
+            columns = f"{REINDEX_COLUMNS}, {self.tenant_column}" if self.tenant_column else REINDEX_COLUMNS
+            docs = self.supabase.table("documents").select(columns) \
+                .in_("id", [doc_id for doc_id, _ in claimed]).execute().data or []
+            # Lấy nội dung hiện tại trong DB; document đã bị xoá thì bỏ khỏi hàng đợi
+            self.process(docs)
+            self.queue.complete(self.tenant, claimed)
+        except Exception as e:
+            self.queue.retry_later(self.tenant, claimed, str(e))
+            with self._stats_lock:
+                self.errors += 1
+                self.last_error = str(e)
+        return len(claimed)
+
+    def start(self) -> None:
+        # Thread worker được khởi động trong từng process (an toàn khi gunicorn fork)
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._wakeup = threading.Event()
+                threading.Thread(target=self._run, name="reindex-worker", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                claimed = self.drain_once()
+            except Exception as e:
+                claimed = 0
+                with self._stats_lock:
+                    self.errors += 1
+                    self.last_error = str(e)
+            if not claimed:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "documents": self.documents,
+                "skipped": self.skipped,
+                "batches": self.batches,
+                "errors": self.errors,
+                "docs_per_sec": round(self.documents / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+                "queue_depth": self.queue.depth(self.tenant),
+                "last_error": self.last_error,
+            }
+
+
+# --- CLI backfill / embedding lại cả tenant ---
+
+def backfill(reindexer: Reindexer, tenant_column: str = None, force: bool = False,
+             missing_only: bool = False, page_size: int = 500, restart: bool = False, log=print) -> int:
+    mode = "force" if force else "missing" if missing_only else "changed"
+    checkpoint = f"backfill:{reindexer.tenant}:{mode}"
+    queue = reindexer.queue
+    if restart:
+        queue.set_checkpoint(checkpoint, None)
+    cursor = queue.get_checkpoint(checkpoint)
+    if cursor is not None:
+        log(f"resuming {checkpoint} after id {cursor}")
+
+    started = time.perf_counter()
+    scanned = written = 0
+    while True:
+        query = reindexer.supabase.table("documents").select(REINDEX_COLUMNS)
+        if tenant_column:
+            query = query.eq(tenant_column, reindexer.tenant)
+        if missing_only:
+            query = query.is_("embedding", "null")
+        if cursor is not None:
+            query = query.gt("id", cursor)
+        docs = query.order("id").limit(page_size).execute().data or []
+        if not docs:
+            break
+
+        written += reindexer.process(docs, force=force)
+        scanned += len(docs)
+        cursor = docs[-1]["id"]
+        # Checkpoint sau khi trang đã ghi xong: dừng giữa chừng thì chạy lại từ trang kế tiếp
+        queue.set_checkpoint(checkpoint, cursor)
+
+        elapsed = time.perf_counter() - started
+        log(f"scanned={scanned} embedded={written} docs/sec={written / elapsed:.1f} "
+            f"queue_depth={queue.depth(reindexer.tenant)} cursor={cursor}")
+        if len(docs) < page_size:
+            break
+
+    queue.set_checkpoint(checkpoint, None)
+    return written
+
+
+def drain(reindexer: Reindexer, log=print) -> int:
+    started = time.perf_counter()
+    total = 0
+    while True:
+        claimed = reindexer.drain_once()
+        if not claimed:
+            break
+        total += claimed
+        elapsed = time.perf_counter() - started
+        log(f"drained={total} docs/sec={total / elapsed:.1f} "
+            f"queue_depth={reindexer.queue.depth(reindexer.tenant)}")
+    return total
+
+
+def main(argv=None) -> None:
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Embedding lại documents theo content hash")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT)
+    parser.add_argument("--tenant-column", default=os.getenv("TENANT_COLUMN", ""),
+                        help="cột lọc tenant trong bảng documents (bỏ trống: không lọc)")
+    parser.add_argument("--force", action="store_true", help="embedding lại mọi document")
+    parser.add_argument("--missing-only", action="store_true", help="chỉ document chưa có embedding")
+    parser.add_argument("--drain", action="store_true", help="xử lý hàng đợi thay vì quét bảng")
+    parser.add_argument("--restart", action="store_true", help="bỏ checkpoint, quét lại từ đầu")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("REINDEX_BATCH_SIZE", "128")))
+    args = parser.parse_args(argv)
+
+    import corn
+    from kb_version import KBVersion
+
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    reindexer = Reindexer.from_env(
+        corn.supabase, lambda texts: embed_texts(client, EMBEDDING_MODEL, texts),
+        ReindexQueue.from_env(), args.tenant)
+    reindexer.batch_size = args.batch_size
+
+    if args.drain:
+        drain(reindexer)
+    else:
+        backfill(reindexer, args.tenant_column or None, args.force, args.missing_only,
+                 args.page_size, args.restart)
+
+    stats = reindexer.stats()
+    print(stats)
+    if stats["documents"]:
+        # Báo cho các worker đang chạy nạp lại index trong RAM (chỉ của tenant này nếu lọc theo cột tenant)
+        KBVersion(os.getenv("KB_VERSION_PATH", "kb_version")).bump(args.tenant if args.tenant_column else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Cache kết quả cuối cùng của /api/chat theo (tenant, q_format, category, subject, limit).
+
+    Mỗi lần đọc truyền vào phiên bản knowledge base hiện tại của tenant (phần tử đầu của
+    key); phiên bản mới hơn phiên bản đang giữ của tenant đó thì mọi câu trả lời của tenant
+    bị xóa, nên không bao giờ trả về câu trả lời cũ sau khi admin sửa dữ liệu, còn cache
+    của tenant khác giữ nguyên. Request chậm bắt đầu trước lần sửa (phiên bản cũ hơn) không
+    đọc được và không ghi được gì, cũng không đưa phiên bản lùi lại. Giới hạn theo số phần
+    tử và theo số byte (ước lượng bằng độ dài JSON).
+    """
+
+    def __init__(self, max_items: int = 2048, max_bytes: int = 32 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()     # key -> (value, size)
+        self._versions = {}     # tenant -> phiên bản
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self, tenant, version) -> bool:
+        # False: phiên bản của request cũ hơn phiên bản cache đang giữ cho tenant
+        current = self._versions.get(tenant)
+        if current is not None and version < current:
+            return False
+        if version != current:
+            stale = [key for key in self._items if key[0] == tenant]
+            if stale:
+                self.invalidations += 1
+            for key in stale:
+                self.bytes -= self._items.pop(key)[1]
+            self._versions[tenant] = version
+        return True
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._items.get(key) if self._check_version(key[0], version) else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, version) -> None:
+        size = len(json.dumps(value, ensure_ascii=False, default=str).encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if not self._check_version(key[0], version):
+                return
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._items[key] = (value, size)
+            self.bytes += size
+            while len(self._items) > self.max_items or self.bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "items": len(self._items),
+                "bytes": self.bytes,
+                "invalidations": self.invalidations,
+                "kb_versions": dict(self._versions),
+            }
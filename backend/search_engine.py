@@ -0,0 +1,356 @@
+import json
+import math
+import sys
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from embedding_codec import CODEC_DTYPES, dequantize, dot_scores, quantize
+from utils import normalize_text
+
+# Trọng số giữa điểm ngữ nghĩa (cosine) và điểm từ khóa (BM25 đã chuẩn hóa về 0..1)
+SEMANTIC_WEIGHT = 0.7
+LEXICAL_WEIGHT = 0.3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+DOCUMENT_COLUMNS = "id, procedure_name, text_content, normalized_text, category, subject, is_active, effective_date, embedding"
+ALIAS_COLUMNS = "id, document_id, alias_text, normalized_alias, embedding"
+
+# Các trường trả về cho mỗi kết quả, giống search_documents_full_hybrid_v4
+RESULT_FIELDS = ("id", "procedure_name", "text_content", "category", "subject", "effective_date")
+
+# PostgREST trả tối đa 1000 dòng mỗi response (max-rows mặc định của Supabase)
+PAGE_SIZE = 1000
+# Số id mỗi bộ lọc in_ (danh sách nằm trong URL của PostgREST)
+IN_CHUNK_SIZE = 200
+
+# Ước lượng chi phí đối tượng Python cho memory_bytes(): một dict hàng, một entry dict/set
+ROW_OVERHEAD_BYTES = 600
+ENTRY_OVERHEAD_BYTES = 100
+
+
+def rows_memory_bytes(rows) -> int:
+    """Ước lượng bộ nhớ của {id: row dict}; SnapshotRows đọc lười từ memmap nên không tính."""
+    if not isinstance(rows, dict):
+        return 0
+    return sum(ROW_OVERHEAD_BYTES + sum(sys.getsizeof(v) for v in row.values() if isinstance(v, str))
+               for row in rows.values())
+
+
+def fetch_all(supabase, table: str, columns: str, where=None, page_size: int = PAGE_SIZE) -> list:
+    """Mọi dòng của bảng, phân trang keyset theo id; where(query) -> query để thêm bộ lọc."""
+    rows = []
+    cursor = None
+    while True:
+        query = supabase.table(table).select(columns)
+        if where is not None:
+            query = where(query)
+        if cursor is not None:
+            query = query.gt("id", cursor)
+        page = query.order("id").limit(page_size).execute().data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        cursor = page[-1]["id"]
+
+
+def fetch_tenant_rows(supabase, document_columns: str, alias_columns: str, tenant_column: str = None,
+                      tenant: str = None):
+    """
+    (documents, aliases) của một tenant: documents lọc theo tenant_column, alias lấy theo
+    document_id của các document đó (in_ theo từng nhóm IN_CHUNK_SIZE id).
+    Không có tenant_column thì cả hai bảng.
+    """
+    if not tenant_column:
+        return fetch_all(supabase, "documents", document_columns), fetch_all(supabase, "alias", alias_columns)
+    documents = fetch_all(supabase, "documents", document_columns, lambda query: query.eq(tenant_column, tenant))
+    doc_ids = [doc["id"] for doc in documents]
+    aliases = []
+    for start in range(0, len(doc_ids), IN_CHUNK_SIZE):
+        chunk = doc_ids[start:start + IN_CHUNK_SIZE]
+        aliases.extend(fetch_all(supabase, "alias", alias_columns,
+                                 lambda query, chunk=chunk: query.in_("document_id", chunk)))
+    aliases.sort(key=lambda alias: alias["id"])
+    return documents, aliases
+
+
+def parse_embedding(value):
+    # PostgREST trả vector pgvector dưới dạng chuỗi "[0.1,0.2,...]"
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+class LocalSearchEngine:
+    """
+    Tìm kiếm hybrid trong process thay cho RPC search_documents_full_hybrid_v4.
+
+    Mỗi document và mỗi alias là một hàng trong cùng một ma trận đã chuẩn hóa L2
+    (float32, hoặc float16/int8 theo codec để giảm bộ nhớ); điểm của document là
+    điểm lớn nhất trong các hàng thuộc về nó.
+    """
+
+    def __init__(self, dim: int = 1536, codec: str = "float32"):
+        self.dim = dim
+        self.codec = codec
+        self._lock = threading.RLock()
+
+        self.docs = {}              # document_id -> metadata
+        self._doc_ids = []          # doc index -> document_id
+        self._doc_index = {}        # document_id -> doc index
+
+        # Cột metadata dùng để lọc theo category/subject/is_active bằng numpy
+        self._doc_category = np.zeros(0, dtype=object)
+        self._doc_subject = np.zeros(0, dtype=object)
+        self._doc_active = np.zeros(0, dtype=bool)
+
+        self._matrix = np.zeros((0, dim), dtype=CODEC_DTYPES[codec])
+        self._scales = np.zeros(0, dtype=np.float32) if codec == "int8" else None
+        self._row_doc = np.zeros(0, dtype=np.int64)   # row -> doc index, -1 nếu trống
+        self._row_len = np.zeros(0, dtype=np.float32)
+        self._n_rows = 0
+        self._free_rows = []
+        self._doc_row = {}          # document_id -> row của embedding document
+        self._alias_row = {}        # alias_id -> row
+
+        # BM25 trên normalized_text / normalized_alias, tính theo hàng
+        self._row_tf = {}
+        self._postings = defaultdict(dict)
+        self._total_len = 0
+
+    # --- Nạp dữ liệu ---
+
+    @classmethod
+    def from_supabase(cls, supabase, dim: int = 1536, codec: str = "float32",
+                      tenant_column: str = None, tenant: str = None):
+        # tenant_column: chỉ nạp documents của tenant và alias trỏ tới chúng
+        engine = cls(dim, codec)
+        engine.load(*fetch_tenant_rows(supabase, DOCUMENT_COLUMNS, ALIAS_COLUMNS, tenant_column, tenant))
+        return engine
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Dùng trực tiếp ma trận embedding và text trong KBSnapshot (memmap, không sao chép);
+        chỉ id, category/subject và postings BM25 được dựng trong RAM của worker.
+        """
+        engine = cls(snapshot.dim, snapshot.header["dtype"])
+        n_docs, n_rows = snapshot.n_documents, snapshot.n_rows
+        doc_ids = snapshot.ids("documents")
+        alias_ids = snapshot.ids("alias")
+
+        engine.docs = snapshot.rows("documents")
+        engine._doc_ids = list(doc_ids)
+        engine._doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        engine._doc_category = np.array(snapshot.column("documents", "category").tolist(), dtype=object)
+        engine._doc_subject = np.array(snapshot.column("documents", "subject").tolist(), dtype=object)
+        engine._doc_active = np.asarray(snapshot.section("documents.is_active")) != 0
+
+        engine._matrix = snapshot.embeddings
+        if engine.codec == "int8":
+            engine._scales = snapshot.section("embedding_scales")
+        engine._row_doc = snapshot.section("row_doc").astype(np.int64)
+        engine._row_len = np.zeros(n_rows, dtype=np.float32)
+        engine._n_rows = n_rows
+        engine._doc_row = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        engine._alias_row = {alias_id: n_docs + j for j, alias_id in enumerate(alias_ids)}
+
+        texts = snapshot.row_texts()
+        for row in range(n_rows):
+            engine._index_text(row, texts[row] or "")
+        return engine
+
+    def load(self, documents, aliases) -> None:
+        with self._lock:
+            for doc in documents:
+                self.upsert_document(doc)
+            for alias in aliases:
+                self.upsert_alias(alias)
+
+    # --- Cập nhật tăng dần ---
+
+    def upsert_document(self, doc: dict) -> None:
+        with self._lock:
+            doc_id = doc["id"]
+            meta = dict(self.docs.get(doc_id, {}))
+            meta.update({k: v for k, v in doc.items() if k != "embedding"})
+            self.docs[doc_id] = meta
+
+            if doc_id not in self._doc_index:
+                self._doc_index[doc_id] = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._doc_category = np.append(self._doc_category, None)
+                self._doc_subject = np.append(self._doc_subject, None)
+                self._doc_active = np.append(self._doc_active, True)
+
+            i = self._doc_index[doc_id]
+            self._doc_category[i] = meta.get("category")
+            self._doc_subject[i] = meta.get("subject")
+            self._doc_active[i] = meta.get("is_active") is not False
+
+            text = meta.get("normalized_text") or normalize_text(meta.get("text_content") or "")
+            row = self._doc_row.get(doc_id)
+            if row is None:
+                row = self._doc_row[doc_id] = self._alloc_row()
+            # update-chunk không gửi embedding: giữ nguyên vector cũ
+            if "embedding" in doc:
+                embedding = parse_embedding(doc["embedding"])
+            else:
+                embedding = self._row_vector(row)
+            self._set_row(row, i, embedding, text)
+
+    def upsert_alias(self, alias: dict) -> None:
+        with self._lock:
+            doc_id = alias.get("document_id")
+            if doc_id not in self._doc_index:
+                # alias chưa gắn document nào thì không có gì để trả về
+                self.remove_alias(alias["id"])
+                return
+            row = self._alias_row.get(alias["id"])
+            if row is None:
+                row = self._alias_row[alias["id"]] = self._alloc_row()
+            text = alias.get("normalized_alias") or normalize_text(alias.get("alias_text") or "")
+            self._set_row(row, self._doc_index[doc_id], parse_embedding(alias.get("embedding")), text)
+
+    def remove_alias(self, alias_id) -> None:
+        with self._lock:
+            row = self._alias_row.pop(alias_id, None)
+            if row is not None:
+                self._clear_row(row)
+                self._free_rows.append(row)
+
+    def _alloc_row(self) -> int:
+        if self._free_rows:
+            return self._free_rows.pop()
+        if self._n_rows == len(self._matrix):
+            capacity = max(64, 2 * len(self._matrix))
+            matrix = np.zeros((capacity, self.dim), dtype=self._matrix.dtype)
+            matrix[:self._n_rows] = self._matrix[:self._n_rows]
+            if self._scales is not None:
+                scales = np.zeros(capacity, dtype=np.float32)
+                scales[:self._n_rows] = self._scales[:self._n_rows]
+                self._scales = scales
+            row_doc = np.full(capacity, -1, dtype=np.int64)
+            row_doc[:self._n_rows] = self._row_doc[:self._n_rows]
+            row_len = np.zeros(capacity, dtype=np.float32)
+            row_len[:self._n_rows] = self._row_len[:self._n_rows]
+            self._matrix, self._row_doc, self._row_len = matrix, row_doc, row_len
+        self._n_rows += 1
+        return self._n_rows - 1
+
+    def _set_row(self, row: int, doc_index: int, embedding, text: str) -> None:
+        self._clear_row(row)
+        self._row_doc[row] = doc_index
+        if embedding is not None:
+            norm = float(np.linalg.norm(embedding))
+            if norm > 0:
+                self._store_row(row, embedding / norm)
+        self._index_text(row, text)
+
+    def _store_row(self, row: int, vector: np.ndarray) -> None:
+        if self._scales is not None:
+            self._matrix[row], self._scales[row] = quantize(vector, "int8")
+        else:
+            self._matrix[row] = vector
+
+    def _row_vector(self, row: int) -> np.ndarray:
+        return dequantize(self._matrix[row], self._scales[row] if self._scales is not None else 1.0)
+
+    def _index_text(self, row: int, text: str) -> None:
+        tf = Counter(text.split())
+        self._row_tf[row] = tf
+        self._row_len[row] = sum(tf.values())
+        self._total_len += self._row_len[row]
+        for token, count in tf.items():
+            self._postings[token][row] = count
+
+    def _clear_row(self, row: int) -> None:
+        self._row_doc[row] = -1
+        self._matrix[row] = 0
+        self._total_len -= self._row_len[row]
+        self._row_len[row] = 0
+        tf = self._row_tf.pop(row, None)
+        if tf:
+            for token in tf:
+                postings = self._postings[token]
+                postings.pop(row, None)
+                if not postings:
+                    del self._postings[token]
+
+    # --- Tìm kiếm ---
+
+    def _lexical_scores(self, q_format: str) -> np.ndarray:
+        scores = np.zeros(self._n_rows, dtype=np.float32)
+        n_rows = len(self._row_tf)
+        if not n_rows:
+            return scores
+        avg_len = self._total_len / n_rows
+        for token in set(q_format.split()):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_rows - len(postings) + 0.5) / (len(postings) + 0.5))
+            rows = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            lengths = self._row_len[rows]
+            scores[rows] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_len))
+        top = scores.max(initial=0)
+        return scores / top if top > 0 else scores
+
+    def memory_bytes(self) -> int:
+        """
+        Ước lượng bộ nhớ riêng của engine: các mảng numpy (trừ phần memmap của
+        snapshot, dùng chung giữa các process), postings BM25 và metadata documents.
+        """
+        with self._lock:
+            arrays = (self._matrix, self._scales, self._row_doc, self._row_len,
+                      self._doc_category, self._doc_subject, self._doc_active)
+            total = sum(a.nbytes for a in arrays if a is not None and not isinstance(a, np.memmap))
+            entries = sum(len(rows) for rows in self._postings.values())
+            total += 2 * entries * ENTRY_OVERHEAD_BYTES
+            total += (len(self._doc_index) + len(self._doc_row) + len(self._alias_row)) * ENTRY_OVERHEAD_BYTES
+            return total + rows_memory_bytes(self.docs)
+
+    def search(self, q_format: str, query_embedding, category=None, subject=None, limit: int = 5) -> list:
+        with self._lock:
+            n_docs = len(self._doc_ids)
+            if not n_docs:
+                return []
+            n = self._n_rows
+            live = self._row_doc[:n] >= 0
+
+            query = parse_embedding(query_embedding)
+            norm = float(np.linalg.norm(query)) if query is not None else 0.0
+            if norm > 0:
+                semantic = dot_scores(self._matrix[:n], self._scales, query / norm)
+            else:
+                semantic = np.zeros(n, dtype=np.float32)
+            lexical = self._lexical_scores(q_format)
+            row_scores = SEMANTIC_WEIGHT * semantic + LEXICAL_WEIGHT * lexical
+
+            doc_scores = np.full(n_docs, -np.inf, dtype=np.float32)
+            np.maximum.at(doc_scores, self._row_doc[:n][live], row_scores[live])
+
+            keep = self._doc_active.copy()
+            if category:
+                keep &= self._doc_category == category
+            if subject:
+                keep &= self._doc_subject == subject
+            doc_scores[~keep] = -np.inf
+
+            candidates = np.flatnonzero(np.isfinite(doc_scores))
+            if len(candidates) > limit:
+                candidates = candidates[np.argpartition(-doc_scores[candidates], limit - 1)[:limit]]
+            candidates = candidates[np.argsort(-doc_scores[candidates], kind="stable")]
+
+            results = []
+            for i in candidates:
+                meta = self.docs[self._doc_ids[i]]
+                result = {field: meta.get(field) for field in RESULT_FIELDS}
+                result["score"] = round(float(doc_scores[i]), 6)
+                results.append(result)
+            return results
@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import CancelledError, Future
+
+
+class _Call:
+    __slots__ = ("future", "waiters", "cancelled", "task")
+
+    def __init__(self):
+        self.future = Future()
+        self.waiters = 1
+        self.cancelled = threading.Event()
+        self.task = None        # asyncio.Task của do_async dẫn đầu
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi trùng key đang chạy đồng thời: lời gọi đầu tiên làm việc,
+    các lời gọi sau chờ chung một Future và nhận cùng kết quả (hoặc cùng lỗi).
+    Key bị xóa ngay khi xong, không giữ lại kết quả như cache.
+
+    Future dùng chung là concurrent.futures.Future nên thread (do) và event loop
+    (do_async) có thể chờ lẫn nhau trong cùng process.
+
+    Bên chờ bỏ ngang (client ngắt kết nối) gọi release(); khi không còn ai chờ,
+    việc đang chạy được báo dừng (submit) hoặc bị hủy (do_async), và request mới
+    cùng key sẽ chạy lại từ đầu.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key, call, result=None, error=None) -> None:
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def release(self, key, future) -> None:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None or call.future is not future:
+                return
+            call.waiters -= 1
+            if call.waiters > 0:
+                return
+            del self._calls[key]
+            call.cancelled.set()
+            self.cancelled += 1
+            task = call.task
+        if task is not None:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            return call.future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result)
+        return result
+
+    def submit(self, key, fn, executor) -> Future:
+        """
+        Như do() nhưng không chặn: fn(cancelled) chạy trên executor (cùng context
+        của bên gọi, để span() vẫn ghi vào request dẫn đầu), trả về Future dùng chung.
+        fn nên kiểm tra cancelled.is_set() trước mỗi bước tốn kém.
+        """
+        call, leader = self._join(key)
+        if leader:
+            def run():
+                if call.cancelled.is_set():
+                    self._finish(key, call, error=CancelledError())
+                    return
+                try:
+                    result = fn(call.cancelled)
+                except BaseException as e:
+                    self._finish(key, call, error=e)
+                    return
+                self._finish(key, call, result)
+
+            executor.submit(contextvars.copy_context().run, run)
+        return call.future
+
+    async def do_async(self, key, coro_fn):
+        call, leader = self._join(key)
+        if leader:
+            async def run():
+                try:
+                    result = await coro_fn()
+                except BaseException as e:
+                    self._finish(key, call, error=e)
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    return
+                self._finish(key, call, result)
+
+            call.task = asyncio.ensure_future(run())
+        shared = asyncio.wrap_future(call.future)
+        try:
+            # shield: request bị hủy (client ngắt) thì Future chung vẫn nguyên cho các request khác
+            return await asyncio.shield(shared)
+        except asyncio.CancelledError:
+            # Không ai đọc kết quả nữa: lấy exception đi để asyncio không cảnh báo
+            shared.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.release(key, call.future)
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "cancelled": self.cancelled,
+                "in_flight": len(self._calls),
+            }
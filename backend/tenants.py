@@ -0,0 +1,293 @@
+"""
+Phục vụ nhiều phường/xã (tenant) từ một deployment.
+
+Tenant của request lấy từ header X-Tenant hoặc tiền tố đường dẫn /t/<tenant>/api/...
+(TenantPathMiddleware); không có thì là DEFAULT_TENANT. Cấu hình đọc từ TENANTS_PATH:
+
+    {
+      "xa_ba_diem": {"names": ["xã Bà Điểm"], "warm": true},
+      "phuong_tan_thoi_nhat": {"names": ["phường Tân Thới Nhất"], "keywords": {"lich": ["sang thu 7"]}}
+    }
+
+    names     tên phường/xã, thêm vào bảng phuong_info của classifier
+    keywords  từ khóa thêm vào các bảng của utils.KEYWORD_TABLES
+    warm      nạp sẵn index khi worker khởi động (mặc định: chỉ tenant mặc định)
+
+Mỗi tenant có TenantState riêng: classifier và các index (alias index,
+LocalSearchEngine) nạp lười ở lần dùng đầu. TenantRegistry giữ các tenant theo LRU
+trong một ngân sách bộ nhớ chung (ước lượng bằng memory_bytes() của từng index)
+và bỏ tenant dùng lâu nhất khi vượt. Mỗi TenantState ghi phiên bản knowledge base
+của tenant lúc nạp; sync() chỉ bỏ index của tenant có phiên bản đã đổi.
+
+Index chỉ tách được theo tenant khi bảng documents có cột tenant (TENANT_COLUMN của
+app.py); không có thì chỉ tenant mặc định dùng index trong RAM, các tenant khác luôn
+tìm qua RPC (lọc theo p_tenant).
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from utils import keyword_matcher, normalize_text
+
+DEFAULT_TENANT = "xa_ba_diem"
+DEFAULT_CONFIGS = {DEFAULT_TENANT: {"names": ["xã Bà Điểm"], "warm": True}}
+TENANT_HEADER = "X-Tenant"
+TENANT_ID = re.compile(r"[a-z0-9_]{1,64}")
+TENANT_PATH = re.compile(r"^/t/([^/]+)(/api/.*)$")
+
+
+class UnknownTenant(LookupError):
+    pass
+
+
+def load_configs(path: str) -> dict:
+    if not path or not os.path.exists(path):
+        return dict(DEFAULT_CONFIGS)
+    with open(path, encoding="utf-8") as f:
+        configs = json.load(f)
+    for tenant in configs:
+        if not TENANT_ID.fullmatch(tenant):
+            raise ValueError(f"invalid tenant id in {path}: {tenant!r}")
+    # Request không ghi tenant vẫn phục vụ như trước
+    configs.setdefault(DEFAULT_TENANT, DEFAULT_CONFIGS[DEFAULT_TENANT])
+    return configs
+
+
+def tenant_keywords(config: dict) -> dict:
+    extra = {cat: [normalize_text(kw) for kw in keywords]
+             for cat, keywords in (config.get("keywords") or {}).items()}
+    names = [normalize_text(name) for name in config.get("names") or ()]
+    if names:
+        extra.setdefault("phuong_info", []).extend(names)
+    return extra
+
+
+def split_tenant_path(path: str):
+    """/t/<tenant>/api/... -> (tenant, /api/...); đường dẫn khác -> (None, path)."""
+    match = TENANT_PATH.match(path)
+    if match is None:
+        return None, path
+    return match.group(1), match.group(2)
+
+
+class TenantPathMiddleware:
+    """WSGI: /t/<tenant>/api/... được chuyển thành /api/... kèm header X-Tenant."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        tenant, path = split_tenant_path(environ.get("PATH_INFO", ""))
+        if tenant is not None:
+            environ["PATH_INFO"] = path
+            environ["HTTP_X_TENANT"] = tenant
+        return self.wsgi_app(environ, start_response)
+
+
+class TenantState:
+
+    def __init__(self, tenant: str, config: dict, version=None):
+        self.tenant = tenant
+        self.config = config
+        self.matcher = keyword_matcher(tenant_keywords(config))
+        self.indexes = {}       # tên -> index đã nạp
+        self.memory_bytes = 0
+        self.version = version  # phiên bản knowledge base mà các index đang phản ánh
+        self.lock = threading.Lock()
+
+
+class TenantRegistry:
+    """
+    TenantState theo LRU. loaders: {tên index: fn(tenant) -> index có memory_bytes()};
+    version: fn(tenant) -> phiên bản knowledge base hiện tại của tenant.
+    Tenant bị bỏ khi vượt ngân sách vẫn phục vụ xong các request đang giữ index của
+    nó; request sau nạp lại từ đầu.
+    """
+
+    def __init__(self, configs: dict, loaders: dict, memory_budget: int = 512 * 1024 * 1024, version=None):
+        self.configs = configs
+        self.loaders = loaders
+        self.memory_budget = memory_budget
+        self.version = version or (lambda tenant: 0)
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+        self.warm_errors = 0
+        self.last_error = None
+
+    @classmethod
+    def from_env(cls, loaders: dict, version=None):
+        return cls(
+            load_configs(os.getenv("TENANTS_PATH", "tenants.json")),
+            loaders,
+            memory_budget=int(float(os.getenv("TENANT_MEMORY_BUDGET_MB", "512")) * 1024 * 1024),
+            version=version,
+        )
+
+    def resolve(self, value) -> str:
+        tenant = (value or DEFAULT_TENANT).strip().lower()
+        if tenant not in self.configs:
+            raise UnknownTenant(tenant)
+        return tenant
+
+    def state(self, tenant: str) -> TenantState:
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is not None:
+                self._states.move_to_end(tenant)
+                return state
+        # Đọc phiên bản ngoài khóa (có thể stat file)
+        version = self.version(tenant)
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is None:
+                state = self._states[tenant] = TenantState(tenant, self.configs[tenant], version)
+            self._states.move_to_end(tenant)
+            return state
+
+    def matcher(self, tenant: str):
+        return self.state(tenant).matcher
+
+    def get(self, tenant: str, name: str):
+        """Index `name` của tenant, nạp ở lần dùng đầu (mỗi tenant chỉ một thread nạp)."""
+        state = self.state(tenant)
+        index = state.indexes.get(name)
+        if index is not None:
+            return index
+        with state.lock:
+            index = state.indexes.get(name)
+            if index is None:
+                version = state.version
+                start = time.perf_counter()
+                index = self.loaders[name](tenant)
+                size = index.memory_bytes()
+                with self._lock:
+                    self.loads += 1
+                    self.load_seconds += time.perf_counter() - start
+                    # Knowledge base đổi trong lúc nạp (sync/advance đã đổi phiên bản) hoặc tenant
+                    # đã bị bỏ: dùng cho request này nhưng không giữ lại
+                    if state.version == version and self._states.get(tenant) is state:
+                        state.indexes[name] = index
+                        state.memory_bytes += size
+                self._enforce_budget(keep=tenant)
+        return index
+
+    def peek(self, tenant: str, name: str):
+        """Index đã nạp hoặc None; không nạp và không đổi thứ tự LRU."""
+        with self._lock:
+            state = self._states.get(tenant)
+            return state.indexes.get(name) if state is not None else None
+
+    def loaded(self, name: str, tenant: str = None) -> list:
+        """Các index `name` đang nạp, của một tenant hoặc của mọi tenant."""
+        with self._lock:
+            if tenant is None:
+                states = list(self._states.values())
+            else:
+                states = [self._states[tenant]] if tenant in self._states else []
+            return [state.indexes[name] for state in states if name in state.indexes]
+
+    def _enforce_budget(self, keep: str) -> None:
+        with self._lock:
+            total = sum(state.memory_bytes for state in self._states.values())
+            for tenant in list(self._states):
+                if total <= self.memory_budget:
+                    break
+                if tenant == keep:
+                    continue
+                total -= self._states.pop(tenant).memory_bytes
+                self.evictions += 1
+
+    def _drop_indexes(self, state: TenantState) -> None:
+        # Gọi khi đang giữ self._lock; classifier của tenant vẫn giữ nguyên
+        if state.indexes:
+            self.invalidations += 1
+        state.indexes = {}
+        state.memory_bytes = 0
+
+    def sync(self, tenant: str) -> int:
+        """
+        Phiên bản knowledge base hiện tại của tenant. Index nạp ở phiên bản khác (worker
+        khác đã sửa tenant này) bị bỏ và nạp lại ở lần dùng tới; tenant khác không bị ảnh hưởng.
+        """
+        version = self.version(tenant)
+        state = self.state(tenant)
+        with self._lock:
+            if state.version != version:
+                self._drop_indexes(state)
+                state.version = version
+        return version
+
+    def invalidate(self, tenant: str) -> None:
+        """Bỏ index đã nạp của tenant (ví dụ có snapshot mới), nạp lại ở lần dùng tới."""
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is not None:
+                self._drop_indexes(state)
+
+    def loaded_version(self, tenant: str):
+        """Phiên bản mà index đang nạp của tenant phản ánh, None nếu tenant chưa nạp."""
+        with self._lock:
+            state = self._states.get(tenant)
+            return state.version if state is not None else None
+
+    def advance(self, tenant: str, before: int, after: int) -> None:
+        """
+        Index của tenant đã được cập nhật tăng dần trong process này từ phiên bản before
+        lên after: ghi nhận phiên bản mới thay vì nạp lại.
+        """
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is not None and state.version == before:
+                state.version = after
+
+    def refresh_memory(self, tenant: str) -> None:
+        """Tính lại memory_bytes sau khi index của tenant được sửa tăng dần, rồi áp ngân sách."""
+        with self._lock:
+            state = self._states.get(tenant)
+        if state is None:
+            return
+        with state.lock:
+            indexes = state.indexes
+            size = sum(index.memory_bytes() for index in list(indexes.values()))
+            with self._lock:
+                if state.indexes is indexes:
+                    state.memory_bytes = size
+        self._enforce_budget(keep=tenant)
+
+    def warm_tenants(self) -> list:
+        return [tenant for tenant, config in self.configs.items()
+                if config.get("warm", tenant == DEFAULT_TENANT)]
+
+    def warm(self, names, tenants=None) -> None:
+        for tenant in tenants if tenants is not None else self.warm_tenants():
+            for name in names:
+                try:
+                    self.get(tenant, name)
+                except Exception as e:
+                    # Không chặn worker: tenant sẽ được nạp lại ở request đầu tiên
+                    with self._lock:
+                        self.warm_errors += 1
+                        self.last_error = f"{tenant}/{name}: {e}"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "configured": len(self.configs),
+                "loaded": len(self._states),
+                "memory_bytes": sum(state.memory_bytes for state in self._states.values()),
+                "memory_budget_bytes": self.memory_budget,
+                "loads": self.loads,
+                "load_seconds": round(self.load_seconds, 3),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "warm_errors": self.warm_errors,
+                "last_error": self.last_error,
+                "tenants": {tenant: state.memory_bytes for tenant, state in self._states.items()},
+            }
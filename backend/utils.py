@@ -1,29 +1,60 @@
 
 import re
 import unicodedata
+from functools import lru_cache
 
-def normalize_text(text: str) -> str:
-    # Bỏ dấu tiếng Việt
-    text = unicodedata.normalize("NFD", text)
-    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+# --- Chuẩn hóa văn bản ---
+# Bảng dịch ký tự -> chuỗi đã bỏ dấu, lowercase; dấu câu bị xóa, "_" thành
+# khoảng trắng. Bảng dựng sẵn cho toàn bộ chữ Latin/tiếng Việt, ký tự lạ được
+# tính lần đầu gặp rồi ghi lại, nên mỗi câu chỉ cần một lần str.translate.
+
+_WORD_OR_SPACE = re.compile(r"[\w\s]")
+
+
+def _translate_char(ch: str) -> str:
+    out = []
+    for c in unicodedata.normalize("NFD", ch):
+        if unicodedata.category(c) == 'Mn' or not _WORD_OR_SPACE.match(c):
+            continue
+        if c == '_':
+            c = ' '
+        elif c == 'Đ' or c == 'đ':
+            c = 'd'
+        out.append(c.lower())
+    return ''.join(out)
+
+
+class _TranslationTable(dict):
+
+    def __missing__(self, codepoint):
+        value = _translate_char(chr(codepoint))
+        self[codepoint] = value
+        return value
 
-    text = re.sub(r"[^\w\s]", "", text)
 
-    text = text.replace("  ", " ")
-    
-    # Thay _ thành khoảng trắng
-    text = text.replace('_', ' ')
+_NORMALIZE_TABLE = _TranslationTable()
+for _cp in list(range(0x250)) + list(range(0x300, 0x370)) + list(range(0x1E00, 0x1F00)):
+    _NORMALIZE_TABLE[_cp]
 
-    # Thay . thành khoảng trắng
-    text = text.replace('.', ' ')
 
-    text = text.replace('Đ', 'D')
-    text = text.replace('đ', 'd')
+def _normalize(text: str) -> str:
+    # split()/join gộp mọi chuỗi khoảng trắng và trim trong cùng một bước
+    return ' '.join(text.translate(_NORMALIZE_TABLE).split())
 
-    text = text.replace(',', '')
-    
-    # Chuẩn hóa lowercase + trim
-    return text.lower().strip()
+
+# Chỉ nhớ các chuỗi ngắn (câu hỏi, alias); các chunk dài đi thẳng không qua cache
+NORMALIZE_CACHE_MAX_LEN = 512
+_normalize_cached = lru_cache(maxsize=4096)(_normalize)
+
+
+def normalize_text(text: str) -> str:
+    if len(text) <= NORMALIZE_CACHE_MAX_LEN:
+        return _normalize_cached(text)
+    return _normalize(text)
+
+
+def normalize_many(texts) -> list:
+    return [normalize_text(t) if t else '' for t in texts]
 
 THU_TUC_KEYWORDS = [
     "thu tuc",
@@ -66,7 +97,6 @@ PHUONG_INFO_KEYWORDS = [
     "lien he",
     "thanh lap",
     "nam nao",
-    "xa ba diem"
 ]
 
 NHAN_SU_INFO_KEYWORDS = [
@@ -153,42 +183,111 @@ LICH_LAM_VIEC_KEYWORDS = [
     "may gio",
 ]
 
-def classify(q: str):
+# --- Bộ so khớp từ khóa ---
+# Biên dịch tất cả bảng từ khóa một lần thành trie theo token, mỗi câu hỏi
+# chỉ duyệt một lượt. So khớp theo nguyên token nên "cn" không khớp bên trong
+# một từ khác ("cnt", "tcn").
+
+class KeywordMatcher:
 
-    # --- Scores ---
-    thu_tuc_score = sum(1 for kw in THU_TUC_KEYWORDS if kw in q)
-    lanh_dao_score = sum(1 for kw in LANH_DAO_INFO_KEYWORDS if kw in q)
-    nhan_su_score = sum(1 for kw in NHAN_SU_INFO_KEYWORDS if kw in q)
-    khu_pho_score = sum(1 for kw in KHU_PHO_KEYWORDS if kw in q)
-    contact_score = sum(1 for kw in CONTACT_INFO_KEYWORDS if kw in q)
-    lich_score = sum(1 for kw in LICH_LAM_VIEC_KEYWORDS if kw in q)
-    phuong_info_score = sum(1 for kw in PHUONG_INFO_KEYWORDS if kw in q)
+    def __init__(self, tables: dict):
+        self._root = {}
+        self._max_depth = 0
+        self.categories = list(tables)
+        for cat, keywords in tables.items():
+            for kw in keywords:
+                tokens = tuple(kw.split())
+                if not tokens:
+                    continue
+                node = self._root
+                for tok in tokens:
+                    node = node.setdefault(tok, {})
+                # Khóa None đánh dấu kết thúc một từ khóa: (từ khóa, các category)
+                node.setdefault(None, (tokens, set()))[1].add(cat)
+                self._max_depth = max(self._max_depth, len(tokens))
+
+    def scores(self, q: str) -> dict:
+        tokens = q.split()
+        n = len(tokens)
+        # Mỗi từ khóa chỉ tính một lần dù xuất hiện nhiều lần, giống `kw in q`
+        matched = {}
+        for i in range(n):
+            node = self._root
+            for j in range(i, min(i + self._max_depth, n)):
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                hit = node.get(None)
+                if hit is not None:
+                    matched[hit[0]] = hit[1]
+
+        counts = dict.fromkeys(self.categories, 0)
+        for cats in matched.values():
+            for cat in cats:
+                counts[cat] += 1
+        return counts
+
+
+KEYWORD_TABLES = {
+    "thu_tuc": THU_TUC_KEYWORDS,
+    "lanh_dao": LANH_DAO_INFO_KEYWORDS,
+    "nhan_su": NHAN_SU_INFO_KEYWORDS,
+    "khu_pho": KHU_PHO_KEYWORDS,
+    "ds_khu_pho": DS_KHU_PHO_KEYWORDS,
+    "contact": CONTACT_INFO_KEYWORDS,
+    "lich": LICH_LAM_VIEC_KEYWORDS,
+    "phuong_info": PHUONG_INFO_KEYWORDS,
+    "bao_nhieu": ["bao nhieu"],
+}
+
+
+def keyword_matcher(extra: dict = None) -> KeywordMatcher:
+    """KEYWORD_TABLES cộng thêm từ khóa riêng (vd. của một tenant): {category: [từ khóa đã normalize]}."""
+    tables = {cat: list(keywords) for cat, keywords in KEYWORD_TABLES.items()}
+    for cat, keywords in (extra or {}).items():
+        if cat not in tables:
+            raise ValueError(f"unknown keyword table: {cat}")
+        tables[cat].extend(keywords)
+    return KeywordMatcher(tables)
+
+
+# Bảng của tenant mặc định (xa_ba_diem), dùng khi classify() không được truyền matcher
+KEYWORD_MATCHER = keyword_matcher({"phuong_info": ["xa ba diem"]})
+
+def classify(q: str, matcher: KeywordMatcher = KEYWORD_MATCHER):
+
+    # --- Scores (một lượt duy nhất) ---
+    scores = matcher.scores(q)
 
     # --- 1️⃣ Ưu tiên thủ tục ---
-    if thu_tuc_score >= 1:
+    if scores["thu_tuc"] >= 1:
         return "thu_tuc_hanh_chinh", "tu_phap_ho_tich"
 
-    if lich_score >= 1:
+    if scores["lich"] >= 1:
         return "thong_tin_phuong", "lich_lam_viec"
 
     # --- 2️⃣ Subject level ---
-    if lanh_dao_score >= 1:
+    if scores["lanh_dao"] >= 1:
         return "thong_tin_phuong", "lanh_dao"
 
-    if khu_pho_score >= 1:
+    if scores["khu_pho"] >= 1:
         item = "thong_tin_khu_pho"
-        if "bao nhieu" in q:
-            item = "tong_quan" if any(kw in q for kw in DS_KHU_PHO_KEYWORDS) else item
+        if scores["bao_nhieu"]:
+            item = "tong_quan" if scores["ds_khu_pho"] else item
         return "thong_tin_phuong", item
-    
-    if nhan_su_score >= 1:
+
+    if scores["nhan_su"] >= 1:
         return "thong_tin_phuong", "nhan_su"
 
-    if contact_score >= 1:
+    if scores["contact"] >= 1:
         return "thong_tin_phuong", "thong_tin_lien_he"
 
     # --- 3️⃣ Fallback ---
-    if phuong_info_score >= 1:
+    if scores["phuong_info"] >= 1:
         return "thong_tin_phuong", "tong_quan"
 
-    return None, None
\ No newline at end of file
+    return None, None
+
+
+def classify_batch(queries, matcher: KeywordMatcher = KEYWORD_MATCHER):
+    return [classify(q, matcher) for q in queries]